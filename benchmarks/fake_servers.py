@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# 1x1 transparent png, served as the generated image
+PNG_BYTES: bytes = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6300010000000500010d0a2db40000000049454e44ae426082")
+
+
+class FakeServer:
+    def __init__(self, handler: type, **settings) -> None:
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        self.server.settings = settings
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "FakeServer":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class _JSONHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def read_body(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        content_type = self.headers.get("Content-Type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            return {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        return {}
+
+    def send_json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOpenAIHandler(_JSONHandler):
+    # settings: latency (seconds until the first token), token_latency (seconds per streamed token)
+    # and completion_tokens (words in every answer)
+    def do_POST(self) -> None:
+        self.server.requests += 1
+        request = self.read_body()
+        settings = self.server.settings
+        time.sleep(settings.get("latency", 0.0))
+        if self.path.endswith("/images/generations"):
+            host, port = self.server.server_address
+            self.send_json({"created": int(time.time()),
+                            "data": [{"url": f"http://{host}:{port}/images/{i}.png"}
+                                     for i in range(request.get("n", 1))]})
+            return
+        words = [f"word{i}" for i in range(settings.get("completion_tokens", 50))]
+        prompt_tokens = sum([len(str(msg.get("content", "")).split()) for msg in request.get("messages", [])])
+        if request.get("stream"):
+            self._stream(words, settings.get("token_latency", 0.0))
+            return
+        self.send_json({
+            "id": "chatcmpl-fake",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": " ".join(words)}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                      "total_tokens": prompt_tokens + len(words)},
+        })
+
+    def do_GET(self) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(len(PNG_BYTES)))
+        self.end_headers()
+        self.wfile.write(PNG_BYTES)
+
+    def _stream(self, words: list[str], token_latency: float) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for word in words:
+            time.sleep(token_latency)
+            chunk = {"object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+            self._write_chunk(f"data: {json.dumps(chunk)}\n\n".encode())
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._write_chunk(b"")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+class FakeTelegramHandler(_JSONHandler):
+    # answers the Bot API methods the bot uses, settings: latency (seconds per call)
+    message_id: int = 0
+    message_id_lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        self.server.requests += 1
+        request = self.read_body()
+        time.sleep(self.server.settings.get("latency", 0.0))
+        method = self.path.rsplit("/", 1)[-1]
+        if method == "getMe":
+            self.send_json({"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Chatbot",
+                                                   "username": "chatbot_bot"}})
+            return
+        if method in ("sendMessage", "editMessageText"):
+            self.send_json({"ok": True, "result": self._message(request)})
+            return
+        if method == "sendPhoto":
+            self.send_json({"ok": True, "result": self._photo_message(request)})
+            return
+        if method == "sendMediaGroup":
+            media = json.loads(request.get("media", "[]"))
+            self.send_json({"ok": True, "result": [self._photo_message(request) for _ in media]})
+            return
+        self.send_json({"ok": True, "result": True})
+
+    def _photo_message(self, request: dict) -> dict:
+        message = self._message(request)
+        message["photo"] = [{"file_id": f"photo-{message['message_id']}", "file_unique_id": str(message['message_id']),
+                             "width": 1, "height": 1}]
+        return message
+
+    def _message(self, request: dict) -> dict:
+        with self.message_id_lock:
+            FakeTelegramHandler.message_id += 1
+            message_id = FakeTelegramHandler.message_id
+        return {
+            "message_id": int(request.get("message_id", message_id)),
+            "date": int(time.time()),
+            "chat": {"id": int(request.get("chat_id", 1)), "type": "private"},
+            "text": request.get("text", ""),
+        }
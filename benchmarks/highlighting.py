@@ -0,0 +1,94 @@
+import argparse
+import contextlib
+import io
+import random
+import statistics
+import time
+from pygments import highlight
+from pygments.formatters import TerminalFormatter
+from pygments.lexers import PythonLexer
+from modules.consolebot import StreamPrinter
+from modules.highlighting import highlight_text
+
+SNIPPETS: dict[str, list[str]] = {
+    "python": ['def handle(update, context):', '    """Answer the message."""',
+               '    text = update.message.text.strip()', '    if not text:', '        return None',
+               '    return {"chat": update.effective_chat.id, "text": text[:4096]}', ''],
+    "javascript": ['async function load(url) {', '  const response = await fetch(url, {method: "GET"});',
+                   '  if (!response.ok) throw new Error(`status ${response.status}`);',
+                   '  return response.json();', '}', ''],
+    "bash": ['for file in *.jsonl; do', '  gzip -9 "$file" && echo "packed $file"', 'done', ''],
+    "sql": ['SELECT chat_id, count(*) AS messages', 'FROM messages', "WHERE category = 'user'",
+            'GROUP BY chat_id ORDER BY messages DESC;', ''],
+    "": ['x = [i * i for i in range(10)]', 'print(sum(x))', ''],
+}
+PROSE: str = "The function below reads the message, checks that it is not empty and answers with a short text."
+
+
+def answer(blocks: int, block_lines: int, rng: random.Random) -> str:
+    # prose and fenced blocks of several languages, like a long code answer
+    lines: list[str] = []
+    for _ in range(blocks):
+        tag = rng.choice(list(SNIPPETS))
+        code: list[str] = []
+        while len(code) < block_lines:
+            code.extend(SNIPPETS[tag])
+        lines.extend([PROSE, "", f"```{tag}", *code[:block_lines], "```", ""])
+    return "\n".join(lines)
+
+
+def per_line(text: str) -> str:
+    # the former format_codeblock: a new lexer and formatter and a Python highlight for every code line
+    highlighted_text: str = ""
+    in_code_block: bool = False
+    for line in text.split("\n"):
+        if line.startswith("```"):
+            in_code_block = not in_code_block
+            highlighted_text += highlight(line, PythonLexer(), TerminalFormatter()) + "\n"
+        elif in_code_block:
+            highlighted_text += highlight(line, PythonLexer(), TerminalFormatter()) + "\n"
+        else:
+            highlighted_text += line + "\n"
+    highlighted_text = "\n".join(line for line in highlighted_text.split("\n") if line.strip())
+    return highlighted_text + "\n"
+
+
+def streamed(text: str, delta_size: int = 4) -> str:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        printer = StreamPrinter()
+        for i in range(0, len(text), delta_size):
+            printer.feed(text[i:i + delta_size])
+        printer.close()
+    return output.getvalue()
+
+
+def timed(function, text: str, runs: int) -> list[float]:
+    seconds: list[float] = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function(text)
+        seconds.append(time.perf_counter() - started)
+    return seconds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time of highlighting long answers with many code blocks")
+    parser.add_argument("--blocks", type=int, default=20, help="code blocks per answer")
+    parser.add_argument("--block-lines", type=int, default=40, help="lines per code block")
+    parser.add_argument("--runs", type=int, default=10, help="repetitions of every variant")
+    args = parser.parse_args()
+    text = answer(args.blocks, args.block_lines, random.Random(42))
+    lines = text.count("\n") + 1
+    # the first call loads the lexers, it is not part of the timing
+    highlight_text(text)
+    print(f"{args.blocks} blocks, {lines} lines, {len(text)} characters per answer")
+    for name, function in (("per line (before)", per_line), ("block", highlight_text), ("streamed", streamed)):
+        seconds = timed(function, text, args.runs)
+        median = statistics.median(seconds)
+        print(f"{name:18} median {median * 1000:8.1f}ms  min {min(seconds) * 1000:8.1f}ms  "
+              f"{lines / median:10,.0f} lines/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from benchmarks.run import benchmark_environment, percentile
+
+
+def fake_words(count: int, rng: random.Random) -> list[str]:
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(3, 9))) for _ in range(count)]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Build and query time of the message search index on a large history")
+    parser.add_argument("--messages", type=int, default=200000, help="number of folded messages")
+    parser.add_argument("--chats", type=int, default=100, help="number of chats they belong to")
+    parser.add_argument("--queries", type=int, default=500, help="number of searches")
+    parser.add_argument("--top-k", type=int, default=3, help="results per search")
+    args = parser.parse_args()
+    rng = random.Random(42)
+    # a few frequent and many rare words, like in real text
+    vocabulary = fake_words(20000, rng)
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.environ.update(benchmark_environment(tmp_dir, SUMMARY_TOKENS_THRESHOLD="100000"))
+        from modules.config import Config
+        from modules.database import Database, Message, SEARCH_INDEX_SCHEMA
+        from sqlalchemy import insert
+        db = Database(Config.reload().DB_URI)
+        rows = [dict(message=" ".join(rng.choices(vocabulary, weights, k=rng.randint(5, 40))), from_user="Bench_User",
+                     to_user="Chatbot", role="user", category="summarized", chat_id=str(-1000 - i % args.chats),
+                     token_count=30) for i in range(args.messages)]
+
+        # the triggers index every row in the transaction that writes it
+        started = time.perf_counter()
+        with db.engine.begin() as connection:
+            for i in range(0, len(rows), 5000):
+                connection.execute(insert(Message), rows[i:i + 5000])
+        insert_seconds = time.perf_counter() - started
+        # a database of an older version: all rows first, the index is built at once when it is created
+        with db.engine.begin() as connection:
+            for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+                connection.exec_driver_sql(f"DROP TRIGGER {trigger}")
+            connection.exec_driver_sql("DROP TABLE messages_fts")
+            connection.exec_driver_sql("DELETE FROM messages")
+        started = time.perf_counter()
+        with db.engine.begin() as connection:
+            for i in range(0, len(rows), 5000):
+                connection.execute(insert(Message), rows[i:i + 5000])
+        plain_insert_seconds = time.perf_counter() - started
+        started = time.perf_counter()
+        with db.engine.begin() as connection:
+            for statement in SEARCH_INDEX_SCHEMA:
+                connection.exec_driver_sql(statement)
+        build_seconds = time.perf_counter() - started
+
+        query_seconds: list[float] = []
+        found = 0
+        for _ in range(args.queries):
+            chat_id = str(-1000 - rng.randrange(args.chats))
+            question = " ".join(rng.choices(vocabulary, weights, k=rng.randint(3, 15)))
+            started = time.perf_counter()
+            found += len(db.search_messages(chat_id, question, args.top_k))
+            query_seconds.append(time.perf_counter() - started)
+        size = db.database_size()
+
+    print(f"{args.messages} messages in {args.chats} chats, database {size / 1e6:.1f} MB")
+    print(f"insert with index  {insert_seconds:7.2f}s  ({args.messages / insert_seconds:,.0f} rows/s)")
+    print(f"insert without     {plain_insert_seconds:7.2f}s  ({args.messages / plain_insert_seconds:,.0f} rows/s)")
+    print(f"build index        {build_seconds:7.2f}s")
+    print(f"query              p50 {statistics.median(query_seconds) * 1000:.2f}ms  "
+          f"p95 {percentile(query_seconds, 95) * 1000:.2f}ms  p99 {percentile(query_seconds, 99) * 1000:.2f}ms  "
+          f"{found / args.queries:.1f} results per query")
+
+
+if __name__ == "__main__":
+    main()
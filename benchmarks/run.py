@@ -0,0 +1,319 @@
+import argparse
+import asyncio
+import contextlib
+import functools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from dotenv import dotenv_values
+from benchmarks.fake_servers import FakeServer, FakeOpenAIHandler, FakeTelegramHandler
+
+ROOT: Path = Path(__file__).resolve().parent.parent
+RESULTS_DIR: Path = ROOT / "benchmarks" / "results"
+
+# driver: process_message calls ChatBot.process_message from worker threads, console sends through
+# ConsoleBot._send_message one message at a time, telegram feeds updates to the TelegramBot handlers
+SCENARIOS: dict[str, dict] = {
+    "dm-few-chats": dict(driver="process_message", chats=5, messages=10, history=0, group_ratio=0.0),
+    "dm-many-chats": dict(driver="process_message", chats=100, messages=3, history=0, group_ratio=0.0),
+    "long-history": dict(driver="process_message", chats=10, messages=5, history=200, group_ratio=0.0),
+    "console": dict(driver="console", chats=1, messages=30, history=50, group_ratio=0.0),
+    "telegram-dm": dict(driver="telegram", chats=20, messages=5, history=10, group_ratio=0.0),
+    "telegram-groups": dict(driver="telegram", chats=20, messages=5, history=10, group_ratio=0.5),
+}
+
+
+class StageTimer:
+    # sums the time spent in a stage, nested calls of the same stage are only counted once
+    def __init__(self) -> None:
+        self.seconds: dict[str, float] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def patch(self, stage: str, cls: type, names: list[str]) -> None:
+        for name in names:
+            setattr(cls, name, self._wrap(stage, getattr(cls, name)))
+
+    def _wrap(self, stage: str, func):
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            depth = getattr(self._local, stage, 0)
+            setattr(self._local, stage, depth + 1)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                setattr(self._local, stage, depth)
+                if depth == 0:
+                    with self._lock:
+                        self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - started
+        return timed
+
+
+def percentile(values: list[float], percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(percent / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def message_text(chat: int, turn: int) -> str:
+    return f"Question {turn} from chat {chat}: " + " ".join(f"term{(chat * 7 + turn * 3 + i) % 500}"
+                                                             for i in range(25))
+
+
+def install_timers():
+    from modules.database import Database, WriteBehindQueue
+    from modules.tokenizer import Tokenizer
+    timer = StageTimer()
+    timer.patch("db", Database, ["add_message_to_system_log", "add_message_to_messages", "get_messages_from_db",
+                                 "get_conversation_from_db", "get_last_messages_from_db",
+                                 "check_config_exists", "check_conversation_exists",
+                                 "remove_conversation", "remove_last_message", "fold_messages", "flush"])
+    timer.patch("db", WriteBehindQueue, ["flush"])
+    timer.patch("tokenizer", Tokenizer, ["encode_batch"])
+    return timer
+
+
+def seed_history(db, chat_ids: list[str], history: int) -> None:
+    for chat_number, chat_id in enumerate(chat_ids):
+        for turn in range(history):
+            role = 'user' if turn % 2 == 0 else 'assistant'
+            text = message_text(chat_number, turn)
+            db.add_message_to_messages(text, 'Bench_User', 'Chatbot', role, 'user', chat_id,
+                                       len(text.split()) + 7, None)
+    db.flush()
+
+
+def drive_process_message(scenario: dict, concurrency: int) -> list[float]:
+    from modules.chatbot_base import ChatBot
+    from modules.message import OpenAIMessage
+    bot = ChatBot()
+    chat_ids = [f"bench-{i}" for i in range(scenario["chats"])]
+    seed_history(bot.db, chat_ids, scenario["history"])
+    latencies: list[float] = []
+
+    def run_chat(chat_number: int) -> None:
+        for turn in range(scenario["messages"]):
+            message = OpenAIMessage(message_text(chat_number, turn), 'Bench_User', bot.config.NAME,
+                                    'user', 'user', chat_ids[chat_number])
+            started = time.perf_counter()
+            bot.process_message(message, on_delta=(lambda delta: None) if bot.config.STREAM else None)
+            latencies.append(time.perf_counter() - started)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(run_chat, range(scenario["chats"])))
+    bot.db.flush()
+    return latencies
+
+
+def drive_console(scenario: dict, concurrency: int) -> list[float]:
+    from modules.consolebot import ConsoleBot
+    bot = ConsoleBot()
+    seed_history(bot.db, ['system_console'], scenario["history"])
+    latencies: list[float] = []
+    for turn in range(scenario["messages"]):
+        started = time.perf_counter()
+        bot._send_message(message_text(0, turn))
+        latencies.append(time.perf_counter() - started)
+    bot.db.flush()
+    return latencies
+
+
+def telegram_update(update_id: int, chat_id: int, group: bool, text: str) -> dict:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "group", "title": "Bench Group"} if group else
+                {"id": chat_id, "type": "private", "first_name": "Bench"},
+        "from": {"id": abs(chat_id), "is_bot": False, "first_name": "Bench", "last_name": "User"},
+        "text": f"@chatbot_bot {text}" if group else text,
+    }
+    if group:
+        message["entities"] = [{"type": "mention", "offset": 0, "length": len("@chatbot_bot")}]
+    return {"update_id": update_id, "message": message}
+
+
+def drive_telegram(scenario: dict, concurrency: int) -> list[float]:
+    from telegram import Update
+    from modules.telegrambot import TelegramBot
+    bot = TelegramBot()
+    groups = int(scenario["chats"] * scenario["group_ratio"])
+    chats = [(-1000 - i, True) if i < groups else (1000 + i, False) for i in range(scenario["chats"])]
+    seed_history(bot.db, [str(chat_id) for chat_id, _ in chats], scenario["history"])
+    latencies: list[float] = []
+
+    async def run_chats() -> None:
+        application = bot.build_application()
+        await application.initialize()
+
+        async def run_chat(chat_number: int) -> None:
+            chat_id, group = chats[chat_number]
+            for turn in range(scenario["messages"]):
+                payload = telegram_update(chat_number * 1000 + turn + 1, chat_id, group,
+                                          message_text(chat_number, turn))
+                started = time.perf_counter()
+                await application.process_update(Update.de_json(payload, application.bot))
+                latencies.append(time.perf_counter() - started)
+
+        await asyncio.gather(*[run_chat(i) for i in range(len(chats))])
+        await application.shutdown()
+        await bot.close()
+
+    asyncio.run(run_chats())
+    bot.dispatcher.shutdown()
+    bot.db.flush()
+    return latencies
+
+
+def run_child(args: argparse.Namespace) -> None:
+    from modules.transport import get_transport
+    # OPENAI_API_BASE and TELEGRAM_API_BASE point at the fake servers
+    get_transport().install()
+    scenario = SCENARIOS[args.child]
+    timer = install_timers()
+    started = time.perf_counter()
+    if scenario["driver"] == "console":
+        latencies = drive_console(scenario, args.concurrency)
+    elif scenario["driver"] == "telegram":
+        latencies = drive_telegram(scenario, args.concurrency)
+    else:
+        latencies = drive_process_message(scenario, args.concurrency)
+    elapsed = time.perf_counter() - started
+    result = {
+        "params": scenario,
+        "messages": len(latencies),
+        "elapsed_seconds": elapsed,
+        "messages_per_second": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_seconds": {
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies, default=0.0),
+        },
+        "db_seconds": timer.seconds.get("db", 0.0),
+        "tokenizer_seconds": timer.seconds.get("tokenizer", 0.0),
+    }
+    with open(args.result_file, "w") as f:
+        json.dump(result, f)
+
+
+def benchmark_environment(tmp_dir: str, **overrides: str) -> dict:
+    # the example settings make runs independent of the local .env, load_dotenv does not override them
+    env = {key: value for key, value in dotenv_values(ROOT / "example.env").items() if value is not None}
+    env.update(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "sk-benchmark",
+        "TELEGRAM_BOT_TOKEN": "123456:benchmark",
+        "DB_PATH": tmp_dir,
+        "DB_NAME": "benchmark.sqlite",
+        "PYTHONPATH": os.pathsep.join(filter(None, [str(ROOT), os.environ.get("PYTHONPATH")])),
+    })
+    env.update(overrides)
+    return env
+
+
+def child_environment(tmp_dir: str, args: argparse.Namespace, openai_url: str, telegram_url: str) -> dict:
+    return benchmark_environment(tmp_dir, **{
+        "OPENAI_API_BASE": f"{openai_url}/v1",
+        "TELEGRAM_API_BASE": f"{telegram_url}/bot",
+        "STREAM": "true" if args.stream else "false",
+        "MAX_CONCURRENT_REQUESTS": str(args.concurrency),
+        "OPENAI_REQUESTS_PER_MINUTE": "0",
+        "OPENAI_TOKENS_PER_MINUTE": "0",
+        "SCHEDULER_MAX_QUEUE": "100000",
+        # every chat waits for its answer before it sends the next message, a window would only add latency
+        "COALESCE_WINDOW_MS": "0",
+    })
+
+
+def run_scenario(name: str, args: argparse.Namespace) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir, \
+            FakeServer(FakeOpenAIHandler, latency=args.latency_ms / 1000, completion_tokens=args.completion_tokens,
+                       token_latency=args.token_latency_ms / 1000) as openai_server, \
+            FakeServer(FakeTelegramHandler, latency=args.telegram_latency_ms / 1000) as telegram_server:
+        result_file = os.path.join(tmp_dir, "result.json")
+        command = [sys.executable, "-m", "benchmarks.run", "--child", name, "--result-file", result_file,
+                   "--concurrency", str(args.concurrency)]
+        # the bots print to stdout, only errors are shown
+        env = child_environment(tmp_dir, args, openai_server.url, telegram_server.url)
+        subprocess.run(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+        with open(result_file) as f:
+            result = json.load(f)
+        result["openai_requests"] = openai_server.server.requests
+        result["telegram_requests"] = telegram_server.server.requests
+        return result
+
+
+def git_commit() -> str:
+    with contextlib.suppress(Exception):
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    return "unknown"
+
+
+def print_result(name: str, result: dict, baseline: dict or None) -> None:
+    latency = result["latency_seconds"]
+    line = (f"{name:<18} {result['messages']:>5} msgs {result['messages_per_second']:>8.1f} msg/s  "
+            f"p50 {latency['p50'] * 1000:>7.1f}ms  p95 {latency['p95'] * 1000:>7.1f}ms  "
+            f"p99 {latency['p99'] * 1000:>7.1f}ms  db {result['db_seconds']:>6.2f}s  "
+            f"tokenizer {result['tokenizer_seconds']:>6.2f}s")
+    if baseline:
+        change = result['messages_per_second'] / baseline['messages_per_second'] - 1 \
+            if baseline['messages_per_second'] else 0.0
+        line += f"  throughput {change:+.0%} vs {baseline.get('commit', 'baseline')}"
+    print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark of the chatbot")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="scenario to run, can be given more than once (default: all)")
+    parser.add_argument("--latency-ms", type=float, default=50, help="latency of the fake OpenAI API")
+    parser.add_argument("--token-latency-ms", type=float, default=0, help="delay per streamed token")
+    parser.add_argument("--completion-tokens", type=int, default=50, help="tokens in every fake answer")
+    parser.add_argument("--telegram-latency-ms", type=float, default=5, help="latency of the fake Bot API")
+    parser.add_argument("--concurrency", type=int, default=8, help="worker threads / MAX_CONCURRENT_REQUESTS")
+    parser.add_argument("--stream", action="store_true", help="run with STREAM=true")
+    parser.add_argument("--output", help="result file (default: benchmarks/results/<commit>-<time>.json)")
+    parser.add_argument("--compare", help="earlier result file to compare the throughput with")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--result-file", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(args)
+        return
+    baseline: dict = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    commit = git_commit()
+    report = {"commit": commit, "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "settings": {key: value for key, value in vars(args).items()
+                           if key in ("latency_ms", "token_latency_ms", "completion_tokens",
+                                      "telegram_latency_ms", "concurrency", "stream")},
+              "scenarios": {}}
+    for name in args.scenario or list(SCENARIOS):
+        result = run_scenario(name, args)
+        report["scenarios"][name] = result
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous:
+            previous = dict(previous, commit=baseline.get("commit"))
+        print_result(name, result, previous)
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"results written to {output}")
+
+
+if __name__ == "__main__":
+    main()
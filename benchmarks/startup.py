@@ -0,0 +1,51 @@
+import argparse
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.run import ROOT, benchmark_environment
+
+# the console bot prints this line right before it waits for the first input
+PROMPT_LINE: bytes = b"*" * 80
+
+
+def time_to_prompt(env: dict, timeout: float) -> float:
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "chatbot.py"], cwd=ROOT, env=env, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    output = b""
+    try:
+        while PROMPT_LINE not in output:
+            chunk = process.stdout.read1(4096)
+            if not chunk:
+                raise RuntimeError(f"the console bot exited before the prompt: {process.stderr.read().decode()}")
+            output += chunk
+            if time.perf_counter() - started > timeout:
+                raise TimeoutError(f"no prompt after {timeout}s")
+        return time.perf_counter() - started
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time from starting the console bot until it shows the prompt")
+    parser.add_argument("--runs", type=int, default=5, help="number of cold starts")
+    parser.add_argument("--target-ms", type=float, default=1500, help="fail when the median is slower")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for one start")
+    args = parser.parse_args()
+    seconds: list[float] = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = benchmark_environment(tmp_dir, STREAM="false")
+        for _ in range(args.runs):
+            seconds.append(time_to_prompt(env, args.timeout))
+    median = statistics.median(seconds)
+    print(f"start to prompt: median {median * 1000:.0f}ms, min {min(seconds) * 1000:.0f}ms, "
+          f"max {max(seconds) * 1000:.0f}ms over {len(seconds)} runs (target {args.target_ms:.0f}ms)")
+    if median * 1000 > args.target_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
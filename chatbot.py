@@ -1,19 +1,38 @@
 import argparse
-import openai
-import telegram
-from modules.telegrambot import TelegramBot
-from modules.consolebot import ConsoleBot
+import os
+import sys
 from modules.config import Config
 
 config = Config()
-openai.api_key = config.OPENAI_API_KEY
+
+
+def network_errors() -> tuple:
+    # telegram is only imported by the Telegram modes, the console starts without it
+    telegram = sys.modules.get("telegram")
+    return (telegram.error.NetworkError,) if telegram else ()
 
 
 def main(arguments):
-    if arguments.telegram:
+    import openai
+    from modules.transport import get_transport
+    openai.api_key = config.OPENAI_API_KEY
+    get_transport().install()
+    if arguments.batch:
+        from modules.batchbot import BatchBot
+        BatchBot().run(arguments.batch, arguments.batch_output, arguments.concurrency)
+        sys.exit(0)
+    elif arguments.webhook:
+        from modules.webhook import run_webhook
+        run_webhook()
+    elif arguments.telegram and config.SHARD_WORKERS > 0:
+        from modules.shards import run_sharded_polling
+        run_sharded_polling(config.SHARD_WORKERS)
+    elif arguments.telegram:
+        from modules.telegrambot import TelegramBot
         bot: TelegramBot = TelegramBot()
         bot.run()
     else:
+        from modules.consolebot import ConsoleBot
         bot: ConsoleBot = ConsoleBot()
         bot.run()
 
@@ -21,11 +40,48 @@ def main(arguments):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=f'{config.NAME} {config.ARG_PARSER_INFO}')
     parser.add_argument('--telegram', action='store_true', help='start bot as a Telegram bot')
+    parser.add_argument('--webhook', action='store_true', help='start bot as a Telegram bot that receives '
+                                                              'updates through a webhook')
+    parser.add_argument('--shards', type=int, help='spread the Telegram chats over this many worker processes')
+    parser.add_argument('--prefetch', action='store_true', help='download the tokenizer data to TIKTOKEN_CACHE_DIR '
+                                                               'so the bot starts offline')
+    parser.add_argument('--batch', metavar='INPUT', help='answer the prompts of a JSONL file, one {"prompt": ..., '
+                                                        '"chat_id": ..., "id": ...} object per line')
+    parser.add_argument('--batch-output', metavar='OUTPUT', help='append the results to this JSONL file, records '
+                                                                 'already in it are skipped (default: '
+                                                                 'INPUT.results.jsonl)')
+    parser.add_argument('--concurrency', type=int, help='prompts of the batch answered at the same time '
+                                                        '(default: BATCH_CONCURRENCY)')
+    subparsers = parser.add_subparsers(dest='command')
+    report_parser = subparsers.add_parser('report', help='token spend, requests and errors per user, chat or period')
+    report_parser.add_argument('--by', choices=['user', 'chat', 'hour', 'day', 'month'], default='day',
+                               help='group the usage by this (default: day)')
+    report_parser.add_argument('--since', help='first date or time, e.g. 2023-06-01')
+    report_parser.add_argument('--until', help='end date or time, not included')
+    report_parser.add_argument('--format', choices=['table', 'csv', 'json'], default='table')
+    report_parser.add_argument('--output', help='write to this file instead of the terminal')
+    report_parser.add_argument('--rebuild', action='store_true',
+                               help='sum up the archived and the current log again instead of only the new rows')
+    subparsers.add_parser('maintenance', help='archive expired log rows and compact the database once')
     args = parser.parse_args()
+    if args.shards is not None:
+        # the environment is passed on to the worker processes
+        os.environ["SHARD_WORKERS"] = str(args.shards)
+        config = Config.reload()
+    if args.command == 'report':
+        from modules.report import run_report
+        run_report(args)
+        sys.exit(0)
+    if args.command == 'maintenance':
+        from modules.maintenance import Maintenance
+        print(f"{Maintenance().run_once()} rows archived")
+        sys.exit(0)
+    if args.prefetch:
+        from modules.message import OpenAIMessage
+        OpenAIMessage.tokenizer.prefetch([config.MODEL])
+        sys.exit(0)
     for i in range(int(config.CONNECTION_MAX_TRIES) + 1):
         try:
             main(args)
-        except openai.error.APIConnectionError as e:
-            print(config.CONNECTION_ERROR_MESSAGE + ":", e, sep='\n')
-        except telegram.error.NetworkError as e:
+        except network_errors() as e:
             print(config.CONNECTION_ERROR_MESSAGE + ":", e, sep='\n')
@@ -1,20 +1,230 @@
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable
 import openai
 from modules.message import OpenAIMessage
 from modules.config import Config
+from modules.metrics import metrics
+
+RETRYABLE_ERRORS = (
+    openai.error.APIConnectionError,
+    openai.error.Timeout,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+    openai.error.APIError,
+)
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, retry_in: float) -> None:
+        super().__init__(f"OpenAI is unavailable, next try in {retry_in:.0f}s")
+        self.retry_in: float = retry_in
+
+
+class CircuitBreaker:
+    CLOSED: str = 'closed'
+    OPEN: str = 'open'
+    HALF_OPEN: str = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float) -> None:
+        self.failure_threshold: int = failure_threshold
+        self.reset_timeout: float = reset_timeout
+        self.state: str = self.CLOSED
+        self.failures: int = 0
+        self.opened_at: float = 0.0
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            # after the timeout a single request is let through to probe the upstream
+            if self.state == self.OPEN and retry_in <= 0:
+                self.state = self.HALF_OPEN
+                return
+            raise CircuitOpenError(max(retry_in, 0))
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+class RequestStats:
+    def __init__(self, latency_samples: int = 1000) -> None:
+        self.requests: int = 0
+        self.retries: int = 0
+        self.hedged: int = 0
+        self.errors: dict[str, int] = {}
+        self.latencies: deque[float] = deque(maxlen=latency_samples)
+        self._lock = threading.Lock()
+
+    def record_latency(self, seconds: float) -> None:
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+        metrics.observe("openai_request_seconds", seconds)
+
+    def record_error(self, error: Exception) -> None:
+        with self._lock:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+        metrics.inc("openai_errors_total", error=name)
+
+    def record_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+        metrics.inc("openai_retries_total")
+
+    def record_hedge(self) -> None:
+        with self._lock:
+            self.hedged += 1
+        metrics.inc("openai_hedged_total")
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            latencies = sorted(self.latencies)
+        return {
+            "requests": self.requests,
+            "retries": self.retries,
+            "hedged": self.hedged,
+            "errors": dict(self.errors),
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "latency_max": latencies[-1] if latencies else 0.0,
+        }
 
 
 class ChatPartner:
     def __init__(self):
         self.config = Config()
+        self.circuit_breaker = CircuitBreaker(self.config.CIRCUIT_BREAKER_THRESHOLD,
+                                              self.config.CIRCUIT_BREAKER_RESET_TIMEOUT)
+        self.stats = RequestStats()
+        self.hedge_executor: ThreadPoolExecutor or None = None
+        if self.config.OPENAI_HEDGE_DELAY > 0:
+            self.hedge_executor = ThreadPoolExecutor(max_workers=2 * self.config.MAX_CONCURRENT_REQUESTS,
+                                                     thread_name_prefix='openai-hedge')
 
     def talk_to_openai(self, messages: list[OpenAIMessage], response_max_tokens: int) -> dict:
-        response: dict = self._get_openai_response(messages, response_max_tokens)
+        response: dict = self._with_retries(
+            lambda: self._with_hedge(lambda: self._get_openai_response(messages, response_max_tokens)))
         return response
 
-    def _get_openai_response(self, messages: list[OpenAIMessage], max_tokens: int) -> dict:
+    def stream_to_openai(self, messages: list[OpenAIMessage], response_max_tokens: int,
+                         on_delta: Callable[[str], None]) -> dict:
+        content: list[str] = []
+
+        def stream() -> None:
+            for chunk in self._get_openai_response(messages, response_max_tokens, stream=True):
+                delta = chunk["choices"][0]["delta"].get("content")
+                if delta:
+                    content.append(delta)
+                    on_delta(delta)
+
+        # a stream is only retried as long as nothing was shown to the user
+        self._with_retries(stream, can_retry=lambda: not content)
+        # streamed responses carry no usage, it is counted locally to look like a normal response
+        response_content = "".join(content)
+        return {
+            "choices": [{"message": {"role": "assistant", "content": response_content}}],
+            "usage": {
+                "prompt_tokens": sum([msg.token_count for msg in messages]),
+                "completion_tokens": OpenAIMessage.tokenizer.count(response_content, self.config.MODEL),
+            },
+        }
+
+    def _with_retries(self, request: Callable, can_retry: Callable[[], bool] = lambda: True):
+        attempt: int = 0
+        while True:
+            self.circuit_breaker.before_call()
+            started = time.monotonic()
+            try:
+                result = request()
+            except RETRYABLE_ERRORS as e:
+                self.stats.record_error(e)
+                if not self._is_transient(e):
+                    self.circuit_breaker.record_success()
+                    raise
+                self.circuit_breaker.record_failure()
+                if attempt >= self.config.OPENAI_MAX_RETRIES or not can_retry():
+                    raise
+                self.stats.record_retry()
+                time.sleep(self._retry_delay(attempt, e))
+                attempt += 1
+                continue
+            except openai.error.OpenAIError as e:
+                # the upstream answered, the request itself was wrong
+                self.stats.record_error(e)
+                self.circuit_breaker.record_success()
+                raise
+            self.circuit_breaker.record_success()
+            self.stats.record_latency(time.monotonic() - started)
+            return result
+
+    def _with_hedge(self, request: Callable) -> dict:
+        # a second identical request is started when the first one is slow, the first answer wins
+        if self.hedge_executor is None:
+            return request()
+        futures: list[Future] = [self.hedge_executor.submit(request)]
+        done, _ = wait(futures, timeout=self.config.OPENAI_HEDGE_DELAY)
+        if not done:
+            self.stats.record_hedge()
+            futures.append(self.hedge_executor.submit(request))
+        error: Exception or None = None
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            futures = list(pending)
+        raise error
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        # full jitter, and never earlier than the server asked for
+        backoff = min(self.config.OPENAI_RETRY_MAX_DELAY, self.config.OPENAI_RETRY_BASE_DELAY * 2 ** attempt)
+        delay = random.uniform(0, backoff)
+        retry_after = self._retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.config.OPENAI_RETRY_MAX_DELAY))
+        return delay
+
+    @staticmethod
+    def _retry_after(error: Exception) -> float or None:
+        headers = getattr(error, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    @staticmethod
+    def _is_transient(error: Exception) -> bool:
+        # an exhausted quota is reported as a rate limit, but waiting does not help
+        if isinstance(error, openai.error.RateLimitError):
+            return getattr(error, "code", None) != "insufficient_quota"
+        if type(error) is openai.error.APIError:
+            status = getattr(error, "http_status", None)
+            return status is None or status >= 500
+        return True
+
+    def _get_openai_response(self, messages: list[OpenAIMessage], max_tokens: int, stream: bool = False) -> dict:
         return openai.ChatCompletion.create(
             model=self.config.MODEL,
             messages=[msg.to_dict() for msg in messages],
             temperature=self.config.TEMPERATURE,
-            max_tokens=max_tokens
+            max_tokens=max_tokens,
+            stream=stream,
+            request_timeout=(self.config.HTTP_CONNECT_TIMEOUT, self.config.OPENAI_REQUEST_TIMEOUT)
         )
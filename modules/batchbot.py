@@ -0,0 +1,188 @@
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import zlib
+from modules.ai import CircuitOpenError
+from modules.chatbot_base import ChatBot
+from modules.message import OpenAIMessage
+from modules.scheduler import PRIORITY_BATCH, SchedulerBusyError
+from modules.tools import clean_username
+
+# errors after which the same record is tried again instead of being written as failed
+WAIT_AND_RETRY_ERRORS = (CircuitOpenError, SchedulerBusyError)
+
+
+class BatchProgress:
+    def __init__(self, interval: float) -> None:
+        self.interval: float = interval
+        self.started: float = time.monotonic()
+        self.reported: float = self.started
+        self.done: int = 0
+        self.failed: int = 0
+        self.prompt_tokens: int = 0
+        self.completion_tokens: int = 0
+
+    def add(self, result: dict) -> None:
+        self.done += 1
+        self.failed += "error" in result
+        if result.get("usage"):
+            self.prompt_tokens += result["usage"]["prompt_tokens"]
+            self.completion_tokens += result["usage"]["completion_tokens"]
+        if time.monotonic() - self.reported >= self.interval:
+            self.report()
+
+    def report(self) -> None:
+        self.reported = time.monotonic()
+        seconds = max(self.reported - self.started, 1e-9)
+        print(f"{self.done} records ({self.failed} failed) in {seconds:.0f}s, {self.done / seconds:.2f} records/s, "
+              f"{self.prompt_tokens} prompt and {self.completion_tokens} completion tokens, "
+              f"{(self.prompt_tokens + self.completion_tokens) / seconds * 60:.0f} tokens/min", file=sys.stderr)
+
+
+class BatchBot(ChatBot):
+    # answers the prompts of a JSONL file, one {"prompt": ..., "chat_id": ..., "id": ...} object per line,
+    # and appends one result per line to the output file in the order they finish
+    def __init__(self) -> None:
+        super().__init__()
+        self.share_rate_limits(self.config.BATCH_RATE_LIMIT_SHARE)
+        self._current = threading.local()
+        self._output_lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self, input_file: str, output_file: str or None = None, concurrency: int or None = None) -> None:
+        output_file = output_file or os.path.splitext(input_file)[0] + ".results.jsonl"
+        concurrency = max(1, concurrency or self.config.BATCH_CONCURRENCY)
+        done_through, done_records = completed_records(output_file)
+        # the records of a chat always go to the same worker, so a conversation is answered in order;
+        # the short queues keep only a few records in memory whatever the size of the input
+        queues = [queue.Queue(maxsize=2) for _ in range(concurrency)]
+        progress = BatchProgress(self.config.BATCH_PROGRESS_INTERVAL)
+        with open(output_file, "a+") as output:
+            self._end_cut_off_line(output)
+            workers = [threading.Thread(target=self._work, args=(records, output, progress), name=f'batch-{i}',
+                                        daemon=True) for i, records in enumerate(queues)]
+            for worker in workers:
+                worker.start()
+            try:
+                for number, line in self._read_records(input_file):
+                    if number <= done_through or number in done_records:
+                        continue
+                    chat_id = self._chat_id(number, line)
+                    queues[zlib.crc32(chat_id.encode()) % concurrency].put((number, line, chat_id))
+            except KeyboardInterrupt:
+                # the records in the queues are not answered, they are the first ones of the next run
+                self._stopped.set()
+            finally:
+                for records in queues:
+                    records.put(None)
+                for worker in workers:
+                    worker.join()
+        self.trace_log.flush()
+        self._log_message(self.stop_log_msg)
+        self.db.flush()
+        progress.report()
+
+    @staticmethod
+    def _read_records(input_file: str):
+        # records are numbered without the empty lines, the number identifies a record when resuming
+        number = 0
+        with open(input_file) as f:
+            for line in f:
+                if line.strip():
+                    number += 1
+                    yield number, line
+
+    @staticmethod
+    def _chat_id(number: int, line: str) -> str:
+        try:
+            chat_id = json.loads(line).get("chat_id")
+        except (ValueError, AttributeError):
+            chat_id = None
+        # every record without a chat is a conversation of its own
+        return str(chat_id) if chat_id is not None else f"batch-{number}"
+
+    @staticmethod
+    def _end_cut_off_line(output) -> None:
+        # an interrupted run may have left half a line, the next result starts on a new one
+        output.seek(0, os.SEEK_END)
+        if output.tell() > 0:
+            output.seek(output.tell() - 1)
+            if output.read(1) != "\n":
+                output.write("\n")
+
+    def _work(self, records: queue.Queue, output, progress: BatchProgress) -> None:
+        try:
+            while (item := records.get()) is not None:
+                if self._stopped.is_set():
+                    continue
+                result = self._answer(*item)
+                if result is None:
+                    continue
+                with self._output_lock:
+                    output.write(json.dumps(result) + "\n")
+                    output.flush()
+                    progress.add(result)
+        finally:
+            # the session of this thread keeps a pooled connection until it is removed
+            self.db.session.remove()
+
+    def _answer(self, number: int, line: str, chat_id: str) -> dict or None:
+        result = {"record": number, "id": number, "chat_id": chat_id}
+        started = time.monotonic()
+        try:
+            record: dict = json.loads(line)
+            result["id"] = record.get("id", number)
+            message = OpenAIMessage(record["prompt"], clean_username(record.get("user") or self.LOCAL_USERNAME),
+                                    self.config.NAME, 'user', 'user', chat_id)
+        except (ValueError, TypeError, KeyError, AttributeError) as e:
+            return {**result, "error": f"invalid record: {e!r}"}
+        while not self._stopped.is_set():
+            self._current.error = None
+            self._current.usage = None
+            response = self.process_message(message, priority=PRIORITY_BATCH)
+            if isinstance(self._current.error, WAIT_AND_RETRY_ERRORS):
+                # OpenAI is down or the scheduler is full: wait instead of failing the rest of the batch
+                self._stopped.wait(getattr(self._current.error, "retry_in", 1.0) or 1.0)
+                continue
+            result["seconds"] = round(time.monotonic() - started, 3)
+            if response.category == 'user':
+                return {**result, "answer": response.content, "usage": self._current.usage}
+            return {**result, "error": response.content}
+        return None
+
+    def _log_usage(self, message: OpenAIMessage, usage: dict) -> None:
+        super()._log_usage(message, usage)
+        # a record may also pay for the summary of its conversation
+        current: dict = self._current.usage or {"prompt_tokens": 0, "completion_tokens": 0}
+        self._current.usage = {"prompt_tokens": current["prompt_tokens"] + usage["prompt_tokens"],
+                               "completion_tokens": current["completion_tokens"] + usage["completion_tokens"]}
+
+    def _metrics_chat_label(self, message: OpenAIMessage) -> str:
+        # a batch can have millions of chats, their tokens are counted together
+        return PRIORITY_BATCH
+
+    def _handle_error(self, message: OpenAIMessage, error: Exception) -> OpenAIMessage:
+        self._current.error = error
+        return super()._handle_error(message, error)
+
+
+def completed_records(output_file: str) -> tuple[int, set[int]]:
+    # the results are written in the order they finish, but never more than a few records ahead of
+    # the oldest unfinished one: a watermark and the records done after it are enough to resume
+    done_through, done_records = 0, set()
+    if not os.path.exists(output_file):
+        return done_through, done_records
+    with open(output_file) as f:
+        for line in f:
+            try:
+                done_records.add(json.loads(line)["record"])
+            except (ValueError, TypeError, KeyError):
+                # the half line of an interrupted run
+                continue
+            while done_through + 1 in done_records:
+                done_through += 1
+                done_records.discard(done_through)
+    return done_through, done_records
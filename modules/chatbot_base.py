@@ -1,10 +1,17 @@
 import datetime
+import json
+from typing import Callable
 from modules.database import Database
 from modules.message import OpenAIMessage
 from modules.config import Config
 from modules.tools import clean_username
 from modules.conversation import Conversation
+from modules.conversation_cache import ConversationCache
 from modules.ai import ChatPartner
+from modules.context import ContextWindow
+from modules.scheduler import RequestScheduler, SchedulerBusyError, PRIORITY_DM, PRIORITY_GROUP
+from modules.metrics import metrics, TraceLog
+from modules.completion_cache import CompletionCache
 
 
 class ChatBot:
@@ -14,6 +21,16 @@ class ChatBot:
         self.LOCAL_USERNAME: str = clean_username(self.config.LOCAL_USERNAME)
         self.db = Database(self.config.DB_URI)
         self.chatpartner = ChatPartner()
+        self.scheduler = RequestScheduler(self.config.OPENAI_REQUESTS_PER_MINUTE,
+                                          self.config.OPENAI_TOKENS_PER_MINUTE,
+                                          self.config.SCHEDULER_MAX_QUEUE)
+        self.context_window = ContextWindow(self.chatpartner, self.scheduler, self._log_usage)
+        self.completion_cache = CompletionCache(self.db)
+        self.conversations = ConversationCache(self.config.CONVERSATION_CACHE_SIZE,
+                                               self.config.CONVERSATION_CACHE_IDLE_SECONDS)
+        self.trace_log = TraceLog(self.db, self.config.TRACE_SAMPLE_RATE, self.config.TRACE_BATCH_SIZE,
+                                  self.config.TRACE_FLUSH_INTERVAL)
+        self._register_gauges()
         self.start_log_msg = OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
                                            f"{self.config.NAME} "
                                            f"{self.config.START_LOG_MSG}"
@@ -26,35 +43,121 @@ class ChatBot:
                                           'system', 'system', 'system', 'log', 'system_log')
         self._log_message(self.start_log_msg)
 
-    def process_message(self, message: OpenAIMessage) -> OpenAIMessage:
-        conversation: Conversation = Conversation(message.chat_id, message.sender)
+    def process_message(self, message: OpenAIMessage, on_delta: Callable[[str], None] or None = None,
+                        priority: str = PRIORITY_DM) -> OpenAIMessage:
+        with metrics.trace(message.chat_id) as trace:
+            response_message = self._process_message(message, on_delta, priority)
+        self.trace_log.record(trace)
+        return response_message
+
+    def _process_message(self, message: OpenAIMessage, on_delta: Callable[[str], None] or None,
+                         priority: str) -> OpenAIMessage:
+        metrics.inc("messages_total", priority=priority)
+        conversation: Conversation = self.conversations.get(message.chat_id, message.sender)
+        if self.context_window.is_too_long(conversation, message):
+            return self._handle_too_long(message)
         conversation.add_message(message)
         try:
-            response: dict = self.chatpartner.talk_to_openai(conversation.full_messages, self.config.MAX_TOKENS)
+            with metrics.span("context"):
+                messages, response_max_tokens = self.context_window.build(conversation, priority)
+            response: dict = self._complete(message, messages, response_max_tokens, on_delta, priority)
             response_message: OpenAIMessage = conversation.create_openai_response_message(response)
-            response_message.token_count = response["usage"]["completion_tokens"]
+            response_message.token_count = response["usage"]["completion_tokens"] + \
+                OpenAIMessage.tokenizer.message_overhead(response_message.role, response_message.sender,
+                                                         self.config.MODEL)
             conversation.add_message(response_message)
+        except SchedulerBusyError as e:
+            metrics.inc("scheduler_rejected_total")
+            conversation.remove_last_message()
+            self._handle_error(message, e)
+            response_message = OpenAIMessage(self.config.BUSY_MESSAGE, self.config.NAME, message.sender,
+                                             'assistant', 'log', message.chat_id)
         except Exception as e:
+            metrics.inc("errors_total", error=type(e).__name__)
             conversation.remove_last_message()
             response_message = self._handle_error(message, e)
         return response_message
 
+    def _complete(self, message: OpenAIMessage, messages: list[OpenAIMessage], response_max_tokens: int,
+                  on_delta: Callable[[str], None] or None, priority: str) -> dict:
+        cache_key: str or None = None
+        if self.completion_cache.is_eligible(messages):
+            cache_key = self.completion_cache.key(messages, response_max_tokens)
+            response: dict or None = self.completion_cache.get(cache_key)
+            if response is not None:
+                if on_delta and self.config.STREAM:
+                    on_delta(response["choices"][0]["message"]["content"])
+                return response
+        estimated_tokens = sum([msg.token_count for msg in messages]) + response_max_tokens
+        with self.scheduler.slot(message.chat_id, priority, estimated_tokens) as ticket, metrics.span("openai"):
+            if on_delta and self.config.STREAM:
+                response: dict = self.chatpartner.stream_to_openai(messages, response_max_tokens, on_delta)
+            else:
+                response: dict = self.chatpartner.talk_to_openai(messages, response_max_tokens)
+            ticket.actual_tokens = response["usage"]["prompt_tokens"] + response["usage"]["completion_tokens"]
+        chat_label = self._metrics_chat_label(message)
+        metrics.inc("tokens_total", response["usage"]["prompt_tokens"], chat_id=chat_label, direction="in")
+        metrics.inc("tokens_total", response["usage"]["completion_tokens"], chat_id=chat_label, direction="out")
+        self._log_usage(message, response["usage"])
+        if cache_key:
+            self.completion_cache.put(cache_key, response)
+        return response
+
+    def share_rate_limits(self, share: float) -> None:
+        # processes that run at the same time with the same OpenAI account each get a share of its limits
+        self.scheduler.set_limits(self.config.OPENAI_REQUESTS_PER_MINUTE * share,
+                                  self.config.OPENAI_TOKENS_PER_MINUTE * share)
+
+    def _register_gauges(self) -> None:
+        metrics.gauge("scheduler_queue_depth", lambda: self.scheduler.queued + self.scheduler.waiting)
+        metrics.gauge("db_write_queue_pending", lambda: len(self.db.write_queue))
+        metrics.gauge("conversation_cache_size", lambda: self.conversations.size)
+        metrics.gauge("conversation_cache_hit_ratio", lambda: self.conversations.hit_ratio)
+        metrics.gauge("tokenizer_cache_hit_ratio", lambda: OpenAIMessage.tokenizer.hit_ratio)
+        metrics.gauge("completion_cache_hit_ratio", lambda: self.completion_cache.hit_ratio)
+        metrics.gauge("openai_circuit_open", lambda: self.chatpartner.circuit_breaker.state != 'closed')
+
+    def _metrics_chat_label(self, message: OpenAIMessage) -> str:
+        # every label value is a time series of its own that is kept until the process ends, so the chats
+        # are only counted one by one on request; Telegram gives groups negative ids
+        if self.config.METRICS_PER_CHAT:
+            return message.chat_id
+        return PRIORITY_GROUP if str(message.chat_id).startswith("-") else PRIORITY_DM
+
     def _handle_error(self, message: OpenAIMessage, error: Exception) -> OpenAIMessage:
         error_message = OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
                                       f"{self.config.ERROR_LOG_MSG}"
                                       f"{self.config.LOG_MSG_APPENDIX} "
                                       f"{self.config.LOG_MSG_PREFIX} "
                                       f"{error} ",
-                                      'system', 'system', 'system', 'log', message.chat_id)
+                                      'system', message.sender, 'system', 'error', message.chat_id)
         self._log_message(error_message)
         return error_message
 
+    def _handle_too_long(self, message: OpenAIMessage) -> OpenAIMessage:
+        self._log_message(OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
+                                        f"{self.config.MESSAGE_TOO_LONG_LOG_MSG} "
+                                        f"{message.sender}"
+                                        f"{self.config.LOG_MSG_APPENDIX}",
+                                        'system', 'system', 'system', 'log', message.chat_id))
+        max_tokens = self.context_window.prompt_budget
+        return OpenAIMessage(self.config.MESSAGE_TOO_LONG_USER_MSG.format(max_tokens=max_tokens),
+                             self.config.NAME, message.sender, 'assistant', 'log', message.chat_id)
+
+    def _log_usage(self, message: OpenAIMessage, usage: dict) -> None:
+        # one row per request that was sent to OpenAI, answers from the completion cache cost nothing
+        usage = {"prompt_tokens": usage["prompt_tokens"], "completion_tokens": usage["completion_tokens"]}
+        self.db.add_message_to_system_log(json.dumps(usage), message.sender, self.config.NAME, 'system', 'usage',
+                                          message.chat_id, usage["prompt_tokens"] + usage["completion_tokens"],
+                                          datetime.datetime.now())
+
     def _log_message(self, message: OpenAIMessage):
         self.db.add_message_to_system_log(message.content, message.sender, message.receiver,
                                           message.role, message.category, message.chat_id,
                                           message.token_count, datetime.datetime.now())
 
     def _start_conversation(self, message: OpenAIMessage, logging: bool = True) -> None:
+        self.conversations.invalidate(message.chat_id)
         msg_list = self._create_start_messages(message)
         for msg in msg_list:
             self.db.add_message_to_messages(msg.content, msg.sender, msg.receiver,
@@ -69,17 +172,17 @@ class ChatBot:
             self._log_message(conversation_start_log_msg)
 
     def _create_start_messages(self, message: OpenAIMessage) -> list[OpenAIMessage]:
-        return [
+        msg_list = [
             OpenAIMessage(self.config.SYSTEM_PROMPT, self.config.NAME, message.receiver,
                           'system', 'config', message.chat_id),
             OpenAIMessage(self.config.MY_NAME_IS + ' ' + message.sender.replace("_", " "),
-                          message.sender, message.receiver, 'user', 'config', message.chat_id, token_count=7),
+                          message.sender, message.receiver, 'user', 'config', message.chat_id),
             OpenAIMessage(f'{self.config.I_WILL_CALL_YOU} {message.sender.split("_", 1)[0]}',
-                          self.config.NAME, message.sender, 'assistant', 'config', message.chat_id, token_count=7),
+                          self.config.NAME, message.sender, 'assistant', 'config', message.chat_id),
         ]
+        OpenAIMessage.tokenizer.count_messages(msg_list, self.config.MODEL)
+        return msg_list
 
-    def _remove_conversation(self, chat_id: str) -> list:
-        conversation = self.db.remove_conversation(chat_id)
-        conversation_list = [OpenAIMessage(msg.message, msg.from_user, msg.to_user, msg.role, msg.category, msg.chat_id)
-                             for msg in conversation]
-        return conversation_list
+    def _remove_conversation(self, chat_id: str) -> int:
+        self.conversations.invalidate(chat_id)
+        return self.db.remove_conversation(chat_id)
@@ -0,0 +1,67 @@
+import hashlib
+import itertools
+import json
+import re
+from datetime import datetime, timedelta
+from modules.config import Config
+from modules.database import Database
+from modules.message import OpenAIMessage
+from modules.metrics import metrics
+
+WHITESPACE = re.compile(r"\s+")
+
+
+class CompletionCache:
+    # exact-match cache of completions, stored in the database so it survives restarts and is shared by processes
+    # the limits are enforced every EVICT_EVERY new entries, the table may be that much larger in between
+    EVICT_EVERY: int = 100
+
+    def __init__(self, db: Database) -> None:
+        self.config: Config = Config()
+        self.db: Database = db
+        self.enabled: bool = self.config.COMPLETION_CACHE
+        self.ttl = timedelta(seconds=self.config.COMPLETION_CACHE_TTL)
+        self.hits: int = 0
+        self.misses: int = 0
+        self._puts = itertools.count(1)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def is_eligible(self, messages: list[OpenAIMessage]) -> bool:
+        # a random answer is only worth repeating at a low temperature, a first question without
+        # earlier turns is answered from the same prompt every time
+        if not self.enabled:
+            return False
+        if self.config.TEMPERATURE <= self.config.COMPLETION_CACHE_MAX_TEMPERATURE:
+            return True
+        return len([msg for msg in messages if msg.category != 'config']) == 1
+
+    def key(self, messages: list[OpenAIMessage], max_tokens: int) -> str:
+        # everything that is sent is part of the key, the names too: an answer may address the user by the
+        # name the config messages introduce, so only users of the same name share an entry
+        prompt = [(msg.role, msg.sender, WHITESPACE.sub(" ", msg.content).strip()) for msg in messages]
+        payload = json.dumps([self.config.MODEL, self.config.TEMPERATURE, max_tokens, prompt])
+        return hashlib.blake2b(payload.encode(), digest_size=20).hexdigest()
+
+    def get(self, key: str) -> dict or None:
+        response = self.db.get_cached_completion(key, datetime.now() - self.ttl)
+        if response is None:
+            self.misses += 1
+            metrics.inc("completion_cache_misses_total")
+            return None
+        self.hits += 1
+        metrics.inc("completion_cache_hits_total")
+        return json.loads(response)
+
+    def put(self, key: str, response: dict) -> None:
+        self.db.add_cached_completion(key, json.dumps({"choices": response["choices"], "usage": response["usage"]}))
+        # counting the whole table after every insert would cost more than the cache saves
+        if next(self._puts) % self.EVICT_EVERY == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        self.db.evict_cached_completions(datetime.now() - self.ttl, self.config.COMPLETION_CACHE_MAX_ENTRIES,
+                                         self.config.COMPLETION_CACHE_MAX_BYTES)
@@ -1,31 +1,125 @@
 import os
 from dotenv import load_dotenv
-load_dotenv()
 
 
 class Config:
-    def __init__(self):
+    # the settings are read once per process, every Config() returns the same instance
+    _instance: "Config" = None
+
+    def __new__(cls) -> "Config":
+        if cls._instance is None:
+            load_dotenv()
+            instance = super().__new__(cls)
+            instance._load()
+            cls._instance = instance
+        return cls._instance
+
+    @classmethod
+    def reload(cls) -> "Config":
+        # for settings that are changed in the environment of the running process
+        cls._instance = None
+        return cls()
+
+    def _load(self) -> None:
         self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
         self.TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
         self.TELEGRAM_STARTED_MESSAGE = os.getenv("TELEGRAM_STARTED_MESSAGE")
         self.TELEGRAM_STOPPED_MESSAGE = os.getenv("TELEGRAM_STOPPED_MESSAGE")
         self.TELEGRAM_START_MESSAGE = os.getenv("TELEGRAM_START_MESSAGE")
         self.TELEGRAM_HELP_MESSAGE = os.getenv("TELEGRAM_HELP_MESSAGE")
+        self.TELEGRAM_EDIT_INTERVAL = float(os.getenv("TELEGRAM_EDIT_INTERVAL", 1.0))
+        self.COALESCE_WINDOW_MS: float = float(os.environ.get("COALESCE_WINDOW_MS", 1000))
+        self.WEBHOOK_URL: str = os.environ.get("WEBHOOK_URL", "")
+        self.WEBHOOK_PATH: str = os.environ.get("WEBHOOK_PATH", "/telegram")
+        self.WEBHOOK_HOST: str = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+        self.WEBHOOK_PORT: int = int(os.environ.get("WEBHOOK_PORT", 8443))
+        self.WEBHOOK_SECRET_TOKEN: str = os.environ.get("WEBHOOK_SECRET_TOKEN", "")
+        self.WEBHOOK_WORKERS: int = int(os.environ.get("WEBHOOK_WORKERS", 1))
+        self.SHARD_WORKERS: int = int(os.environ.get("SHARD_WORKERS", 0))
+        self.SHARD_DRAIN_TIMEOUT: float = float(os.environ.get("SHARD_DRAIN_TIMEOUT", 30))
         self.MODEL = os.getenv("MODEL")
         self.MAX_TOKENS = int(os.getenv("MAX_TOKENS"))
         self.MAX_TOKENS_SUMMARY = int(os.getenv("MAX_TOKENS_SUMMARY"))
+        self.TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+        self.TIKTOKEN_CACHE_DIR: str = os.environ.get("TIKTOKEN_CACHE_DIR") or \
+            os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".tiktoken")
+        self.MODEL_MAX_TOKENS = int(os.getenv("MODEL_MAX_TOKENS", 4000))
+        self.MESSAGE_MAX_TOKENS = int(os.getenv("MESSAGE_MAX_TOKENS", 3000))
+        self.RESPONSE_MIN_TOKENS = int(os.getenv("RESPONSE_MIN_TOKENS", 500))
+        self.SUMMARY_TOKENS_THRESHOLD = int(os.getenv("SUMMARY_TOKENS_THRESHOLD", 2000))
+        self.SUMMARY_PROMPT: str = os.environ.get(
+            "SUMMARY_PROMPT",
+            "Summarize the following conversation in at most {max_tokens} tokens. "
+            "Keep names, facts, decisions and open questions.")
+        self.SUMMARY_MESSAGE_PREFIX: str = os.environ.get("SUMMARY_MESSAGE_PREFIX",
+                                                          "Summary of the earlier conversation:")
+        self.SUMMARY_ERROR_LOG_MSG: str = os.environ.get("SUMMARY_ERROR_LOG_MSG", "Summary could not be created")
+        self.MEMORY_TOP_K: int = int(os.environ.get("MEMORY_TOP_K", 3))
+        self.MEMORY_MAX_TOKENS: int = int(os.environ.get("MEMORY_MAX_TOKENS", 400))
         self.NAME = os.getenv("NAME")
         self.SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT")
         self.TEMPERATURE = float(os.getenv("TEMPERATURE"))
+        self.COMPLETION_CACHE: bool = os.environ.get("COMPLETION_CACHE", "false").lower() == "true"
+        self.COMPLETION_CACHE_MAX_TEMPERATURE: float = float(os.environ.get("COMPLETION_CACHE_MAX_TEMPERATURE", 0.3))
+        self.COMPLETION_CACHE_TTL: float = float(os.environ.get("COMPLETION_CACHE_TTL", 86400))
+        self.COMPLETION_CACHE_MAX_ENTRIES: int = int(os.environ.get("COMPLETION_CACHE_MAX_ENTRIES", 10000))
+        self.COMPLETION_CACHE_MAX_BYTES: int = int(os.environ.get("COMPLETION_CACHE_MAX_BYTES", 50000000))
+        self.STREAM: bool = os.environ.get("STREAM", "true").lower() == "true"
         self.BYE_MESSAGE = os.getenv("BYE_MESSAGE")
+        self.BUSY_MESSAGE = os.getenv("BUSY_MESSAGE", "I am busy right now, please try again in a minute.")
         self.MY_NAME_IS: str = os.environ.get("MY_NAME_IS")
         self.LOCAL_USERNAME: str = os.environ.get("LOCAL_USERNAME")
         self.CONNECTION_MAX_TRIES: str = os.environ.get("CONNECTION_MAX_TRIES")
+        self.OPENAI_MAX_RETRIES: int = int(os.environ.get("OPENAI_MAX_RETRIES", 3))
+        self.OPENAI_RETRY_BASE_DELAY: float = float(os.environ.get("OPENAI_RETRY_BASE_DELAY", 1.0))
+        self.OPENAI_RETRY_MAX_DELAY: float = float(os.environ.get("OPENAI_RETRY_MAX_DELAY", 30))
+        self.OPENAI_REQUEST_TIMEOUT: float = float(os.environ.get("OPENAI_REQUEST_TIMEOUT", 60))
+        self.OPENAI_API_BASE: str = os.environ.get("OPENAI_API_BASE", "")
+        self.TELEGRAM_API_BASE: str = os.environ.get("TELEGRAM_API_BASE", "")
+        self.HTTP_MAX_CONNECTIONS: int = int(os.environ.get("HTTP_MAX_CONNECTIONS", 100))
+        self.HTTP_MAX_CONNECTIONS_PER_HOST: int = int(os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", 16))
+        self.HTTP_MAX_HOSTS: int = int(os.environ.get("HTTP_MAX_HOSTS", 10))
+        self.HTTP_CONNECT_TIMEOUT: float = float(os.environ.get("HTTP_CONNECT_TIMEOUT", 5))
+        self.HTTP_KEEPALIVE_TIMEOUT: float = float(os.environ.get("HTTP_KEEPALIVE_TIMEOUT", 30))
+        self.TELEGRAM_TIMEOUT: float = float(os.environ.get("TELEGRAM_TIMEOUT", 10))
+        self.TELEGRAM_HTTP2: bool = os.environ.get("TELEGRAM_HTTP2", "false").lower() == "true"
+        self.OPENAI_HEDGE_DELAY: float = float(os.environ.get("OPENAI_HEDGE_DELAY", 0))
+        self.CIRCUIT_BREAKER_THRESHOLD: int = int(os.environ.get("CIRCUIT_BREAKER_THRESHOLD", 5))
+        self.CIRCUIT_BREAKER_RESET_TIMEOUT: float = float(os.environ.get("CIRCUIT_BREAKER_RESET_TIMEOUT", 30))
+        self.OPENAI_REQUESTS_PER_MINUTE: float = float(os.environ.get("OPENAI_REQUESTS_PER_MINUTE", 3500))
+        self.OPENAI_TOKENS_PER_MINUTE: float = float(os.environ.get("OPENAI_TOKENS_PER_MINUTE", 90000))
+        self.SCHEDULER_MAX_QUEUE: int = int(os.environ.get("SCHEDULER_MAX_QUEUE", 100))
+        self.MAX_CONCURRENT_REQUESTS: int = int(os.environ.get("MAX_CONCURRENT_REQUESTS", 4))
+        self.BATCH_CONCURRENCY: int = int(os.environ.get("BATCH_CONCURRENCY", self.MAX_CONCURRENT_REQUESTS))
+        self.BATCH_PROGRESS_INTERVAL: float = float(os.environ.get("BATCH_PROGRESS_INTERVAL", 10))
+        self.BATCH_RATE_LIMIT_SHARE: float = float(os.environ.get("BATCH_RATE_LIMIT_SHARE", 0.5))
+        self.CONVERSATION_CACHE_SIZE: int = int(os.environ.get("CONVERSATION_CACHE_SIZE", 256))
+        self.CONVERSATION_CACHE_IDLE_SECONDS: int = int(os.environ.get("CONVERSATION_CACHE_IDLE_SECONDS", 1800))
         self.CONNECTION_ERROR_MESSAGE: str = os.environ.get("CONNECTION_ERROR_MESSAGE")
         self.DB_NAME: str = os.environ.get("DB_NAME")
         self.DB_PATH: str = os.environ.get("DB_PATH")
         self.DB_FULL_NAME: str = os.path.join(self.DB_PATH, self.DB_NAME)
         self.DB_URI: str = f'sqlite:///{self.DB_FULL_NAME}'
+        self.DB_POOL_SIZE: int = int(os.environ.get("DB_POOL_SIZE", 5))
+        self.DB_MAX_OVERFLOW: int = int(os.environ.get("DB_MAX_OVERFLOW", 10))
+        self.DB_POOL_TIMEOUT: float = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+        self.DB_WRITE_BEHIND: bool = os.environ.get("DB_WRITE_BEHIND", "true").lower() == "true"
+        self.DB_WRITE_BATCH_SIZE: int = int(os.environ.get("DB_WRITE_BATCH_SIZE", 50))
+        self.DB_WRITE_FLUSH_INTERVAL: float = float(os.environ.get("DB_WRITE_FLUSH_INTERVAL", 1.0))
+        self.ARCHIVE_PATH: str = os.environ.get("ARCHIVE_PATH") or os.path.join(self.DB_PATH, "archive")
+        self.LOG_RETENTION_DAYS: float = float(os.environ.get("LOG_RETENTION_DAYS", 90))
+        self.LOG_RETENTION_ROWS_PER_CHAT: int = int(os.environ.get("LOG_RETENTION_ROWS_PER_CHAT", 0))
+        self.SUMMARIZED_RETENTION_DAYS: float = float(os.environ.get("SUMMARIZED_RETENTION_DAYS", 90))
+        self.DB_MAX_BYTES: int = int(os.environ.get("DB_MAX_BYTES", 0))
+        self.DB_FULL_VACUUM: bool = os.environ.get("DB_FULL_VACUUM", "false").lower() == "true"
+        self.MAINTENANCE_INTERVAL: float = float(os.environ.get("MAINTENANCE_INTERVAL", 3600))
+        self.MAINTENANCE_CHUNK_SIZE: int = int(os.environ.get("MAINTENANCE_CHUNK_SIZE", 1000))
+        self.METRICS_PORT: int = int(os.environ.get("METRICS_PORT", 0))
+        self.METRICS_HOST: str = os.environ.get("METRICS_HOST", "127.0.0.1")
+        self.METRICS_PER_CHAT: bool = os.environ.get("METRICS_PER_CHAT", "false").lower() == "true"
+        self.TRACE_SAMPLE_RATE: float = float(os.environ.get("TRACE_SAMPLE_RATE", 0.1))
+        self.TRACE_BATCH_SIZE: int = int(os.environ.get("TRACE_BATCH_SIZE", 20))
+        self.TRACE_FLUSH_INTERVAL: float = float(os.environ.get("TRACE_FLUSH_INTERVAL", 60))
         self.ARG_PARSER_INFO: str = os.environ.get("ARG_PARSER_INFO")
         self.LOG_MSG_PREFIX: str = os.environ.get("LOG_MSG_PREFIX")
         self.LOG_MSG_APPENDIX: str = os.environ.get("LOG_MSG_APPENDIX")
@@ -39,4 +133,13 @@ class Config:
         self.I_WILL_CALL_YOU: str = os.environ.get("I_WILL_CALL_YOU")
         self.ERROR_LOG_MSG: str = os.environ.get("ERROR_LOG_MSG")
         self.REMOVE_LAST_MESSAGE_LOG_MSG: str = os.environ.get("REMOVE_LAST_MESSAGE_LOG_MSG")
+        self.COMMAND_LOG_MSG: str = os.environ.get("COMMAND_LOG_MSG", "Command executed:")
         self.TELEGRAM_IMAGE_CAPTION: str = os.environ.get("TELEGRAM_IMAGE_CAPTION")
+        self.TELEGRAM_PIC_USAGE_MESSAGE: str = os.environ.get("TELEGRAM_PIC_USAGE_MESSAGE",
+                                                              "Usage: /pic [number of pictures] description")
+        self.PICTURE_PATH: str = os.environ.get("PICTURE_PATH") or os.path.join(self.DB_PATH, "pictures")
+        self.PICTURE_SIZE: str = os.environ.get("PICTURE_SIZE", "1024x1024")
+        self.PICTURE_MAX_N: int = int(os.environ.get("PICTURE_MAX_N", 4))
+        self.PICTURE_RETENTION_DAYS: float = float(os.environ.get("PICTURE_RETENTION_DAYS", 30))
+        self.PICTURE_MAX_BYTES: int = int(os.environ.get("PICTURE_MAX_BYTES", 500000000))
+        self.PICTURE_MAX_DOWNLOAD_BYTES: int = int(os.environ.get("PICTURE_MAX_DOWNLOAD_BYTES", 20000000))
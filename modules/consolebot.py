@@ -1,10 +1,54 @@
 import sys
 import readline
-from pygments import highlight
-from pygments.formatters import TerminalFormatter
-from pygments.lexers import PythonLexer
 from modules.chatbot_base import ChatBot
+from modules.highlighting import FENCE, IncrementalHighlighter, highlight_text
 from modules.message import OpenAIMessage
+from modules.scheduler import PRIORITY_CONSOLE
+from modules.metrics import metrics
+
+
+class StreamPrinter:
+    def __init__(self) -> None:
+        self.line: str = ""
+        self.printed: int = 0
+        self.code_block: IncrementalHighlighter or None = None
+        self.has_output: bool = False
+
+    def feed(self, delta: str) -> None:
+        self.line += delta
+        while "\n" in self.line:
+            line, self.line = self.line.split("\n", 1)
+            self._finish_line(line)
+        # prose is printed as it arrives, code lines are highlighted once they are complete
+        if self.code_block is None and self.line.strip() and not self._may_be_fence(self.line):
+            self._write(self.line[self.printed:])
+            self.printed = len(self.line)
+
+    def close(self) -> None:
+        if self.line:
+            self._finish_line(self.line)
+            self.line = ""
+
+    def _finish_line(self, line: str) -> None:
+        if self.printed:
+            self._write(line[self.printed:] + "\n")
+            self.printed = 0
+        elif line.startswith(FENCE):
+            self.code_block = IncrementalHighlighter(line[len(FENCE):]) if self.code_block is None else None
+            self._write(line + "\n")
+        elif self.code_block is not None:
+            self._write(self.code_block.add_line(line) + "\n")
+        elif line.strip():
+            self._write(line + "\n")
+
+    @staticmethod
+    def _may_be_fence(line: str) -> bool:
+        return line.startswith(FENCE) or FENCE.startswith(line)
+
+    def _write(self, text: str) -> None:
+        self.has_output = True
+        sys.stdout.write(text)
+        sys.stdout.flush()
 
 
 class ConsoleBot(ChatBot):
@@ -18,6 +62,7 @@ class ConsoleBot(ChatBot):
             "/exit": self.stop,
             "/stop": self.stop,
             "/bye": self.stop,
+            "/stats": self.show_stats,
         }
         self.SEPARATOR_LINE: str = u"\033[32m" + "*" * 80 + u"\033[0m"
         self.conversation_reset_log_msg = OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
@@ -47,7 +92,19 @@ class ConsoleBot(ChatBot):
         self._log_message(self.conversation_reset_log_msg)
         return f'{self.config.CONSOLE_RESET_MSG}'
 
+    def show_stats(self) -> str:
+        stats = metrics.to_dict()
+        lines: list[str] = []
+        for name, histogram in stats["histograms"].items():
+            lines.append(f"{name}: {histogram['count']} x {histogram['mean'] * 1000:.1f}ms mean, "
+                         f"p50 <= {histogram['p50'] * 1000:.0f}ms, p95 <= {histogram['p95'] * 1000:.0f}ms, "
+                         f"max {histogram['max'] * 1000:.0f}ms")
+        lines.extend([f"{name}: {value:g}" for name, value in stats["counters"].items()])
+        lines.extend([f"{name}: {value:g}" for name, value in stats["gauges"].items()])
+        return "\n".join(lines)
+
     def stop(self) -> None:
+        self.trace_log.flush()
         self._log_message(self.stop_log_msg)
         print(u"\033[0m" + self.config.BYE_MESSAGE)
         sys.exit(0)
@@ -75,21 +132,22 @@ class ConsoleBot(ChatBot):
             return command() + "\n" + self.SEPARATOR_LINE + "\n"
         msg_obj: OpenAIMessage = OpenAIMessage(message, self.LOCAL_USERNAME, self.config.NAME,
                                                'user', 'user', 'system_console')
-        answer_from_openai: OpenAIMessage = self.process_message(msg_obj)
+        if self.config.STREAM:
+            sys.stdout.write(u"\033[0m")
+            printer = StreamPrinter()
+            answer_from_openai: OpenAIMessage = self.process_message(msg_obj, on_delta=printer.feed,
+                                                                     priority=PRIORITY_CONSOLE)
+            printer.close()
+            if printer.has_output and answer_from_openai.category == 'user':
+                return self.SEPARATOR_LINE + "\n"
+            if printer.has_output:
+                # the stream broke off, the error is shown after the part of the answer that was printed
+                return answer_from_openai.content + "\n" + self.SEPARATOR_LINE + "\n"
+        else:
+            answer_from_openai: OpenAIMessage = self.process_message(msg_obj, priority=PRIORITY_CONSOLE)
         highlighted_reply: str = self.format_codeblock(answer_from_openai.content)
         return highlighted_reply + self.SEPARATOR_LINE + "\n"
 
     @staticmethod
     def format_codeblock(text: str) -> str:
-        highlighted_text: str = ""
-        in_code_block: bool = False
-        for line in text.split("\n"):
-            if line.startswith("```"):
-                in_code_block = not in_code_block
-                highlighted_text += highlight(line, PythonLexer(), TerminalFormatter()) + "\n"
-            elif in_code_block:
-                highlighted_text += highlight(line, PythonLexer(), TerminalFormatter()) + "\n"
-            else:
-                highlighted_text += line + "\n"
-        highlighted_text = "\n".join(line for line in highlighted_text.split("\n") if line.strip())
-        return highlighted_text + "\n"
+        return highlight_text(text)
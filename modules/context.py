@@ -0,0 +1,114 @@
+from typing import Callable
+from modules.config import Config
+from modules.message import OpenAIMessage
+from modules.conversation import Conversation
+from modules.ai import ChatPartner
+from modules.tokenizer import Tokenizer
+from modules.scheduler import RequestScheduler, PRIORITY_DM
+from modules.metrics import metrics
+
+
+class ContextWindow:
+    def __init__(self, chatpartner: ChatPartner, scheduler: RequestScheduler,
+                 log_usage: Callable[[OpenAIMessage, dict], None] or None = None) -> None:
+        self.config: Config = Config()
+        self.chatpartner: ChatPartner = chatpartner
+        self.scheduler: RequestScheduler = scheduler
+        self.log_usage: Callable[[OpenAIMessage, dict], None] or None = log_usage
+
+    @property
+    def prompt_budget(self) -> int:
+        return min(self.config.MESSAGE_MAX_TOKENS, self.config.MODEL_MAX_TOKENS - self.config.RESPONSE_MIN_TOKENS)
+
+    def is_too_long(self, conversation: Conversation, message: OpenAIMessage) -> bool:
+        return conversation.config_tokens + message.token_count > self.prompt_budget
+
+    def build(self, conversation: Conversation, priority: str = PRIORITY_DM) -> tuple[list[OpenAIMessage], int]:
+        self.summarize(conversation, priority)
+        messages: list[OpenAIMessage] = list(conversation.config_messages)
+        if conversation.summary_message:
+            messages.append(conversation.summary_message)
+        budget: int = self.prompt_budget - Tokenizer.TOKENS_REPLY_PRIMING - sum([msg.token_count for msg in messages])
+        # only the token counts are read to choose the messages, objects are built for the ones that are sent
+        start: int = len(conversation.user_messages)
+        for token_count in reversed(conversation.user_messages.token_counts):
+            # the newest message is always sent, older ones only while they fit
+            if start < len(conversation.user_messages) and token_count > budget:
+                break
+            start -= 1
+            budget -= token_count
+        messages.extend(self._recall(conversation, budget))
+        messages.extend(conversation.user_messages[start:])
+        prompt_tokens: int = Tokenizer.TOKENS_REPLY_PRIMING + sum([msg.token_count for msg in messages])
+        response_max_tokens: int = max(1, min(self.config.MAX_TOKENS, self.config.MODEL_MAX_TOKENS - prompt_tokens))
+        return messages, response_max_tokens
+
+    def _recall(self, conversation: Conversation, budget: int) -> list[OpenAIMessage]:
+        # folded messages that are relevant to the newest one, in their original order before the recent ones
+        if self.config.MEMORY_TOP_K <= 0 or len(conversation.user_messages) == 0:
+            return []
+        budget = min(budget, self.config.MEMORY_MAX_TOKENS)
+        recalled: list[tuple[int, OpenAIMessage]] = []
+        with metrics.span("recall"):
+            for message_id, msg in conversation.recall(conversation.user_messages.contents[-1],
+                                                       self.config.MEMORY_TOP_K):
+                if msg.token_count <= budget:
+                    recalled.append((message_id, msg))
+                    budget -= msg.token_count
+        metrics.inc("recalled_messages_total", len(recalled))
+        return [msg for _, msg in sorted(recalled, key=lambda item: item[0])]
+
+    def summarize(self, conversation: Conversation, priority: str = PRIORITY_DM) -> None:
+        keep_tokens: int = self.config.SUMMARY_TOKENS_THRESHOLD // 2
+        while conversation.user_tokens > self.config.SUMMARY_TOKENS_THRESHOLD:
+            count: int = self._messages_to_fold(conversation, keep_tokens)
+            if count == 0:
+                return
+            try:
+                summary: str = self._create_summary(conversation, conversation.user_messages[:count], priority)
+            except Exception as e:
+                conversation.system_log(OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
+                                                      f"{self.config.SUMMARY_ERROR_LOG_MSG}"
+                                                      f"{self.config.LOG_MSG_APPENDIX} "
+                                                      f"{self.config.LOG_MSG_PREFIX} "
+                                                      f"{e} ",
+                                                      'system', 'system', 'system', 'log', conversation.chat_id))
+                return
+            conversation.fold_messages(count, summary)
+
+    def _messages_to_fold(self, conversation: Conversation, keep_tokens: int) -> int:
+        # fold the oldest messages until the rest fits into keep_tokens, but never the newest
+        # message and never more than one summary request can take
+        fold_budget: int = self.prompt_budget - self.config.MAX_TOKENS_SUMMARY - conversation.summary_tokens
+        remaining: int = conversation.user_tokens
+        folded_tokens: int = 0
+        count: int = 0
+        for token_count in conversation.user_messages.token_counts[:-1]:
+            if remaining <= keep_tokens:
+                break
+            if count and folded_tokens + token_count > fold_budget:
+                break
+            remaining -= token_count
+            folded_tokens += token_count
+            count += 1
+        return count
+
+    def _create_summary(self, conversation: Conversation, messages: list[OpenAIMessage], priority: str) -> str:
+        transcript: list[str] = []
+        if conversation.summary_message:
+            transcript.append(conversation.summary_message.content)
+        transcript.extend([f"{msg.sender}: {msg.content}" for msg in messages])
+        prompt = [
+            OpenAIMessage(self.config.SUMMARY_PROMPT.format(max_tokens=self.config.MAX_TOKENS_SUMMARY),
+                          self.config.NAME, self.config.NAME, 'system', 'summary', conversation.chat_id),
+            OpenAIMessage("\n".join(transcript),
+                          self.config.NAME, self.config.NAME, 'user', 'summary', conversation.chat_id),
+        ]
+        estimated_tokens = sum([msg.token_count for msg in prompt]) + self.config.MAX_TOKENS_SUMMARY
+        with self.scheduler.slot(conversation.chat_id, priority, estimated_tokens) as ticket:
+            response: dict = self.chatpartner.talk_to_openai(prompt, self.config.MAX_TOKENS_SUMMARY)
+            ticket.actual_tokens = response["usage"]["prompt_tokens"] + response["usage"]["completion_tokens"]
+        if self.log_usage:
+            # the summary is paid for by the user whose message made the conversation too long
+            self.log_usage(conversation.user_messages[-1], response["usage"])
+        return response["choices"][0]["message"]["content"]
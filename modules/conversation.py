@@ -1,19 +1,21 @@
 from modules.config import Config
-from modules.message import OpenAIMessage
+from modules.message import OpenAIMessage, MessageStore
 from modules.database import Database
 from modules.tools import clean_username
 import datetime
 
 
 class Conversation:
-    config = Config()
-    db = Database(config.DB_URI)
-
     def __init__(self, chat_id: str, username: str) -> None:
+        self.config: Config = Config()
+        self.db: Database = Database(self.config.DB_URI)
         self.chat_id: str = chat_id
         self.username: str = clean_username(username)
         self.config_messages: list[OpenAIMessage] = []
-        self.user_messages: list[OpenAIMessage] = []
+        self.user_messages: MessageStore = MessageStore(chat_id, 'user')
+        self.summary_message: OpenAIMessage or None = None
+        # running total, kept up to date by every change of the config messages
+        self._config_tokens: int = 0
         self.conversation_start_log_msg = OpenAIMessage(f"{self.config.LOG_MSG_PREFIX} "
                                                         f"{self.config.CONVERSATION_START_LOG_MSG} "
                                                         f"{self.username}"
@@ -25,11 +27,13 @@ class Conversation:
                                                         f"{self.config.LOG_MSG_APPENDIX}",
                                                         'system', 'system', 'system', 'log', self.chat_id)
         self.setup_config_messages()
+        self.setup_summary_message()
         self.setup_user_messages()
 
     @property
     def full_messages(self) -> list[OpenAIMessage]:
-        return self.config_messages + self.user_messages
+        summary_messages = [self.summary_message] if self.summary_message else []
+        return self.config_messages + summary_messages + list(self.user_messages)
 
     @property
     def config_messages_count(self) -> int:
@@ -45,15 +49,19 @@ class Conversation:
 
     @property
     def config_tokens(self) -> int:
-        return sum([msg.token_count for msg in self.config_messages])
+        return self._config_tokens
 
     @property
     def user_tokens(self) -> int:
-        return sum([msg.token_count for msg in self.user_messages])
+        return self.user_messages.total_tokens
+
+    @property
+    def summary_tokens(self) -> int:
+        return self.summary_message.token_count if self.summary_message else 0
 
     @property
     def total_tokens(self) -> int:
-        return self.config_tokens + self.user_tokens
+        return self.config_tokens + self.summary_tokens + self.user_tokens
 
     @property
     def exists(self) -> bool:
@@ -80,6 +88,7 @@ class Conversation:
     def setup_config_messages(self, logging: bool = True) -> None:
         if self.db.check_config_exists(self.chat_id):
             self.config_messages = self.db.get_conversation_from_db(self.chat_id, category='config')
+            self._config_tokens = sum([msg.token_count for msg in self.config_messages])
             return
         self.config_messages = [
             OpenAIMessage(self.config.SYSTEM_PROMPT.format(name=self.config.NAME),
@@ -89,13 +98,33 @@ class Conversation:
             OpenAIMessage(f'{self.config.I_WILL_CALL_YOU} {self.username.split("_", 1)[0]}',
                           self.config.NAME, self.username, 'assistant', 'config', self.chat_id),
         ]
+        OpenAIMessage.tokenizer.count_messages(self.config_messages, self.config.MODEL)
+        self._config_tokens = sum([msg.token_count for msg in self.config_messages])
         for msg in self.config_messages:
             self.message_log(msg)
         if logging:
             self.system_log(self.conversation_start_log_msg)
 
+    def setup_summary_message(self) -> None:
+        summary_messages = self.db.get_conversation_from_db(self.chat_id, category='summary')
+        self.summary_message = summary_messages[-1] if summary_messages else None
+
     def setup_user_messages(self) -> None:
-        self.user_messages = self.db.get_conversation_from_db(self.chat_id, category='user')
+        self.user_messages = self.db.get_message_store(self.chat_id, category='user')
+
+    def fold_messages(self, count: int, summary: str) -> None:
+        self.summary_message = OpenAIMessage(f"{self.config.SUMMARY_MESSAGE_PREFIX} {summary}",
+                                             self.config.NAME, self.username, 'system', 'summary', self.chat_id)
+        self.user_messages.remove_first(count)
+        self.db.fold_messages(self.chat_id, count, self.summary_message.content, self.summary_message.sender,
+                              self.summary_message.receiver, self.summary_message.token_count,
+                              datetime.datetime.now())
+
+    def recall(self, content: str, limit: int) -> list[tuple[int, OpenAIMessage]]:
+        # earlier messages that were folded into the summary, the most relevant to content first
+        if self.summary_message is None:
+            return []
+        return self.db.search_messages(self.chat_id, content, limit)
 
     def create_openai_response_message(self, response: dict):
         response_content = response["choices"][0]["message"]["content"]
@@ -113,6 +142,10 @@ class Conversation:
 
     def clear_messages(self, logging=True) -> None:
         self.user_messages.clear()
+        self.summary_message = None
         self.db.remove_conversation(self.chat_id)
+        # the config messages were removed with the conversation, write them again
+        # so a cached instance stays in sync with the database
+        self.setup_config_messages(logging=False)
         if logging:
             self.system_log(self.conversation_reset_log_msg)
@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from modules.conversation import Conversation
+from modules.metrics import metrics
+
+
+class ConversationCache:
+    def __init__(self, max_entries: int, max_idle_seconds: float) -> None:
+        self.max_entries: int = max_entries
+        self.max_idle_seconds: float = max_idle_seconds
+        self.hits: int = 0
+        self.misses: int = 0
+        self.evictions: int = 0
+        self._entries: OrderedDict[str, tuple[Conversation, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def size(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    @property
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def get(self, chat_id: str, username: str) -> Conversation:
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._entries.get(chat_id)
+            if entry is not None:
+                self._entries[chat_id] = (entry[0], now)
+                self._entries.move_to_end(chat_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # built outside the lock, loading the history hits the database
+        with metrics.span("conversation_load"):
+            conversation = Conversation(chat_id, username)
+        if self.max_entries > 0:
+            with self._lock:
+                self._entries[chat_id] = (conversation, now)
+                self._entries.move_to_end(chat_id)
+                self._evict_overflow()
+        return conversation
+
+    def invalidate(self, chat_id: str) -> None:
+        with self._lock:
+            self._entries.pop(chat_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _evict_idle(self, now: float) -> None:
+        # entries are kept in LRU order, so the idle ones are at the front
+        while self._entries:
+            chat_id, (_, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.max_idle_seconds:
+                break
+            del self._entries[chat_id]
+            self.evictions += 1
+
+    def _evict_overflow(self) -> None:
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
@@ -1,8 +1,19 @@
+import asyncio
+import atexit
+import importlib.util
+import json
+import re
+import threading
 from datetime import datetime
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, desc
+from sqlalchemy import create_engine, event, insert, update, select, func, case, bindparam, text, Column, Integer, String, \
+    DateTime, Text, Boolean, Index, desc
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError, OperationalError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from modules.message import OpenAIMessage
+from sqlalchemy.orm import sessionmaker, scoped_session
+from modules.message import OpenAIMessage, MessageStore
+from modules.config import Config
+from modules.metrics import metrics
 Base = declarative_base()
 
 
@@ -16,7 +27,8 @@ class SystemLog(Base):
     category: str = Column(String)
     chat_id: str = Column(String, default='')
     token_count: int = Column(Integer, default=0)
-    date_time: datetime = Column(DateTime, default=datetime.now())
+    date_time: datetime = Column(DateTime, default=datetime.now)
+    __table_args__ = (Index('ix_system_log_chat_id_category_id', 'chat_id', 'category', 'id'),)
 
 
 class Message(Base):
@@ -29,77 +41,822 @@ class Message(Base):
     category: str = Column(String)
     chat_id: str = Column(String)
     token_count: int = Column(Integer, default=0)
-    date_time: datetime = Column(DateTime, default=datetime.now())
+    date_time: datetime = Column(DateTime, default=datetime.now)
+    __table_args__ = (Index('ix_messages_chat_id_category_id', 'chat_id', 'category', 'id'),)
+
+
+class ChatSummary(Base):
+    # running totals of the rows in messages per chat, kept in the transaction that changes the rows
+    __tablename__ = 'chats'
+    chat_id: str = Column(String, primary_key=True)
+    message_count: int = Column(Integer, default=0)
+    # tokens of the answers of the bot, prompt_tokens counts all other messages
+    prompt_tokens: int = Column(Integer, default=0)
+    completion_tokens: int = Column(Integer, default=0)
+    has_config: bool = Column(Boolean, default=False)
+    last_activity: datetime = Column(DateTime, default=datetime.now)
+
+
+class UsageRollup(Base):
+    # usage per hour, chat and user, summed up from system_log by roll_up_usage
+    __tablename__ = 'usage_rollup'
+    bucket: datetime = Column(DateTime, primary_key=True)
+    chat_id: str = Column(String, primary_key=True)
+    user: str = Column(String, primary_key=True)
+    messages: int = Column(Integer, default=0)
+    requests: int = Column(Integer, default=0)
+    prompt_tokens: int = Column(Integer, default=0)
+    completion_tokens: int = Column(Integer, default=0)
+    errors: int = Column(Integer, default=0)
+    __table_args__ = (Index('ix_usage_rollup_chat_id', 'chat_id'), Index('ix_usage_rollup_user', 'user'))
+
+
+class RollupWatermark(Base):
+    # the last system_log id that is contained in a rollup
+    __tablename__ = 'rollup_watermarks'
+    name: str = Column(String, primary_key=True)
+    last_id: int = Column(Integer, default=0)
+
+
+USAGE_COUNTERS: tuple[str, ...] = ("messages", "requests", "prompt_tokens", "completion_tokens", "errors")
+
+
+class CachedCompletion(Base):
+    __tablename__ = 'completion_cache'
+    key: str = Column(String, primary_key=True)
+    response: str = Column(Text)
+    size: int = Column(Integer, default=0)
+    hits: int = Column(Integer, default=0)
+    created: datetime = Column(DateTime, default=datetime.now)
+    last_used: datetime = Column(DateTime, default=datetime.now, index=True)
+
+
+class StoredPicture(Base):
+    __tablename__ = 'pictures'
+    id: int = Column(Integer, primary_key=True)
+    prompt_key: str = Column(String, index=True)
+    prompt: str = Column(Text)
+    content_hash: str = Column(String, index=True)
+    size: int = Column(Integer, default=0)
+    telegram_file_id: str = Column(String)
+    created: datetime = Column(DateTime, default=datetime.now, index=True)
+    last_used: datetime = Column(DateTime, default=datetime.now)
+
+
+SQLITE_PRAGMAS: dict[str, str or int] = {
+    # only takes effect for a new database, see Database.vacuum
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "busy_timeout": 5000,
+    "cache_size": -16000,
+}
+
+
+def update_chat_summaries(executor, rows: list[dict], sign: int = 1) -> None:
+    # adds (sign 1) or subtracts (sign -1) message rows to the totals of their chats, executor is the
+    # connection or session of the transaction that inserts or deletes the rows
+    totals: dict[str, dict] = {}
+    for row in rows:
+        chat = totals.setdefault(row["chat_id"], {"message_count": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                                                  "has_config": False, "last_activity": None})
+        chat["message_count"] += sign
+        tokens = "completion_tokens" if row["role"] == 'assistant' else "prompt_tokens"
+        chat[tokens] += sign * (row.get("token_count") or 0)
+        chat["has_config"] = chat["has_config"] or row["category"] == 'config'
+        date_time = row.get("date_time")
+        if sign > 0 and date_time and (chat["last_activity"] is None or date_time > chat["last_activity"]):
+            chat["last_activity"] = date_time
+    for chat_id, chat in totals.items():
+        values = {
+            "message_count": ChatSummary.message_count + chat["message_count"],
+            "prompt_tokens": ChatSummary.prompt_tokens + chat["prompt_tokens"],
+            "completion_tokens": ChatSummary.completion_tokens + chat["completion_tokens"],
+        }
+        # deleting single messages never removes the config, only a reset does
+        if sign > 0 and chat["has_config"]:
+            values["has_config"] = True
+        if chat["last_activity"] is not None:
+            values["last_activity"] = chat["last_activity"]
+        if executor.execute(update(ChatSummary).where(ChatSummary.chat_id == chat_id).values(values)).rowcount == 0:
+            executor.execute(insert(ChatSummary).values(chat_id=chat_id, message_count=max(0, chat["message_count"]),
+                                                        prompt_tokens=max(0, chat["prompt_tokens"]),
+                                                        completion_tokens=max(0, chat["completion_tokens"]),
+                                                        has_config=chat["has_config"],
+                                                        last_activity=chat["last_activity"] or datetime.now()))
+
+
+def sum_usage(rows) -> dict[tuple, dict[str, int]]:
+    # rows are (id, date_time, category, role, from_user, to_user, chat_id, message) of system_log,
+    # the message is only needed for 'usage' rows
+    totals: dict[tuple, dict[str, int]] = {}
+    for _, date_time, category, role, from_user, to_user, chat_id, usage in rows:
+        if category == 'user' and role == 'user':
+            counters, user = {"messages": 1}, from_user
+        elif category == 'usage':
+            usage = json.loads(usage)
+            counters, user = {"requests": 1, "prompt_tokens": usage["prompt_tokens"],
+                              "completion_tokens": usage["completion_tokens"]}, from_user
+        elif category == 'error':
+            counters, user = {"errors": 1}, to_user
+        else:
+            continue
+        bucket = (date_time or datetime.now()).replace(minute=0, second=0, microsecond=0)
+        total = totals.setdefault((bucket, chat_id or '', user or ''), dict.fromkeys(USAGE_COUNTERS, 0))
+        for counter, value in counters.items():
+            total[counter] += value
+    return totals
+
+
+def add_usage(connection, totals: dict[tuple, dict[str, int]]) -> None:
+    if not totals:
+        return
+    # the rows are read in the order they were written, only the latest buckets can exist already
+    existing = {tuple(key) for key in connection.execute(
+        select(UsageRollup.bucket, UsageRollup.chat_id, UsageRollup.user)
+        .where(UsageRollup.bucket >= min([bucket for bucket, _, _ in totals])))}
+    updates = [dict(zip(("key_bucket", "key_chat_id", "key_user"), key), **total)
+               for key, total in totals.items() if key in existing]
+    inserts = [dict(zip(("bucket", "chat_id", "user"), key), **total)
+               for key, total in totals.items() if key not in existing]
+    if updates:
+        connection.execute(update(UsageRollup)
+                           .where(UsageRollup.bucket == bindparam("key_bucket"),
+                                  UsageRollup.chat_id == bindparam("key_chat_id"),
+                                  UsageRollup.user == bindparam("key_user"))
+                           .values({counter: getattr(UsageRollup, counter) + bindparam(counter)
+                                    for counter in USAGE_COUNTERS}), updates)
+    if inserts:
+        connection.execute(insert(UsageRollup), inserts)
+
+
+def message_row(message) -> dict:
+    return {"chat_id": message.chat_id, "role": message.role, "category": message.category,
+            "token_count": message.token_count}
+
+
+# full text index of the user and summarized messages for Database.search_messages: contentless, the text
+# is only stored in messages; the chat is an indexed token, so a search only reads the postings of one chat
+SEARCH_INDEX_SCHEMA: list[str] = [
+    "CREATE VIRTUAL TABLE messages_fts USING fts5(message, chat, content='')",
+    """CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages
+       WHEN new.category IN ('user', 'summarized') BEGIN
+         INSERT INTO messages_fts(rowid, message, chat) VALUES (new.id, new.message, 'c' || hex(new.chat_id));
+       END""",
+    """CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages
+       WHEN old.category IN ('user', 'summarized') BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, message, chat)
+         VALUES ('delete', old.id, old.message, 'c' || hex(old.chat_id));
+       END""",
+    # folding only changes the category from user to summarized, both are indexed already
+    """CREATE TRIGGER messages_fts_update AFTER UPDATE OF message, category, chat_id ON messages
+       WHEN old.message IS NOT new.message OR old.chat_id IS NOT new.chat_id
+         OR (old.category IN ('user', 'summarized')) <> (new.category IN ('user', 'summarized')) BEGIN
+         INSERT INTO messages_fts(messages_fts, rowid, message, chat)
+         SELECT 'delete', old.id, old.message, 'c' || hex(old.chat_id) WHERE old.category IN ('user', 'summarized');
+         INSERT INTO messages_fts(rowid, message, chat)
+         SELECT new.id, new.message, 'c' || hex(new.chat_id) WHERE new.category IN ('user', 'summarized');
+       END""",
+    """INSERT INTO messages_fts(rowid, message, chat)
+       SELECT id, message, 'c' || hex(chat_id) FROM messages WHERE category IN ('user', 'summarized')""",
+]
+SEARCH_TERM = re.compile(r"\w{2,}")
+SEARCH_MAX_TERMS: int = 32
+
+
+def search_query(chat_id: str, content: str) -> str or None:
+    # the words of content, any of them matches, within the chat; None if there is no word to search for
+    terms = list(dict.fromkeys(SEARCH_TERM.findall(content.lower())))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    words = " OR ".join([f'"{term}"' for term in terms])
+    return f"chat : c{chat_id.encode().hex().upper()} AND message : ({words})"
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for pragma, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {pragma}={value}")
+    cursor.close()
+
+
+class WriteBehindQueue:
+    # a batch that fails this often is written row by row, the rows that still fail are dropped
+    MAX_FLUSH_ATTEMPTS: int = 3
+
+    def __init__(self, engine: Engine, batch_size: int, flush_interval: float) -> None:
+        self.engine: Engine = engine
+        self.batch_size: int = batch_size
+        self.flush_interval: float = flush_interval
+        self._rows: list[tuple[type, dict]] = []
+        self._rows_lock = threading.Lock()
+        # held for the whole flush, a reader that flushes first waits for rows another thread is writing
+        self._flush_lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._failed_flushes: int = 0
+        self._thread: threading.Thread or None = None
+        if self.batch_size > 1 and self.flush_interval > 0:
+            self._thread = threading.Thread(target=self._flush_periodically, name='db-write-behind', daemon=True)
+            self._thread.start()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def put(self, model: type, row: dict) -> None:
+        with self._rows_lock:
+            self._rows.append((model, row))
+            pending = len(self._rows)
+        if pending >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._flush_lock:
+            with self._rows_lock:
+                rows, self._rows = self._rows, []
+            if not rows:
+                return
+            try:
+                with metrics.span("db_write"), self.engine.begin() as connection:
+                    self._write(connection, rows)
+            except Exception:
+                self._failed_flushes += 1
+                if self._failed_flushes < self.MAX_FLUSH_ATTEMPTS:
+                    with self._rows_lock:
+                        self._rows = rows + self._rows
+                    raise
+                self._write_row_by_row(rows)
+            self._failed_flushes = 0
+
+    def _write(self, connection, rows: list[tuple[type, dict]]) -> None:
+        for model, model_rows in self._group_by_model(rows):
+            connection.execute(insert(model), model_rows)
+            if model is Message:
+                update_chat_summaries(connection, model_rows)
+
+    def _write_row_by_row(self, rows: list[tuple[type, dict]]) -> None:
+        # one bad row would otherwise fail every later flush, and every read that flushes first
+        for model, row in rows:
+            try:
+                with metrics.span("db_write"), self.engine.begin() as connection:
+                    self._write(connection, [(model, row)])
+            except Exception as e:
+                metrics.inc("db_dropped_rows_total", table=model.__tablename__)
+                print(f"{Config().ERROR_LOG_MSG} {e} {model.__tablename__} row dropped: {row}")
+
+    def close(self) -> None:
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.flush()
+
+    def _flush_periodically(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"{Config().ERROR_LOG_MSG} {e}")
+
+    @staticmethod
+    def _group_by_model(rows: list[tuple[type, dict]]) -> list[tuple[type, list[dict]]]:
+        groups: list[tuple[type, list[dict]]] = []
+        for model, row in rows:
+            if groups and groups[-1][0] is model:
+                groups[-1][1].append(row)
+            else:
+                groups.append((model, [row]))
+        return groups
+
+
+class SharedEngine:
+    def __init__(self, db_uri: str, config: Config) -> None:
+        self.db_uri: str = db_uri
+        self.config: Config = config
+        self.engine: Engine = create_engine(db_uri, **self._pool_options())
+        if self.engine.dialect.name == 'sqlite':
+            event.listen(self.engine, "connect", set_sqlite_pragmas)
+        Base.metadata.create_all(self.engine)
+        self.migrate()
+        self.backfill_chat_summaries()
+        self.search_index: bool = self.create_search_index()
+        # one session per worker thread, handlers for different chats run concurrently
+        self.session: scoped_session = scoped_session(sessionmaker(bind=self.engine))
+        batch_size = config.DB_WRITE_BATCH_SIZE if config.DB_WRITE_BEHIND else 1
+        self.write_queue: WriteBehindQueue = WriteBehindQueue(self.engine, batch_size, config.DB_WRITE_FLUSH_INTERVAL)
+        self._async_engine = None
+        self._async_session = None
+
+    @property
+    def async_session(self):
+        # created on first use, the aiosqlite driver is optional
+        if self._async_session is None:
+            from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session
+            self._async_engine = create_async_engine(self.db_uri.replace('sqlite://', 'sqlite+aiosqlite://', 1))
+            if self._async_engine.dialect.name == 'sqlite':
+                event.listen(self._async_engine.sync_engine, "connect", set_sqlite_pragmas)
+            self._async_session = async_scoped_session(async_sessionmaker(self._async_engine,
+                                                                          expire_on_commit=False),
+                                                       scopefunc=asyncio.current_task)
+        return self._async_session
+
+    def migrate(self) -> None:
+        # create_all only creates indexes together with new tables, databases created
+        # by older versions get them here
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(self.engine, checkfirst=True)
+
+    def create_search_index(self) -> bool:
+        # returns whether the index exists, the sqlite library may be built without FTS5
+        if self.engine.dialect.name != 'sqlite':
+            return False
+        exists = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+        with self.engine.begin() as connection:
+            if connection.exec_driver_sql(exists).first() is not None:
+                return True
+            try:
+                # created and filled with the existing messages in one transaction
+                for statement in SEARCH_INDEX_SCHEMA:
+                    connection.exec_driver_sql(statement)
+                return True
+            except OperationalError:
+                connection.rollback()
+        # without FTS5, or another process created the index at the same time
+        with self.engine.connect() as connection:
+            return connection.exec_driver_sql(exists).first() is not None
+
+    def backfill_chat_summaries(self) -> None:
+        # databases of older versions have messages but no totals yet, they are summed up once
+        with self.engine.begin() as connection:
+            if connection.execute(select(ChatSummary.chat_id).limit(1)).first() is not None:
+                return
+            if connection.execute(select(Message.id).limit(1)).first() is None:
+                return
+            totals = select(Message.chat_id, func.count(Message.id),
+                            func.coalesce(func.sum(case((Message.role != 'assistant', Message.token_count),
+                                                        else_=0)), 0),
+                            func.coalesce(func.sum(case((Message.role == 'assistant', Message.token_count),
+                                                        else_=0)), 0),
+                            func.max(case((Message.category == 'config', 1), else_=0)),
+                            func.max(Message.date_time)).group_by(Message.chat_id)
+            try:
+                connection.execute(insert(ChatSummary).from_select(
+                    ["chat_id", "message_count", "prompt_tokens", "completion_tokens", "has_config",
+                     "last_activity"], totals))
+            except IntegrityError:
+                # another process started at the same time and filled the table
+                connection.rollback()
+
+    def close(self) -> None:
+        self.write_queue.close()
+        self.session.remove()
+        self.engine.dispose()
+
+    def _pool_options(self) -> dict:
+        if self.db_uri in ('sqlite://', 'sqlite:///:memory:'):
+            return {}
+        return {
+            "pool_size": self.config.DB_POOL_SIZE,
+            "max_overflow": self.config.DB_MAX_OVERFLOW,
+            "pool_timeout": self.config.DB_POOL_TIMEOUT,
+            "pool_pre_ping": True,
+        }
+
+
+# one engine, session registry and write queue per database for the whole process
+_shared_engines: dict[str, SharedEngine] = {}
+_shared_engines_lock = threading.Lock()
+
+
+def get_shared_engine(db_uri: str) -> SharedEngine:
+    with _shared_engines_lock:
+        if db_uri not in _shared_engines:
+            shared_engine = SharedEngine(db_uri, Config())
+            atexit.register(shared_engine.close)
+            _shared_engines[db_uri] = shared_engine
+        return _shared_engines[db_uri]
+
+
+def async_driver_available() -> bool:
+    return importlib.util.find_spec("aiosqlite") is not None
 
 
 class Database:
     def __init__(self, db_uri: str):
-        self.engine = create_engine(db_uri)
-        Base.metadata.create_all(self.engine)
-        session = sessionmaker(bind=self.engine)
-        self.session = session()
-        self.session.commit()
+        self.config: Config = Config()
+        self.db_uri: str = db_uri
+        self._shared_engine: SharedEngine or None = None
+
+    @property
+    def shared_engine(self) -> SharedEngine:
+        # the engine is created on the first query, importing a module with a Database costs nothing
+        if self._shared_engine is None:
+            self._shared_engine = get_shared_engine(self.db_uri)
+        return self._shared_engine
+
+    @property
+    def engine(self) -> Engine:
+        return self.shared_engine.engine
+
+    @property
+    def session(self) -> scoped_session:
+        return self.shared_engine.session
+
+    @property
+    def write_queue(self) -> WriteBehindQueue:
+        return self.shared_engine.write_queue
+
+    def flush(self) -> None:
+        self.write_queue.flush()
+
+    def close(self) -> None:
+        self.shared_engine.close()
 
     def add_message_to_system_log(self, message, from_user, to_user, role, category, chat_id, token_count, date_time):
-        system_log = SystemLog(message=message, from_user=from_user, to_user=to_user,
-                               role=role, category=category, chat_id=chat_id,
-                               token_count=token_count, date_time=date_time)
-        self.session.add(system_log)
-        self.session.commit()
+        self.write_queue.put(SystemLog, dict(message=message, from_user=from_user, to_user=to_user,
+                                             role=role, category=category, chat_id=chat_id,
+                                             token_count=token_count, date_time=date_time))
+
+    def add_messages_to_system_log(self, rows: list[dict]) -> None:
+        # many log rows in one transaction, also when the write-behind queue is off
+        with metrics.span("db_write"), self.engine.begin() as connection:
+            connection.execute(insert(SystemLog), rows)
 
     def add_message_to_messages(self, message, from_user, to_user, role, category, chat_id, token_count, date_time):
-        message_obj = Message(message=message, from_user=from_user, to_user=to_user,
-                              role=role, category=category, chat_id=chat_id,
-                              token_count=token_count, date_time=date_time)
-        self.session.add(message_obj)
-        self.session.commit()
+        self.write_queue.put(Message, dict(message=message, from_user=from_user, to_user=to_user,
+                                           role=role, category=category, chat_id=chat_id,
+                                           token_count=token_count, date_time=date_time))
 
     def get_system_log_from_db(self, chat_id: str):
-        return self.session.query(SystemLog).filter_by(chat_id=chat_id).all()
+        self.flush()
+        with metrics.span("db_read"):
+            return self.session.query(SystemLog).filter_by(chat_id=chat_id).all()
 
     def get_messages_from_db(self, chat_id: str, category: str) -> list:
-        return self.session.query(Message).filter_by(chat_id=chat_id, category=category).all()
+        self.flush()
+        with metrics.span("db_read"):
+            return self.session.query(Message).filter_by(chat_id=chat_id, category=category).all()
 
     def get_conversation_from_db(self, chat_id: str, category: str) -> list[OpenAIMessage]:
-        db_messages = self.get_messages_from_db(chat_id, category)
-        messages = []
-        for db_message in db_messages:
-            message_obj = OpenAIMessage(db_message.message, db_message.from_user, db_message.to_user,
-                                        db_message.role, db_message.category, db_message.chat_id,
-                                        db_message.token_count)
-            messages.append(message_obj)
-        return messages
+        return list(self.get_message_store(chat_id, category))
+
+    def get_message_store(self, chat_id: str, category: str) -> MessageStore:
+        # plain rows into the columns of the store, without ORM objects in between
+        self.flush()
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            rows = connection.execute(select(Message.message, Message.from_user, Message.to_user, Message.role,
+                                             Message.token_count)
+                                      .where(Message.chat_id == chat_id, Message.category == category)
+                                      .order_by(Message.id)).all()
+        store = MessageStore(chat_id, category)
+        for content, sender, receiver, role, token_count in rows:
+            # rows of old versions may have no token count yet
+            store.add(content, sender, receiver, role,
+                      token_count or OpenAIMessage.tokenizer.count_message(role, content, sender, self.config.MODEL))
+        return store
+
+    def search_messages(self, chat_id: str, content: str, limit: int,
+                        category: str = 'summarized') -> list[tuple[int, OpenAIMessage]]:
+        # (id, message) of the messages of the chat that are most relevant to content by BM25, best first;
+        # folded messages are only written by fold_messages, which flushes, so there is nothing to flush here
+        query = search_query(chat_id, content)
+        if query is None or limit <= 0 or not self.shared_engine.search_index:
+            return []
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            rows = connection.execute(text(
+                "SELECT m.id, m.message, m.from_user, m.to_user, m.role, m.token_count "
+                "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH :query AND m.category = :category "
+                "ORDER BY bm25(messages_fts, 1.0, 0.0) LIMIT :limit"),
+                {"query": query, "category": category, "limit": limit}).all()
+        return [(message_id, OpenAIMessage(content, sender, receiver, role, category, chat_id, token_count))
+                for message_id, content, sender, receiver, role, token_count in rows]
 
     def get_last_messages_from_db(self, chat_id: str, limit: int = 1) -> list:
-        return self.session.query(Message).filter_by(chat_id=chat_id).order_by(desc(Message.id)).limit(limit).all()
+        self.flush()
+        with metrics.span("db_read"):
+            return self.session.query(Message).filter_by(chat_id=chat_id).order_by(desc(Message.id)).limit(limit).all()
+
+    def get_chat_summary(self, chat_id: str) -> ChatSummary or None:
+        self.flush()
+        with metrics.span("db_read"):
+            return self.session.query(ChatSummary).filter_by(chat_id=chat_id).populate_existing().first()
 
     def check_config_exists(self, chat_id: str) -> bool:
-        return self.session.query(Message).filter_by(chat_id=chat_id, category='config').first() is not None
+        self.flush()
+        with metrics.span("db_read"):
+            return bool(self.session.query(ChatSummary.has_config).filter_by(chat_id=chat_id).scalar())
 
     def check_conversation_exists(self, chat_id: str) -> bool:
-        return self.session.query(Message).filter_by(chat_id=chat_id).first() is not None
+        self.flush()
+        with metrics.span("db_read"):
+            return (self.session.query(ChatSummary.message_count).filter_by(chat_id=chat_id).scalar() or 0) > 0
 
-    def remove_conversation(self, chat_id: str) -> list:
+    def remove_conversation(self, chat_id: str) -> int:
+        # returns the number of removed messages
         if self.check_conversation_exists(chat_id) is False:
-            return []
-        conversation: list = self.get_messages_from_db(chat_id, 'user')
-        self.session.query(Message).filter_by(chat_id=chat_id).delete()
-        self.session.commit()
-        return conversation
-
-    def remove_last_message(self, chat_id: str) -> None:
-        last_message = self.get_last_messages_from_db(chat_id)
-        if last_message:
-            self.session.query(Message).filter_by(id=last_message[0].id).delete()
+            return 0
+        with metrics.span("db_write"):
+            removed = self.session.query(Message).filter_by(chat_id=chat_id).delete(synchronize_session=False)
+            self.session.query(ChatSummary).filter_by(chat_id=chat_id) \
+                .update({ChatSummary.message_count: 0, ChatSummary.prompt_tokens: 0,
+                         ChatSummary.completion_tokens: 0, ChatSummary.has_config: False,
+                         ChatSummary.last_activity: datetime.now()}, synchronize_session=False)
+            self.session.commit()
+        return removed
+
+    def remove_last_message(self, chat_id: str, category: str = 'user') -> None:
+        self.flush()
+        with metrics.span("db_write"):
+            last_message = self.session.query(Message).filter_by(chat_id=chat_id, category=category) \
+                .order_by(desc(Message.id)).limit(1).all()
+            if last_message:
+                removed_row = message_row(last_message[0])
+                self.session.query(Message).filter_by(id=last_message[0].id).delete()
+                update_chat_summaries(self.session, [removed_row], sign=-1)
+                self.session.commit()
+                return last_message[0]
+
+    def fold_messages(self, chat_id: str, count: int, summary: str, from_user: str, to_user: str,
+                      token_count: int, date_time: datetime) -> None:
+        self.flush()
+        # replaces the oldest user messages by a summary in one transaction, the folded rows
+        # are kept with the category 'summarized' so the history is not lost
+        with metrics.span("db_write"):
+            folded_ids = [row.id for row in self.session.query(Message.id)
+                          .filter_by(chat_id=chat_id, category='user').order_by(Message.id).limit(count)]
+            self.session.query(Message).filter(Message.id.in_(folded_ids)) \
+                .update({Message.category: 'summarized'}, synchronize_session=False)
+            # the folded rows stay in the table, only the replaced summary changes the totals
+            old_summaries = [dict(chat_id=chat_id, role=role, category='summary', token_count=count)
+                             for role, count in self.session.query(Message.role, Message.token_count)
+                             .filter_by(chat_id=chat_id, category='summary')]
+            self.session.query(Message).filter_by(chat_id=chat_id, category='summary').delete()
+            self.session.add(Message(message=summary, from_user=from_user, to_user=to_user,
+                                     role='system', category='summary', chat_id=chat_id,
+                                     token_count=token_count, date_time=date_time))
+            update_chat_summaries(self.session, old_summaries, sign=-1)
+            update_chat_summaries(self.session, [dict(chat_id=chat_id, role='system', category='summary',
+                                                      token_count=token_count, date_time=date_time)])
+            self.session.commit()
+
+    def get_cached_completion(self, key: str, created_after: datetime) -> str or None:
+        with metrics.span("db_read"):
+            entry = self.session.get(CachedCompletion, key)
+        if entry is None:
+            return None
+        with metrics.span("db_write"):
+            if entry.created < created_after:
+                self.session.delete(entry)
+                self.session.commit()
+                return None
+            entry.hits += 1
+            entry.last_used = datetime.now()
+            response = entry.response
+            self.session.commit()
+        return response
+
+    def add_cached_completion(self, key: str, response: str) -> None:
+        with metrics.span("db_write"):
+            self.session.merge(CachedCompletion(key=key, response=response, size=len(response),
+                                                created=datetime.now(), last_used=datetime.now()))
             self.session.commit()
-            return last_message[0]
+
+    def evict_cached_completions(self, created_before: datetime, max_entries: int, max_bytes: int) -> None:
+        # expired entries first, then the least recently used ones until both limits are kept
+        with metrics.span("db_write"):
+            self.session.query(CachedCompletion).filter(CachedCompletion.created < created_before).delete()
+            count, size = self.session.query(func.count(CachedCompletion.key),
+                                             func.coalesce(func.sum(CachedCompletion.size), 0)).one()
+            evict_keys: list[str] = []
+            if count > max_entries or size > max_bytes:
+                for key, entry_size in self.session.query(CachedCompletion.key, CachedCompletion.size) \
+                        .order_by(CachedCompletion.last_used).yield_per(500):
+                    if count <= max_entries and size <= max_bytes:
+                        break
+                    evict_keys.append(key)
+                    count -= 1
+                    size -= entry_size
+            for i in range(0, len(evict_keys), 500):
+                self.session.query(CachedCompletion).filter(CachedCompletion.key.in_(evict_keys[i:i + 500])) \
+                    .delete(synchronize_session=False)
+            self.session.commit()
+
+    def add_pictures(self, prompt_key: str, prompt: str, pictures: list[tuple[str, int]]) -> None:
+        with metrics.span("db_write"):
+            self.session.add_all([StoredPicture(prompt_key=prompt_key, prompt=prompt, content_hash=content_hash,
+                                                size=size) for content_hash, size in pictures])
+            self.session.commit()
+
+    def get_pictures(self, prompt_key: str, limit: int) -> list:
+        with metrics.span("db_read"):
+            pictures = self.session.query(StoredPicture).filter_by(prompt_key=prompt_key) \
+                .order_by(desc(StoredPicture.id)).limit(limit).all()
+        if pictures:
+            with metrics.span("db_write"):
+                for picture in pictures:
+                    picture.last_used = datetime.now()
+                self.session.commit()
+        return pictures
+
+    def set_picture_file_id(self, content_hash: str, telegram_file_id: str) -> None:
+        with metrics.span("db_write"):
+            self.session.query(StoredPicture).filter_by(content_hash=content_hash) \
+                .update({StoredPicture.telegram_file_id: telegram_file_id})
+            self.session.commit()
+
+    def expire_pictures(self, created_before: datetime, max_bytes: int) -> list[str]:
+        # removes pictures older than the retention and, while the stored files take more than max_bytes,
+        # the least recently used ones; returns the content hashes that are not used by any picture anymore
+        with metrics.span("db_write"):
+            expired = StoredPicture.created < created_before
+            removed: set[str] = {content_hash for content_hash, in
+                                 self.session.query(StoredPicture.content_hash).filter(expired).distinct()}
+            self.session.query(StoredPicture).filter(expired).delete(synchronize_session=False)
+            # a file is counted once, however many prompts it was generated for
+            files = self.session.query(StoredPicture.content_hash, func.max(StoredPicture.size).label('size'),
+                                       func.max(StoredPicture.last_used).label('last_used')) \
+                .group_by(StoredPicture.content_hash).subquery()
+            stored_bytes: int = self.session.query(func.coalesce(func.sum(files.c.size), 0)).scalar()
+            evicted: list[str] = []
+            if stored_bytes > max_bytes:
+                for content_hash, size in self.session.query(files.c.content_hash, files.c.size) \
+                        .order_by(files.c.last_used).yield_per(500):
+                    if stored_bytes <= max_bytes:
+                        break
+                    evicted.append(content_hash)
+                    stored_bytes -= size
+            for i in range(0, len(evicted), 500):
+                self.session.query(StoredPicture).filter(StoredPicture.content_hash.in_(evicted[i:i + 500])) \
+                    .delete(synchronize_session=False)
+            removed.update(evicted)
+            candidates = sorted(removed)
+            for i in range(0, len(candidates), 500):
+                removed.difference_update([content_hash for content_hash, in
+                                           self.session.query(StoredPicture.content_hash).distinct()
+                                           .filter(StoredPicture.content_hash.in_(candidates[i:i + 500]))])
+            self.session.commit()
+        return sorted(removed)
+
+    def roll_up_usage(self, chunk_size: int = 10000) -> int:
+        # adds the system_log rows after the watermark to the hourly rollup, one transaction per chunk
+        # with the watermark, so an interrupted run continues where it stopped; returns the rows read
+        self.flush()
+        read = 0
+        while True:
+            with metrics.span("db_write"), self.engine.begin() as connection:
+                last_id = connection.execute(select(RollupWatermark.last_id)
+                                             .where(RollupWatermark.name == 'usage')).scalar()
+                rows = connection.execute(
+                    select(SystemLog.id, SystemLog.date_time, SystemLog.category, SystemLog.role,
+                           SystemLog.from_user, SystemLog.to_user, SystemLog.chat_id,
+                           case((SystemLog.category == 'usage', SystemLog.message), else_=None))
+                    .where(SystemLog.id > (last_id or 0)).order_by(SystemLog.id).limit(chunk_size)).all()
+                if not rows:
+                    return read
+                add_usage(connection, sum_usage(rows))
+                # a second report running at the same time moved the watermark first, its rows are not added twice
+                if last_id is None:
+                    connection.execute(insert(RollupWatermark).values(name='usage', last_id=rows[-1][0]))
+                elif connection.execute(update(RollupWatermark).where(RollupWatermark.name == 'usage',
+                                                                      RollupWatermark.last_id == last_id)
+                                        .values(last_id=rows[-1][0])).rowcount == 0:
+                    connection.rollback()
+                    continue
+                read += len(rows)
+
+    def roll_up_archived_usage(self, rows) -> None:
+        # rows of archived system_log segments, see roll_up_usage; used when the rollup is built again
+        with metrics.span("db_write"), self.engine.begin() as connection:
+            add_usage(connection, sum_usage(rows))
+
+    def reset_usage_rollup(self) -> None:
+        with metrics.span("db_write"), self.engine.begin() as connection:
+            connection.execute(UsageRollup.__table__.delete())
+            connection.execute(RollupWatermark.__table__.delete().where(RollupWatermark.name == 'usage'))
+
+    def archive_rows(self, model: type, condition, write_rows, chunk_size: int) -> int:
+        # moves up to chunk_size rows of system_log or messages that match condition out of the database:
+        # write_rows gets them before they are deleted, in one short transaction; returns the number of rows.
+        # The newest row always stays: sqlite numbers a new row after the largest id, without it the ids of
+        # archived rows would be used again and the rollup watermark would skip the new rows
+        self.flush()
+        table = model.__table__
+        newest = select(func.max(table.c.id)).scalar_subquery()
+        with metrics.span("db_write"), self.engine.begin() as connection:
+            rows = [row._asdict() for row in connection.execute(
+                select(table).where(condition, table.c.id < newest).order_by(table.c.id).limit(chunk_size))]
+            if not rows:
+                return 0
+            write_rows(rows)
+            connection.execute(table.delete().where(table.c.id.in_([row["id"] for row in rows])))
+            if model is Message:
+                update_chat_summaries(connection, rows, sign=-1)
+        return len(rows)
+
+    def has_any_row(self, model: type, ids: list[int]) -> bool:
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            return connection.execute(select(model.id).where(model.id.in_(ids)).limit(1)).first() is not None
+
+    def row_limit_cutoffs(self, model: type, max_rows: int) -> list[tuple[str, int]]:
+        # (chat_id, id) of every chat with more than max_rows rows: the rows up to id are the oldest ones
+        self.flush()
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            chats = connection.execute(select(model.chat_id).group_by(model.chat_id)
+                                       .having(func.count(model.id) > max_rows)).scalars().all()
+            return [(chat_id, connection.execute(select(model.id).where(model.chat_id == chat_id)
+                                                 .order_by(desc(model.id)).offset(max_rows).limit(1)).scalar())
+                    for chat_id in chats]
+
+    def get_rollup_watermark(self) -> int:
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            return connection.execute(select(RollupWatermark.last_id)
+                                      .where(RollupWatermark.name == 'usage')).scalar() or 0
+
+    def database_size(self) -> int:
+        # bytes in use, free pages are not counted because they are reused or vacuumed
+        if self.engine.dialect.name != 'sqlite':
+            return 0
+        with self.engine.connect() as connection:
+            pages = connection.exec_driver_sql("PRAGMA page_count").scalar() - \
+                connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            return pages * connection.exec_driver_sql("PRAGMA page_size").scalar()
+
+    def vacuum(self, full: bool = False, pages_per_step: int = 1000) -> None:
+        # incremental_vacuum gives free pages back in short steps, so writers are only held up briefly;
+        # a database created with auto_vacuum NONE needs one full VACUUM to switch to incremental
+        if self.engine.dialect.name != 'sqlite':
+            return
+        with metrics.span("db_write"), self.engine.connect().execution_options(isolation_level="AUTOCOMMIT") \
+                as connection:
+            if connection.exec_driver_sql("PRAGMA auto_vacuum").scalar() != 2:
+                if full:
+                    connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                    connection.exec_driver_sql("VACUUM")
+                return
+            free_pages = connection.exec_driver_sql("PRAGMA freelist_count").scalar()
+            while free_pages > 0:
+                # executescript runs the pragma to the end, a plain execute frees a single page
+                connection.connection.driver_connection.executescript(f"PRAGMA incremental_vacuum({pages_per_step});")
+                free_pages, previous = connection.exec_driver_sql("PRAGMA freelist_count").scalar(), free_pages
+                if free_pages >= previous:
+                    break
+
+    def get_usage(self, group_by: str, since: datetime or None = None, until: datetime or None = None) -> list[dict]:
+        # group_by is 'user', 'chat_id' or 'bucket', the rollup is small compared to system_log
+        column = getattr(UsageRollup, group_by)
+        query = select(column, *[func.sum(getattr(UsageRollup, counter)) for counter in USAGE_COUNTERS]) \
+            .group_by(column).order_by(column)
+        if since is not None:
+            query = query.where(UsageRollup.bucket >= since)
+        if until is not None:
+            query = query.where(UsageRollup.bucket < until)
+        with metrics.span("db_read"), self.engine.connect() as connection:
+            return [dict(zip((group_by,) + USAGE_COUNTERS, row)) for row in connection.execute(query)]
 
     def get_current_token_count(self, chat_id: str) -> int:
         last_2_messages = self.get_last_messages_from_db(chat_id, 2)
         return sum([msg.token_count for msg in last_2_messages])
 
     def update_message(self, message_id: int, new_message: str):
+        self.flush()
         message_obj = self.session.query(Message).filter_by(id=message_id).first()
         if message_obj:
             message_obj.message = new_message
             self.session.commit()
+
+
+class AsyncDatabase:
+    # log access for the event loop, uses aiosqlite when it is installed and
+    # the synchronous Database in a worker thread otherwise
+    def __init__(self, db_uri: str):
+        self.db: Database = Database(db_uri)
+        self.use_async_driver: bool = async_driver_available()
+
+    async def add_message_to_system_log(self, message, from_user, to_user, role, category, chat_id,
+                                        token_count, date_time):
+        if not self.use_async_driver:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.db.add_message_to_system_log, message, from_user, to_user,
+                                       role, category, chat_id, token_count, date_time)
+            return
+        session = self.db.shared_engine.async_session
+        try:
+            session.add(SystemLog(message=message, from_user=from_user, to_user=to_user,
+                                  role=role, category=category, chat_id=chat_id,
+                                  token_count=token_count, date_time=date_time))
+            await session.commit()
+        finally:
+            await session.remove()
+
+    async def get_system_log_from_db(self, chat_id: str) -> list:
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.db.flush)
+        if not self.use_async_driver:
+            return await loop.run_in_executor(None, self.db.get_system_log_from_db, chat_id)
+        session = self.db.shared_engine.async_session
+        try:
+            result = await session.execute(select(SystemLog).filter_by(chat_id=chat_id))
+            return list(result.scalars())
+        finally:
+            await session.remove()
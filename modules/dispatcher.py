@@ -0,0 +1,95 @@
+import asyncio
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+from modules.scheduler import RequestScheduler, PRIORITIES, PRIORITY_DM
+
+# work that is not an OpenAI request, e.g. a reset, is never rejected and goes first
+PRIORITY_COMMAND: int = -1
+
+
+class ChatDispatcher:
+    def __init__(self, max_concurrency: int, scheduler: RequestScheduler or None = None) -> None:
+        self.max_concurrency: int = max(1, max_concurrency)
+        self.scheduler: RequestScheduler or None = scheduler
+        self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='chat-worker')
+        self.busy: int = 0
+        # (priority, arrival, future) of the chats that wait for a worker
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._arrivals = itertools.count()
+        self._chat_locks: dict[str, asyncio.Lock] = {}
+        self._chat_users: dict[str, int] = {}
+
+    @property
+    def active_chats(self) -> int:
+        return len(self._chat_locks)
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    async def run(self, chat_id: str, func: Callable, *args, priority: str or None = None) -> Any:
+        # the chat lock is taken before the worker, so a chat that waits for its
+        # own previous message does not block a worker other chats could use
+        lock = self._get_chat_lock(chat_id)
+        try:
+            async with lock:
+                await self._acquire_worker(priority)
+                try:
+                    loop = asyncio.get_running_loop()
+                    return await loop.run_in_executor(self.executor, func, *args)
+                finally:
+                    self._release_worker()
+        finally:
+            self._release_chat_lock(chat_id)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.executor.shutdown(wait=wait)
+
+    async def _acquire_worker(self, priority: str or None) -> None:
+        if self.busy < self.max_concurrency and not self._waiters:
+            self.busy += 1
+            return
+        # a request that has to wait for a worker is already queued for OpenAI: it is admitted by the
+        # scheduler now, so a full queue is answered at once instead of after the wait for a worker
+        admitted = priority is not None and self.scheduler is not None
+        if admitted:
+            self.scheduler.admit()
+        waiter = asyncio.get_running_loop().create_future()
+        rank = PRIORITIES.get(priority, PRIORITIES[PRIORITY_DM]) if priority is not None else PRIORITY_COMMAND
+        heapq.heappush(self._waiters, (rank, next(self._arrivals), waiter))
+        try:
+            # the worker of a finished request is handed over, busy does not change
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_worker()
+            else:
+                self._waiters = [entry for entry in self._waiters if entry[2] is not waiter]
+                heapq.heapify(self._waiters)
+            raise
+        finally:
+            if admitted:
+                self.scheduler.leave()
+
+    def _release_worker(self) -> None:
+        # the waiting chat with the highest priority, and the oldest of those, goes next
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.busy -= 1
+
+    def _get_chat_lock(self, chat_id: str) -> asyncio.Lock:
+        if chat_id not in self._chat_locks:
+            self._chat_locks[chat_id] = asyncio.Lock()
+        self._chat_users[chat_id] = self._chat_users.get(chat_id, 0) + 1
+        return self._chat_locks[chat_id]
+
+    def _release_chat_lock(self, chat_id: str) -> None:
+        self._chat_users[chat_id] -= 1
+        if self._chat_users[chat_id] == 0:
+            del self._chat_users[chat_id]
+            del self._chat_locks[chat_id]
@@ -0,0 +1,71 @@
+from collections import deque
+from functools import lru_cache
+from pygments import highlight
+from pygments.formatters import TerminalFormatter
+from pygments.lexer import Lexer
+from pygments.lexers import get_lexer_by_name
+from pygments.util import ClassNotFound
+
+FENCE: str = "```"
+# blocks without a language tag are shown as Python, like all blocks were before the tag was read
+DEFAULT_LANGUAGE: str = "python"
+FORMATTER: TerminalFormatter = TerminalFormatter()
+
+
+@lru_cache(maxsize=64)
+def lexer_for(tag: str) -> Lexer:
+    # tag is what follows the opening fence, e.g. "python", "js title=app.js" or nothing
+    name = tag.split()[0].lower() if tag.strip() else DEFAULT_LANGUAGE
+    try:
+        # stripnl=False keeps the blank lines at the start and end, the output has as many lines as the code
+        return get_lexer_by_name(name, stripnl=False)
+    except ClassNotFound:
+        return get_lexer_by_name("text", stripnl=False)
+
+
+def highlight_code(code: str, tag: str) -> str:
+    # the formatter closes the colors at every line end, so the result can be split into lines
+    return highlight(code, lexer_for(tag), FORMATTER)[:-1]
+
+
+def highlight_text(text: str) -> str:
+    # every code block is lexed once as a whole, prose lines are kept as they are and empty ones dropped
+    parts: list[str] = []
+    code: list[str] = []
+    tag: str or None = None
+    for line in text.split("\n"):
+        if tag is None:
+            if line.startswith(FENCE):
+                tag = line[len(FENCE):]
+                parts.append(line)
+            elif line.strip():
+                parts.append(line)
+        elif line.startswith(FENCE):
+            if code:
+                parts.append(highlight_code("\n".join(code), tag))
+            parts.append(line)
+            code = []
+            tag = None
+        else:
+            code.append(line)
+    if code:
+        # a block that is not closed at the end of the answer
+        parts.append(highlight_code("\n".join(code), tag))
+    return "\n".join(parts) + "\n"
+
+
+class IncrementalHighlighter:
+    # highlights a streamed code block line by line: a line is lexed together with the lines before it back to
+    # the last blank one, so the lexer knows e.g. that it is inside a string, but not the whole block every time
+    CONTEXT_LINES: int = 10
+
+    def __init__(self, tag: str) -> None:
+        self.tag: str = tag
+        self.lines: deque[str] = deque(maxlen=self.CONTEXT_LINES)
+
+    def add_line(self, line: str) -> str:
+        if not line.strip():
+            self.lines.clear()
+            return line
+        self.lines.append(line)
+        return highlight_code("\n".join(self.lines), self.tag).rsplit("\n", 1)[-1]
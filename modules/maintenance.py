@@ -0,0 +1,189 @@
+import contextlib
+import fcntl
+import glob
+import gzip
+import json
+import os
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import and_
+from modules.config import Config
+from modules.database import Database, SystemLog, Message
+from modules.metrics import metrics
+
+
+TEMPORARY: str = ".tmp"
+
+
+class ArchiveSegment:
+    # gzip files of JSON lines, one per chunk: a chunk is on disk under a temporary name before its rows are
+    # deleted from the database and gets its name once the delete is committed, so no row is archived twice
+    def __init__(self, prefix: str) -> None:
+        self.prefix: str = prefix
+        self.chunks: int = 0
+        self.rows: int = 0
+        self._pending: str or None = None
+        self._pending_rows: int = 0
+
+    def write(self, rows: list[dict]) -> None:
+        os.makedirs(os.path.dirname(self.prefix), exist_ok=True)
+        file = f"{self.prefix}-{self.chunks:05d}.jsonl.gz{TEMPORARY}"
+        data = gzip.compress("".join([json.dumps(row, default=str) + "\n" for row in rows]).encode())
+        with open(file, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self._pending, self._pending_rows = file, len(rows)
+
+    def commit(self) -> None:
+        if self._pending is None:
+            return
+        os.replace(self._pending, self._pending[:-len(TEMPORARY)])
+        self.chunks += 1
+        self.rows += self._pending_rows
+        self._pending = None
+
+    def discard(self) -> None:
+        if self._pending is None:
+            return
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._pending)
+        self._pending = None
+
+
+class ArchiveStore:
+    # <path>/<table>/<time>-<pid>-<chunk>.jsonl.gz, one new segment per table and maintenance run
+    TABLES: dict[str, type] = {'system_log': SystemLog, 'messages': Message}
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+
+    def segment(self, table: str) -> ArchiveSegment:
+        name = f"{datetime.now():%Y%m%dT%H%M%S}-{os.getpid()}"
+        return ArchiveSegment(os.path.join(self.path, table, name))
+
+    def recover(self, db: Database) -> None:
+        # a chunk left under its temporary name by a crash belongs to the archive when its rows are gone
+        # from the database; when they are still there or the chunk is cut off, the delete never happened
+        for table, model in self.TABLES.items():
+            for file in glob.glob(os.path.join(self.path, table, "*" + TEMPORARY)):
+                try:
+                    with gzip.open(file, "rt") as f:
+                        ids = [json.loads(line)["id"] for line in f]
+                except (EOFError, OSError, ValueError):
+                    ids = []
+                if ids and not db.has_any_row(model, ids):
+                    os.replace(file, file[:-len(TEMPORARY)])
+                else:
+                    os.remove(file)
+
+    def segments(self, table: str) -> list[str]:
+        return sorted(glob.glob(os.path.join(self.path, table, "*.jsonl.gz")))
+
+    def read(self, table: str):
+        # the archived rows of a table, oldest segment first, date_time as datetime again
+        for file in self.segments(table):
+            with gzip.open(file, "rt") as f:
+                try:
+                    for line in f:
+                        row = json.loads(line)
+                        if row.get("date_time"):
+                            row["date_time"] = datetime.fromisoformat(row["date_time"])
+                        yield row
+                except EOFError:
+                    # a segment of an older version cut off by a crash, its rows were not deleted
+                    pass
+
+
+class Maintenance:
+    # moves expired rows out of the database into the archive and gives the free space back,
+    # in short transactions in a background thread so messages are handled meanwhile
+    def __init__(self, db: Database or None = None) -> None:
+        self.config: Config = Config()
+        self.db: Database = db or Database(self.config.DB_URI)
+        self.archive: ArchiveStore = ArchiveStore(self.config.ARCHIVE_PATH)
+        self._stopped = threading.Event()
+        self._thread: threading.Thread or None = None
+
+    def start(self) -> None:
+        if self.config.MAINTENANCE_INTERVAL <= 0 or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run_periodically, name='db-maintenance', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run_once(self) -> int:
+        # returns the number of archived rows; when another process is busy with it, this one skips its turn
+        os.makedirs(self.config.ARCHIVE_PATH, exist_ok=True)
+        with open(os.path.join(self.config.ARCHIVE_PATH, ".maintenance.lock"), "w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            with metrics.span("maintenance"):
+                self.archive.recover(self.db)
+                archived = self._archive_expired()
+                self.db.vacuum(full=self.config.DB_FULL_VACUUM)
+        metrics.inc("archived_rows_total", archived)
+        return archived
+
+    def _run_periodically(self) -> None:
+        delay = min(60.0, self.config.MAINTENANCE_INTERVAL)
+        while not self._stopped.wait(delay):
+            delay = self.config.MAINTENANCE_INTERVAL
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"{self.config.ERROR_LOG_MSG} {e}")
+
+    def _archive_expired(self) -> int:
+        # the usage report has counted every log row before it leaves the database
+        self.db.roll_up_usage()
+        rolled_up = SystemLog.id <= self.db.get_rollup_watermark()
+        now = datetime.now()
+        log_segment = self.archive.segment('system_log')
+        archived = 0
+        if self.config.LOG_RETENTION_DAYS > 0:
+            expired = SystemLog.date_time < now - timedelta(days=self.config.LOG_RETENTION_DAYS)
+            archived += self._archive(SystemLog, and_(rolled_up, expired), log_segment)
+        if self.config.LOG_RETENTION_ROWS_PER_CHAT > 0:
+            for chat_id, last_id in self.db.row_limit_cutoffs(SystemLog, self.config.LOG_RETENTION_ROWS_PER_CHAT):
+                archived += self._archive(SystemLog, and_(rolled_up, SystemLog.chat_id == chat_id,
+                                                          SystemLog.id <= last_id), log_segment)
+        if self.config.SUMMARIZED_RETENTION_DAYS > 0:
+            expired = Message.date_time < now - timedelta(days=self.config.SUMMARIZED_RETENTION_DAYS)
+            archived += self._archive(Message, and_(Message.category == 'summarized', expired),
+                                      self.archive.segment('messages'))
+        if self.config.DB_MAX_BYTES > 0:
+            # the oldest log rows go first, one chunk at a time until the database is small enough
+            while self.db.database_size() > self.config.DB_MAX_BYTES and not self._stopped.is_set():
+                count = self._archive_chunk(SystemLog, rolled_up, log_segment)
+                if count == 0:
+                    break
+                archived += count
+        return archived
+
+    def _archive(self, model: type, condition, segment: ArchiveSegment) -> int:
+        archived = 0
+        while not self._stopped.is_set():
+            count = self._archive_chunk(model, condition, segment)
+            if count == 0:
+                break
+            archived += count
+            # a short pause between the chunks lets the bot write its messages
+            self._stopped.wait(0.01)
+        return archived
+
+    def _archive_chunk(self, model: type, condition, segment: ArchiveSegment) -> int:
+        try:
+            count = self.db.archive_rows(model, condition, segment.write, self.config.MAINTENANCE_CHUNK_SIZE)
+        except Exception:
+            # the rows are still in the database
+            segment.discard()
+            raise
+        segment.commit()
+        return count
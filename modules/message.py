@@ -1,26 +1,61 @@
-import tiktoken
+import threading
+from array import array
+from sys import intern
 from modules.config import Config
+from modules.tokenizer import Tokenizer
+
+
+class SharedTokenizer:
+    # the tokenizer of all messages, created with the settings on first use instead of on import
+    def __init__(self) -> None:
+        self._tokenizer: Tokenizer or None = None
+        self._lock = threading.Lock()
+
+    def __get__(self, instance, owner) -> Tokenizer:
+        if self._tokenizer is None:
+            with self._lock:
+                if self._tokenizer is None:
+                    config = Config()
+                    self._tokenizer = Tokenizer(config.TOKEN_CACHE_SIZE, config.TIKTOKEN_CACHE_DIR)
+        return self._tokenizer
 
 
 class OpenAIMessage:
-    config: Config = Config()
+    tokenizer: Tokenizer = SharedTokenizer()
+    __slots__ = ("content", "sender", "receiver", "role", "category", "chat_id", "_token_count")
 
     def __init__(self, content: str, sender: str, receiver: str,
                  role: str, category: str, chat_id: str, token_count: int = 0) -> None:
         self.content: str = content
-        self.sender: str = sender
-        self.receiver: str = receiver
-        self.role: str = role
-        self.category: str = category
-        self.chat_id: str = chat_id
-        self.token_count: int = token_count
-        if self.token_count == 0:
+        # the same few names repeat in every message of a chat, interned they are stored once
+        self.sender: str = intern(sender)
+        self.receiver: str = intern(receiver)
+        self.role: str = intern(role)
+        self.category: str = intern(category)
+        self.chat_id: str = intern(chat_id)
+        self._token_count: int = token_count
+
+    @property
+    def config(self) -> Config:
+        return Config()
+
+    @property
+    def token_count(self) -> int:
+        # counted on first use, so lists of messages can be counted in one batch before
+        if self._token_count == 0:
             self.set_token_count()
+        return self._token_count
+
+    @token_count.setter
+    def token_count(self, token_count: int) -> None:
+        self._token_count = token_count
+
+    @property
+    def token_count_is_missing(self) -> bool:
+        return self._token_count == 0
 
     def calculate_token(self) -> int:
-        encoding = tiktoken.encoding_for_model(self.config.MODEL)
-        num_token = len(encoding.encode(self.content))
-        return num_token
+        return self.tokenizer.count_message(self.role, self.content, self.sender, self.config.MODEL)
 
     def set_token_count(self) -> None:
         self.token_count = self.calculate_token()
@@ -41,3 +76,61 @@ class OpenAIMessage:
     def __repr__(self):
         return f"OpenAIMessage: sender={self.sender}, receiver={self.receiver}, " \
                f"role={self.role}, category={self.category}, chat_id={self.chat_id}, content={self.content[:12]}"
+
+
+class MessageStore:
+    # the messages of one conversation and category in parallel columns instead of one object each,
+    # an OpenAIMessage is only built when a message is read
+    def __init__(self, chat_id: str, category: str) -> None:
+        self.chat_id: str = intern(chat_id)
+        self.category: str = intern(category)
+        self.contents: list[str] = []
+        self.senders: list[str] = []
+        self.receivers: list[str] = []
+        self.roles: list[str] = []
+        self.token_counts: array = array('l')
+        self.total_tokens: int = 0
+
+    def __len__(self) -> int:
+        return len(self.contents)
+
+    def __getitem__(self, index: int or slice) -> OpenAIMessage or list[OpenAIMessage]:
+        if isinstance(index, slice):
+            return [self._message(i) for i in range(*index.indices(len(self)))]
+        return self._message(index)
+
+    def __iter__(self):
+        return (self._message(i) for i in range(len(self)))
+
+    def __reversed__(self):
+        return (self._message(i) for i in range(len(self) - 1, -1, -1))
+
+    def add(self, content: str, sender: str, receiver: str, role: str, token_count: int) -> None:
+        self.contents.append(content)
+        self.senders.append(intern(sender))
+        self.receivers.append(intern(receiver))
+        self.roles.append(intern(role))
+        self.token_counts.append(token_count)
+        self.total_tokens += token_count
+
+    def append(self, message: OpenAIMessage) -> None:
+        self.add(message.content, message.sender, message.receiver, message.role, message.token_count)
+
+    def pop(self) -> OpenAIMessage:
+        message = self._message(-1)
+        for column in (self.contents, self.senders, self.receivers, self.roles, self.token_counts):
+            column.pop()
+        self.total_tokens -= message.token_count
+        return message
+
+    def remove_first(self, count: int) -> None:
+        self.total_tokens -= sum(self.token_counts[:count])
+        for column in (self.contents, self.senders, self.receivers, self.roles, self.token_counts):
+            del column[:count]
+
+    def clear(self) -> None:
+        self.remove_first(len(self))
+
+    def _message(self, index: int) -> OpenAIMessage:
+        return OpenAIMessage(self.contents[index], self.senders[index], self.receivers[index], self.roles[index],
+                             self.category, self.chat_id, self.token_counts[index])
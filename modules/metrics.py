@@ -0,0 +1,207 @@
+import bisect
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+# seconds, from a cached tokenizer lookup up to a slow completion
+DEFAULT_BUCKETS: tuple[float, ...] = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        self.buckets: tuple[float, ...] = buckets
+        # the last count is the +Inf bucket
+        self.counts: list[int] = [0] * (len(buckets) + 1)
+        self.count: int = 0
+        self.sum: float = 0.0
+        self.max: float = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket that holds the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return self.max
+
+
+class Trace:
+    def __init__(self, chat_id: str) -> None:
+        self.chat_id: str = chat_id
+        self.started: float = time.perf_counter()
+        self.spans: dict[str, float] = {}
+
+    @property
+    def seconds(self) -> float:
+        return time.perf_counter() - self.started
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.spans[stage] = self.spans.get(stage, 0.0) + seconds
+
+
+class Metrics:
+    def __init__(self) -> None:
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.gauges: dict[str, Callable[[], float]] = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def gauge(self, name: str, callback: Callable[[], float]) -> None:
+        # gauges are read when the metrics are exported, the last registered callback wins
+        self.gauges[name] = callback
+
+    @contextmanager
+    def span(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - started
+            self.observe("stage_seconds", seconds, stage=stage)
+            trace: Trace or None = getattr(self._local, "trace", None)
+            if trace is not None:
+                trace.add(stage, seconds)
+
+    @contextmanager
+    def trace(self, chat_id: str):
+        # collects the spans of one request in the current thread
+        trace = Trace(chat_id)
+        previous = getattr(self._local, "trace", None)
+        self._local.trace = trace
+        try:
+            yield trace
+        finally:
+            self._local.trace = previous
+            self.observe("request_seconds", trace.seconds)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            counters = {self._name(name, labels): value for (name, labels), value in sorted(self.counters.items())}
+            histograms = {self._name(name, labels): {"count": histogram.count,
+                                                     "mean": histogram.sum / histogram.count,
+                                                     "p50": histogram.quantile(0.5),
+                                                     "p95": histogram.quantile(0.95),
+                                                     "max": histogram.max}
+                          for (name, labels), histogram in sorted(self.histograms.items()) if histogram.count}
+        gauges = {name: self._read_gauge(callback) for name, callback in sorted(self.gauges.items())}
+        return {"counters": counters, "gauges": gauges, "histograms": histograms}
+
+    def to_prometheus(self, prefix: str = "chatbot_") -> str:
+        lines: list[str] = []
+        with self._lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            for (name, labels), value in counters:
+                lines.append(f"{prefix}{self._name(name, labels)} {value}")
+            for (name, labels), histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else bound
+                    lines.append(f"{prefix}{self._name(name + '_bucket', labels + (('le', le),))} {cumulative}")
+                lines.append(f"{prefix}{self._name(name + '_sum', labels)} {histogram.sum}")
+                lines.append(f"{prefix}{self._name(name + '_count', labels)} {histogram.count}")
+        for name, callback in sorted(self.gauges.items()):
+            lines.append(f"{prefix}{name} {self._read_gauge(callback)}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _name(name: str, labels: tuple) -> str:
+        if not labels:
+            return name
+        label_text = ",".join(f'{key}="{str(value)}"'.replace("\n", " ") for key, value in labels)
+        return f"{name}{{{label_text}}}"
+
+    @staticmethod
+    def _read_gauge(callback: Callable[[], float]) -> float:
+        try:
+            return float(callback())
+        except Exception:
+            return float("nan")
+
+
+# one registry for the whole process, like the shared database engines
+metrics = Metrics()
+
+
+class TraceLog:
+    # writes a sample of the request traces to the system log, many traces in one insert
+    def __init__(self, db, sample_rate: float, batch_size: int, flush_interval: float) -> None:
+        self.db = db
+        self.sample_rate: float = sample_rate
+        self.batch_size: int = max(1, batch_size)
+        self.flush_interval: float = flush_interval
+        self._rows: list[dict] = []
+        self._last_flush: float = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, trace: Trace) -> None:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return
+        row = dict(message=json.dumps({"seconds": round(trace.seconds, 4),
+                                       "spans": {stage: round(seconds, 4) for stage, seconds in trace.spans.items()}}),
+                   from_user='system', to_user='system', role='system', category='trace',
+                   chat_id=trace.chat_id, token_count=0, date_time=datetime.now())
+        with self._lock:
+            self._rows.append(row)
+            due = len(self._rows) >= self.batch_size or time.monotonic() - self._last_flush >= self.flush_interval
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._last_flush = time.monotonic()
+        if rows:
+            self.db.add_messages_to_system_log(rows)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def do_GET(self) -> None:
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.to_prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(host: str, port: int) -> ThreadingHTTPServer:
+    # serves /metrics in the Prometheus text format from a daemon thread
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
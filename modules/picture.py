@@ -1,22 +1,137 @@
+import asyncio
+import hashlib
+import os
+import re
+from datetime import datetime, timedelta
+import aiohttp
 import openai
-import requests
 from modules.config import Config
 from modules.database import Database
-import datetime
+from modules.metrics import metrics
+from modules.transport import Transport, get_transport
 
 
 class Picture:
-    config = Config()
-    db = Database(config.DB_URI)
-
-    def __init__(self, description: str) -> None:
-        self.prompt = description
-        self.response = openai.Image.create(prompt=self.prompt, n=1)
-        self.image_url = self.response["data"][0]["url"]
-        self.image_data = requests.get(self.image_url).content
-        self.timestamp_string = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S")
-        self.picture_file = f"generated_image-{self.timestamp_string}.png"
-
-    def write(self):
-        with open(self.picture_file, "wb") as f:
-            f.write(self.image_data)
+    def __init__(self, prompt: str, content_hash: str, data: bytes or None = None,
+                 telegram_file_id: str or None = None) -> None:
+        self.prompt: str = prompt
+        self.content_hash: str = content_hash
+        self.data: bytes or None = data
+        self.telegram_file_id: str or None = telegram_file_id
+        # set while a new picture is written to the store in the background
+        self.stored: asyncio.Future or None = None
+
+
+class PictureStore:
+    # content addressed files: <path>/<first two hex digits>/<sha256>.png, equal images are stored once
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+
+    def file_for(self, content_hash: str) -> str:
+        return os.path.join(self.path, content_hash[:2], f"{content_hash}.png")
+
+    def save(self, content_hash: str, data: bytes) -> None:
+        file = self.file_for(content_hash)
+        if os.path.exists(file):
+            return
+        os.makedirs(os.path.dirname(file), exist_ok=True)
+        # written under a temporary name first, a reader never sees half a file
+        temporary_file = f"{file}.{os.getpid()}.tmp"
+        with open(temporary_file, "wb") as f:
+            f.write(data)
+        os.replace(temporary_file, file)
+
+    def load(self, content_hash: str) -> bytes or None:
+        try:
+            with open(self.file_for(content_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def remove(self, content_hashes: list[str]) -> None:
+        for content_hash in content_hashes:
+            try:
+                os.remove(self.file_for(content_hash))
+            except FileNotFoundError:
+                pass
+
+
+class PictureGenerator:
+    def __init__(self) -> None:
+        self.config: Config = Config()
+        self.db: Database = Database(self.config.DB_URI)
+        self.store: PictureStore = PictureStore(self.config.PICTURE_PATH)
+        self.transport: Transport = get_transport()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        # the connection pool of the running event loop, shared with the asynchronous OpenAI requests
+        return self.transport.aiohttp_session()
+
+    @staticmethod
+    def prompt_key(prompt: str) -> str:
+        normalized = re.sub(r"\s+", " ", prompt).strip().lower()
+        return hashlib.blake2b(normalized.encode(), digest_size=20).hexdigest()
+
+    async def create(self, prompt: str, n: int = 1) -> list[Picture]:
+        n = max(1, min(n, self.config.PICTURE_MAX_N))
+        loop = asyncio.get_running_loop()
+        prompt_key = self.prompt_key(prompt)
+        cached = await loop.run_in_executor(None, self.db.get_pictures, prompt_key, n)
+        if len(cached) == n:
+            metrics.inc("picture_cache_hits_total")
+            pictures = [Picture(prompt, row.content_hash, telegram_file_id=row.telegram_file_id) for row in cached]
+            for picture in pictures:
+                if picture.telegram_file_id is None:
+                    picture.data = await loop.run_in_executor(None, self.store.load, picture.content_hash)
+            if all([picture.telegram_file_id or picture.data for picture in pictures]):
+                return pictures
+        metrics.inc("picture_cache_misses_total")
+        openai.aiosession.set(self.session)
+        with metrics.span("openai_image"):
+            response = await openai.Image.acreate(prompt=prompt, n=n, size=self.config.PICTURE_SIZE,
+                                                  request_timeout=self.config.OPENAI_REQUEST_TIMEOUT)
+        images = await asyncio.gather(*[self._download(image["url"]) for image in response["data"]])
+        pictures = [Picture(prompt, hashlib.sha256(data).hexdigest(), data) for data in images]
+        # the pictures are returned from memory, storing them does not delay the answer
+        stored = loop.run_in_executor(None, self._store, prompt_key, prompt, pictures)
+        for picture in pictures:
+            picture.stored = stored
+        return pictures
+
+    async def remember_file_id(self, picture: Picture, telegram_file_id: str) -> None:
+        # Telegram keeps uploaded photos, sending the file id again needs no upload
+        if picture.telegram_file_id == telegram_file_id:
+            return
+        picture.telegram_file_id = telegram_file_id
+        if picture.stored is not None:
+            await picture.stored
+        await asyncio.get_running_loop().run_in_executor(None, self.db.set_picture_file_id,
+                                                         picture.content_hash, telegram_file_id)
+
+    async def close(self) -> None:
+        await self.transport.close_aiohttp_session()
+
+    async def _download(self, url: str) -> bytes:
+        chunks: list[bytes] = []
+        size = 0
+        with metrics.span("picture_download"):
+            async with self.session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if size > self.config.PICTURE_MAX_DOWNLOAD_BYTES:
+                        raise ValueError(f"picture is larger than {self.config.PICTURE_MAX_DOWNLOAD_BYTES} bytes")
+                    chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _store(self, prompt_key: str, prompt: str, pictures: list[Picture]) -> None:
+        try:
+            for picture in pictures:
+                self.store.save(picture.content_hash, picture.data)
+            self.db.add_pictures(prompt_key, prompt, [(picture.content_hash, len(picture.data))
+                                                      for picture in pictures])
+            created_before = datetime.now() - timedelta(days=self.config.PICTURE_RETENTION_DAYS)
+            self.store.remove(self.db.expire_pictures(created_before, self.config.PICTURE_MAX_BYTES))
+        except Exception as e:
+            print(f"{self.config.ERROR_LOG_MSG} {e}")
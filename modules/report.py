@@ -0,0 +1,88 @@
+import csv
+import json
+import sys
+from datetime import datetime
+from modules.config import Config
+from modules.database import Database, USAGE_COUNTERS
+from modules.maintenance import ArchiveStore
+
+# the rollup is kept per hour, longer periods are summed up from the hours
+PERIOD_FORMATS: dict[str, str] = {
+    "hour": "%Y-%m-%d %H:00",
+    "day": "%Y-%m-%d",
+    "month": "%Y-%m",
+}
+GROUP_COLUMNS: dict[str, str] = {"user": "user", "chat": "chat_id"}
+
+
+class UsageReport:
+    def __init__(self, db: Database) -> None:
+        self.db: Database = db
+
+    def rows(self, by: str, since: datetime or None = None, until: datetime or None = None) -> list[dict]:
+        # system_log is only read after the watermark, the report itself is computed from the rollup
+        self.db.roll_up_usage()
+        if by in GROUP_COLUMNS:
+            rows = [{by: row.pop(GROUP_COLUMNS[by]), **row}
+                    for row in self.db.get_usage(GROUP_COLUMNS[by], since, until)]
+        else:
+            rows = self._rows_by_period(by, since, until)
+        for row in rows:
+            row["total_tokens"] = row["prompt_tokens"] + row["completion_tokens"]
+            row["error_rate"] = round(row["errors"] / row["messages"], 4) if row["messages"] else 0.0
+        return rows
+
+    def rebuild(self, archive: ArchiveStore, chunk_size: int = 10000) -> None:
+        # sums up the log again, the archived rows first, e.g. after the rollup was lost
+        self.db.reset_usage_rollup()
+        rows: list[tuple] = []
+        for row in archive.read('system_log'):
+            rows.append((row["id"], row["date_time"], row["category"], row["role"], row["from_user"],
+                         row["to_user"], row["chat_id"], row["message"]))
+            if len(rows) >= chunk_size:
+                self.db.roll_up_archived_usage(rows)
+                rows = []
+        self.db.roll_up_archived_usage(rows)
+
+    def _rows_by_period(self, period: str, since: datetime or None, until: datetime or None) -> list[dict]:
+        periods: dict[str, dict] = {}
+        for row in self.db.get_usage("bucket", since, until):
+            key = row.pop("bucket").strftime(PERIOD_FORMATS[period])
+            total = periods.setdefault(key, {period: key, **dict.fromkeys(USAGE_COUNTERS, 0)})
+            for counter in USAGE_COUNTERS:
+                total[counter] += row[counter] or 0
+        return list(periods.values())
+
+
+def write_rows(rows: list[dict], output_format: str, file) -> None:
+    if output_format == "json":
+        json.dump(rows, file, indent=2)
+        file.write("\n")
+        return
+    if not rows:
+        return
+    if output_format == "csv":
+        writer = csv.DictWriter(file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+        return
+    columns = list(rows[0])
+    widths = [max(len(column), *[len(str(row[column])) for row in rows]) for column in columns]
+    file.write("  ".join(column.ljust(width) for column, width in zip(columns, widths)) + "\n")
+    for row in rows:
+        file.write("  ".join(str(row[column]).ljust(width) for column, width in zip(columns, widths)) + "\n")
+
+
+def run_report(arguments) -> None:
+    config = Config()
+    report = UsageReport(Database(config.DB_URI))
+    if arguments.rebuild:
+        report.rebuild(ArchiveStore(config.ARCHIVE_PATH))
+    since = datetime.fromisoformat(arguments.since) if arguments.since else None
+    until = datetime.fromisoformat(arguments.until) if arguments.until else None
+    rows = report.rows(arguments.by, since, until)
+    if arguments.output:
+        with open(arguments.output, "w", newline="") as f:
+            write_rows(rows, arguments.format, f)
+    else:
+        write_rows(rows, arguments.format, sys.stdout)
@@ -0,0 +1,170 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from modules.metrics import metrics
+
+PRIORITY_CONSOLE: str = 'console'
+PRIORITY_DM: str = 'dm'
+PRIORITY_GROUP: str = 'group'
+PRIORITY_BATCH: str = 'batch'
+# lower values are served first
+PRIORITIES: dict[str, int] = {
+    PRIORITY_CONSOLE: 0,
+    PRIORITY_DM: 1,
+    PRIORITY_GROUP: 2,
+    PRIORITY_BATCH: 3,
+}
+
+
+class SchedulerBusyError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float) -> None:
+        self.capacity: float = per_minute
+        self.rate: float = per_minute / 60
+        self.tokens: float = per_minute
+        self.updated: float = time.monotonic()
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # a request larger than the bucket may go once the bucket is full
+        missing = min(amount, self.capacity) - self.tokens
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float) -> None:
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+    def set_rate(self, per_minute: float) -> None:
+        # the bucket keeps how full it is
+        self._refill()
+        self.tokens = self.tokens * per_minute / self.capacity
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class Ticket:
+    def __init__(self, chat_id: str, priority: str, estimated_tokens: int) -> None:
+        self.chat_id: str = chat_id
+        self.priority: int = PRIORITIES.get(priority, PRIORITIES[PRIORITY_DM])
+        self.estimated_tokens: int = estimated_tokens
+        self.actual_tokens: int or None = None
+
+
+class RequestScheduler:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_queue: int) -> None:
+        self.request_bucket: TokenBucket or None = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.token_bucket: TokenBucket or None = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.max_queue: int = max_queue
+        self.queued: int = 0
+        # requests that wait for a worker before they reach the scheduler, see admit
+        self.waiting: int = 0
+        self.rejected: int = 0
+        # priority -> chats in round-robin order -> waiting tickets of that chat
+        self._queues: dict[int, OrderedDict[str, deque[Ticket]]] = {}
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self, chat_id: str, priority: str, estimated_tokens: int):
+        ticket = self.acquire(chat_id, priority, estimated_tokens)
+        try:
+            yield ticket
+        finally:
+            self.settle(ticket)
+
+    def acquire(self, chat_id: str, priority: str, estimated_tokens: int) -> Ticket:
+        with metrics.span("queue"):
+            return self._acquire(chat_id, priority, estimated_tokens)
+
+    def _acquire(self, chat_id: str, priority: str, estimated_tokens: int) -> Ticket:
+        with self._condition:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerBusyError(f"{self.queued} requests are waiting")
+            ticket = Ticket(chat_id, priority, estimated_tokens)
+            self._queues.setdefault(ticket.priority, OrderedDict()).setdefault(chat_id, deque()).append(ticket)
+            self.queued += 1
+            while True:
+                if self._next_ticket() is not ticket:
+                    self._condition.wait()
+                    continue
+                wait_time = self._wait_time(ticket)
+                if wait_time > 0:
+                    self._condition.wait(timeout=wait_time)
+                    continue
+                self._dequeue(ticket)
+                if self.request_bucket:
+                    self.request_bucket.consume(1)
+                if self.token_bucket:
+                    self.token_bucket.consume(ticket.estimated_tokens)
+                self._condition.notify_all()
+                return ticket
+
+    def set_limits(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        # e.g. when more processes share the account, a disabled limit stays disabled
+        with self._condition:
+            if self.request_bucket and requests_per_minute > 0:
+                self.request_bucket.set_rate(requests_per_minute)
+            if self.token_bucket and tokens_per_minute > 0:
+                self.token_bucket.set_rate(tokens_per_minute)
+            self._condition.notify_all()
+
+    def admit(self) -> None:
+        # the requests that wait for a worker count towards the queue limit, otherwise the queue could
+        # never be longer than the number of workers and a full queue would never be noticed
+        with self._condition:
+            if self.queued + self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise SchedulerBusyError(f"{self.queued + self.waiting} requests are waiting")
+            self.waiting += 1
+
+    def leave(self) -> None:
+        # the admitted request has a worker now and is queued by acquire
+        with self._condition:
+            self.waiting -= 1
+
+    def settle(self, ticket: Ticket) -> None:
+        # gives back what the estimate reserved too much, once the real usage is known
+        if ticket.actual_tokens is None or self.token_bucket is None:
+            return
+        with self._condition:
+            self.token_bucket.refund(ticket.estimated_tokens - ticket.actual_tokens)
+            self._condition.notify_all()
+
+    def _next_ticket(self) -> Ticket or None:
+        for priority in sorted(self._queues):
+            chats = self._queues[priority]
+            if chats:
+                return next(iter(chats.values()))[0]
+        return None
+
+    def _wait_time(self, ticket: Ticket) -> float:
+        wait_times = [0.0]
+        if self.request_bucket:
+            wait_times.append(self.request_bucket.wait_time(1))
+        if self.token_bucket:
+            wait_times.append(self.token_bucket.wait_time(ticket.estimated_tokens))
+        return max(wait_times)
+
+    def _dequeue(self, ticket: Ticket) -> None:
+        # the chat moves to the end of the line, so one busy chat cannot starve the others
+        chats = self._queues[ticket.priority]
+        tickets = chats[ticket.chat_id]
+        tickets.popleft()
+        if tickets:
+            chats.move_to_end(ticket.chat_id)
+        else:
+            del chats[ticket.chat_id]
+        self.queued -= 1
@@ -0,0 +1,228 @@
+import asyncio
+import bisect
+import hashlib
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+import openai
+from telegram import Update
+from telegram.ext import Application, TypeHandler, ContextTypes
+from modules.config import Config
+from modules.database import get_shared_engine
+from modules.metrics import metrics
+from modules.telegrambot import TelegramBot
+from modules.maintenance import Maintenance
+from modules.transport import get_transport
+
+DRAIN: str = 'drain'
+STOP: None = None
+
+
+def update_chat_id(update: dict) -> str:
+    # the chat of a message, an edited message, a channel post or the message of a callback query
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        if "chat" in value:
+            return str(value["chat"]["id"])
+        if isinstance(value.get("message"), dict) and "chat" in value["message"]:
+            return str(value["message"]["chat"]["id"])
+        if "from" in value:
+            return str(value["from"]["id"])
+    return str(update.get("update_id", ""))
+
+
+class HashRing:
+    # consistent hashing: changing the number of workers only moves the chats of the added or removed worker
+    def __init__(self, workers: int, replicas: int = 64) -> None:
+        self.workers: int = workers
+        self._ring: list[tuple[int, int]] = sorted((self._hash(f"worker-{worker}-{replica}"), worker)
+                                                   for worker in range(workers) for replica in range(replicas))
+        self._keys: list[int] = [key for key, _ in self._ring]
+
+    def worker_for(self, chat_id: str) -> int:
+        index = bisect.bisect(self._keys, self._hash(chat_id)) % len(self._ring)
+        return self._ring[index][1]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class ShardRouter:
+    # runs in the front process and hands every update to the worker process that owns its chat,
+    # so the updates of a chat are handled in order by one process with one conversation cache
+    def __init__(self, workers: int) -> None:
+        self.config: Config = Config()
+        self.ring: HashRing = HashRing(max(1, workers))
+        self.context = multiprocessing.get_context("spawn")
+        self.queues: list = []
+        self.processes: list = []
+        self.acks = self.context.Queue()
+        self.generation: int = 0
+        self.draining: bool = False
+        self.pending: list[dict] = []
+        self._lock = threading.Lock()
+        self._resize_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._monitor: threading.Thread or None = None
+
+    def start(self) -> None:
+        # the schema is created once here, before several processes open the database
+        get_shared_engine(self.config.DB_URI)
+        for worker in range(self.ring.workers):
+            self.queues.append(self.context.Queue())
+            self.processes.append(self._spawn(worker, self.ring.workers))
+        self._monitor = threading.Thread(target=self._watch_workers, name='shard-monitor', daemon=True)
+        self._monitor.start()
+        metrics.gauge("shard_workers", lambda: self.ring.workers)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGUSR1, lambda *args: self._resize_in_background(self.ring.workers + 1))
+            signal.signal(signal.SIGUSR2, lambda *args: self._resize_in_background(self.ring.workers - 1))
+
+    def route(self, update: dict) -> None:
+        with self._lock:
+            if self.draining:
+                self.pending.append(update)
+                return
+            worker = self.ring.worker_for(update_chat_id(update))
+            self.queues[worker].put(update)
+        metrics.inc("shard_updates_total", worker=worker)
+
+    def resize(self, workers: int) -> None:
+        workers = max(1, workers)
+        with self._resize_lock:
+            if workers == self.ring.workers:
+                return
+            # drain barrier: new updates are held back until every worker has finished the ones it has,
+            # otherwise a moved chat could be answered by two processes at the same time
+            with self._lock:
+                self.draining = True
+                self.generation += 1
+                generation = self.generation
+            self._drain(generation, workers)
+            with self._lock:
+                for worker in range(self.ring.workers, workers):
+                    self.queues.append(self.context.Queue())
+                    self.processes.append(self._spawn(worker, workers))
+                for worker in range(workers, self.ring.workers):
+                    self.queues[worker].put(STOP)
+                removed = self.processes[workers:]
+                del self.processes[workers:]
+                del self.queues[workers:]
+                self.ring = HashRing(workers)
+                self.draining = False
+                # held back updates go first, in the order they arrived
+                for update in self.pending:
+                    self.queues[self.ring.worker_for(update_chat_id(update))].put(update)
+                self.pending = []
+            for process in removed:
+                process.join(self.config.SHARD_DRAIN_TIMEOUT)
+
+    def stop(self) -> None:
+        self._stopped.set()
+        for worker_queue in self.queues:
+            worker_queue.put(STOP)
+        for process in self.processes:
+            process.join(self.config.SHARD_DRAIN_TIMEOUT)
+            if process.is_alive():
+                process.terminate()
+
+    def _drain(self, generation: int, workers: int) -> None:
+        alive = {worker for worker, process in enumerate(self.processes) if process.is_alive()}
+        for worker in alive:
+            self.queues[worker].put((DRAIN, generation, workers))
+        deadline = time.monotonic() + self.config.SHARD_DRAIN_TIMEOUT
+        while alive and time.monotonic() < deadline:
+            try:
+                worker, acked_generation = self.acks.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if acked_generation == generation:
+                alive.discard(worker)
+
+    def _spawn(self, worker: int, workers: int):
+        process = self.context.Process(target=run_worker, args=(worker, workers, self.queues[worker], self.acks),
+                                        name=f'chat-shard-{worker}', daemon=True)
+        process.start()
+        return process
+
+    def _watch_workers(self) -> None:
+        while not self._stopped.wait(1.0):
+            with self._lock:
+                for worker, process in enumerate(self.processes):
+                    if not process.is_alive() and not self._stopped.is_set():
+                        # updates already queued for the worker are kept, the one it was handling is lost
+                        metrics.inc("shard_restarts_total", worker=worker)
+                        print(f"{self.config.ERROR_LOG_MSG} shard worker {worker} exited with {process.exitcode}")
+                        self.processes[worker] = self._spawn(worker, self.ring.workers)
+
+    def _resize_in_background(self, workers: int) -> None:
+        threading.Thread(target=self.resize, args=(workers,), name='shard-resize', daemon=True).start()
+
+
+def run_worker(worker: int, workers: int, updates, acks) -> None:
+    # entry point of a worker process, the workers share the OpenAI rate limits equally
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    openai.api_key = Config().OPENAI_API_KEY
+    get_transport().install()
+    bot = TelegramBot()
+    bot.share_rate_limits(1 / workers)
+    asyncio.run(_serve_updates(bot, worker, updates, acks))
+
+
+async def _serve_updates(bot: TelegramBot, worker: int, updates, acks) -> None:
+    application: Application = bot.build_application()
+    await application.initialize()
+    loop = asyncio.get_running_loop()
+    running: set[asyncio.Task] = set()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, updates.get)
+            if item is STOP:
+                break
+            if isinstance(item, tuple) and item[0] == DRAIN:
+                if running:
+                    await asyncio.wait(running)
+                # the chats of this worker may move to another one, cached conversations would get stale
+                bot.conversations.clear()
+                bot.share_rate_limits(1 / item[2])
+                acks.put((worker, item[1]))
+                continue
+            # tasks are created in arrival order, the chat locks of the dispatcher keep that order
+            task = asyncio.create_task(application.process_update(Update.de_json(item, application.bot)))
+            running.add(task)
+            task.add_done_callback(running.discard)
+    finally:
+        if running:
+            await asyncio.wait(running)
+        await application.shutdown()
+        await bot.close()
+        bot.dispatcher.shutdown(wait=True)
+        bot.trace_log.flush()
+        bot.db.flush()
+
+
+def run_sharded_polling(workers: int) -> None:
+    # the front process only polls Telegram and routes, the bot runs in the workers
+    config = Config()
+    router = ShardRouter(workers)
+    router.start()
+    # the workers only answer, the front process keeps the database small
+    maintenance = Maintenance()
+    maintenance.start()
+
+    async def route(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        router.route(update.to_dict())
+
+    application: Application = get_transport().application_builder(config.TELEGRAM_BOT_TOKEN).build()
+    application.add_handler(TypeHandler(Update, route))
+    print(config.TELEGRAM_STARTED_MESSAGE.format(name=config.NAME))
+    try:
+        application.run_polling()
+    finally:
+        maintenance.stop()
+        router.stop()
+        print(config.TELEGRAM_STOPPED_MESSAGE.format(name=config.NAME))
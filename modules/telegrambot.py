@@ -1,90 +1,151 @@
+import asyncio
+import contextlib
+import datetime
 import signal
 import sys
-from telegram import ForceReply, Update, MessageEntity
+from typing import Callable
+from telegram import ForceReply, Update, MessageEntity, Message, InputMediaPhoto
+from telegram.error import BadRequest, NetworkError, RetryAfter
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
 from modules.chatbot_base import ChatBot
 from modules.message import OpenAIMessage
-from modules.tools import clean_username
-from modules.picture import Picture
-from modules.conversation import Conversation
+from modules.tools import clean_username, split_message
+from modules.picture import PictureGenerator
+from modules.dispatcher import ChatDispatcher
+from modules.database import AsyncDatabase
+from modules.scheduler import SchedulerBusyError, PRIORITY_DM, PRIORITY_GROUP
+from modules.metrics import metrics, start_metrics_server
+from modules.maintenance import Maintenance
+from modules.transport import get_transport
+
+
+class TelegramStream:
+    # the final text is sent at most this often, waiting for a flood wait or RETRY_DELAY seconds in between
+    FINAL_RENDER_ATTEMPTS: int = 5
+    RETRY_DELAY: float = 1.0
+
+    def __init__(self, reply_to: Message, edit_interval: float) -> None:
+        self.reply_to: Message = reply_to
+        self.edit_interval: float = edit_interval
+        self.loop = asyncio.get_running_loop()
+        self.text: str = ""
+        self.sent_messages: list[Message] = []
+        self.sent_texts: list[str] = []
+        self.changed = asyncio.Event()
+        self.finished = asyncio.Event()
+        self.renderer: asyncio.Task or None = None
+
+    def start(self) -> None:
+        self.renderer = asyncio.create_task(self._run())
+
+    def feed(self, delta: str) -> None:
+        # called from the worker thread that reads the OpenAI stream
+        self.loop.call_soon_threadsafe(self._append, delta)
+
+    async def finish(self, text: str) -> None:
+        # the renderer is stopped between two edits, cancelling it could lose a message that is being sent
+        self.finished.set()
+        self.changed.set()
+        if self.renderer:
+            await self.renderer
+        self.text = text
+        # the final text must arrive, it is sent again after a flood wait or a network error and
+        # the error of the last attempt goes to the caller
+        for _ in range(self.FINAL_RENDER_ATTEMPTS - 1):
+            if await self._render():
+                return
+        await self._render(raise_errors=True)
+
+    async def _run(self) -> None:
+        while not self.finished.is_set():
+            await self.changed.wait()
+            self.changed.clear()
+            if self.finished.is_set():
+                return
+            await self._render()
+            try:
+                await asyncio.wait_for(self.finished.wait(), self.edit_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _append(self, delta: str) -> None:
+        self.text += delta
+        self.changed.set()
+
+    async def _render(self, raise_errors: bool = False) -> bool:
+        # the first 4096 characters are edited into the first message, everything after
+        # that goes to follow-up messages; False if Telegram asked to wait or could not be
+        # reached before all of it was sent, the next render sends the rest
+        for i, chunk in enumerate(split_message(self.text)):
+            if not chunk.strip():
+                break
+            # Telegram drops trailing whitespace, an edit that only adds some would change nothing
+            text = chunk.rstrip()
+            try:
+                if i >= len(self.sent_messages):
+                    with metrics.span("telegram_send"):
+                        self.sent_messages.append(await self.reply_to.reply_text(chunk))
+                    self.sent_texts.append(text)
+                elif self.sent_texts[i] != text:
+                    with metrics.span("telegram_edit"):
+                        await self.sent_messages[i].edit_text(chunk)
+                    self.sent_texts[i] = text
+            except RetryAfter as e:
+                if raise_errors:
+                    raise
+                await asyncio.sleep(e.retry_after)
+                return False
+            except BadRequest as e:
+                if "not modified" not in e.message.lower():
+                    raise
+                self.sent_texts[i] = text
+            except NetworkError as e:
+                if raise_errors:
+                    raise
+                metrics.inc("errors_total", error=type(e).__name__)
+                await asyncio.sleep(self.RETRY_DELAY)
+                return False
+        return True
+
+
+class PendingUpdates:
+    # the messages of a user that are answered together, see TelegramBot.answer
+    def __init__(self, update: Update) -> None:
+        self.updates: list[Update] = [update]
+        # ends the coalescing window early, e.g. before a reset
+        self.flush = asyncio.Event()
+        self.answered = asyncio.Event()
 
 
 class TelegramBot(ChatBot):
     def __init__(self) -> None:
         super().__init__()
+        self.dispatcher = ChatDispatcher(self.config.MAX_CONCURRENT_REQUESTS, self.scheduler)
+        self.async_db = AsyncDatabase(self.config.DB_URI)
+        self.pictures = PictureGenerator()
+        # chat and user -> updates waiting to be answered together
+        self._pending_updates: dict[str, PendingUpdates] = {}
+        metrics.gauge("dispatcher_active_chats", lambda: self.dispatcher.active_chats)
 
     def run(self) -> None:
-        async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            user = update.effective_user
-            username = clean_username(user.full_name)
-            print(f"User {username} executed /start command.")
-            # TODO: remove this print statement and log to database instead
-            await update.message.reply_html(
-                f"{self.config.TELEGRAM_START_MESSAGE.format(user=user.mention_html(), name=self.config.NAME, model=self.config.MODEL)}",
-                reply_markup=ForceReply(selective=True)
-            )
-
-        async def reset_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            user = update.effective_user
-            username = clean_username(user.full_name)
-            conversation = Conversation(str(update.effective_chat.id), username)
-            conversation.clear_messages()
-            print(f"User {username} executed /reset command.")
-            await update.message.reply_text(f"{self.config.CONSOLE_RESET_MSG}")
-            # TODO: remove this print statement and log to database instead
-
-        async def pic_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            user = update.effective_user
-            user_input = context.args[0]
-            username = clean_username(user.full_name)
-            picture = Picture(user_input)
-            # TODO: remove this print statement and log to database instead
-            # TODO: save the picture to the database
-            print(f"User {username} executed /pic command.")
-            with open(f"generated_image-{picture.timestamp_string}.png", "rb") as f:
-                await update.message.reply_photo(photo=f, caption=self.config.TELEGRAM_IMAGE_CAPTION)
-
-        async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            user = update.effective_user
-            username = clean_username(user.full_name)
-            print(f"User {username} executed /help command.")
-            # TODO: remove this print statement and log to database instead
-            await update.message.reply_text(f"{self.config.TELEGRAM_HELP_MESSAGE}")
-
-        async def answer_to_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-            # TODO: remove the print statements and log to database instead
-            username = clean_username(update.effective_user.full_name)
-            chat_id = update.message.chat_id
-            # answer to a reply-message from a user in a group
-            if update.message.chat.type == 'group':
-                if update.effective_message.reply_to_message and \
-                        update.effective_message.reply_to_message.from_user.id == context.bot.id:
-                    print(f"User {username} replied to {self.config.NAME} in chat id {chat_id}.")
-                    await update.message.reply_text(self.send_message(update))
-                # answer to a mention in a group
-                if update.effective_message.entities:
-                    for entity in update.effective_message.entities:
-                        if entity.type == MessageEntity.MENTION:
-                            print(f"User {username} mentioned {self.config.NAME} in chat id {chat_id}.")
-                            await update.message.reply_text(self.send_message(update))
-            # if not in a group, just answer to the message
-            else:
-                print(f"User {username} sent message to {self.config.NAME} in chat id {chat_id}.")
-                await update.message.reply_text(self.send_message(update))
+        maintenance = Maintenance(self.db)
 
         def shutdown():
+            maintenance.stop()
+            self.dispatcher.shutdown(wait=False)
+            self.trace_log.flush()
             print(self.config.TELEGRAM_STOPPED_MESSAGE.format(name=self.config.NAME))
             sys.exit(0)
 
         signal.signal(signal.SIGINT, shutdown)
 
         try:
-            application: Application = Application.builder().token(self.config.TELEGRAM_BOT_TOKEN).build()
-            application.add_handler(CommandHandler("start", start_command))
-            application.add_handler(CommandHandler("reset", reset_command))
-            application.add_handler(CommandHandler("help", help_command))
-            application.add_handler(CommandHandler("pic", pic_command))
-            application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, answer_to_message))
+            if self.config.METRICS_PORT:
+                start_metrics_server(self.config.METRICS_HOST, self.config.METRICS_PORT)
+            maintenance.start()
+            application: Application = self.build_application()
+            # run_polling closes its event loop at the end, the HTTP sessions of that loop are closed before
+            application.post_shutdown = lambda _: self.close()
             print(self.config.TELEGRAM_STARTED_MESSAGE.format(name=self.config.NAME))
             application.run_polling()
         except Exception as e:
@@ -92,11 +153,184 @@ class TelegramBot(ChatBot):
         finally:
             shutdown()
 
-    def send_message(self, update: Update) -> str or None:
+    async def close(self) -> None:
+        # the aiohttp session of the running event loop, used for the pictures and the asynchronous OpenAI requests
+        await self.pictures.close()
+
+    def build_application(self, base_url: str or None = None) -> Application:
+        application: Application = get_transport() \
+            .application_builder(self.config.TELEGRAM_BOT_TOKEN, base_url) \
+            .concurrent_updates(True) \
+            .build()
+        application.add_handler(CommandHandler("start", self.start_command))
+        application.add_handler(CommandHandler("reset", self.reset_command))
+        application.add_handler(CommandHandler("help", self.help_command))
+        application.add_handler(CommandHandler("pic", self.pic_command))
+        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.answer_to_message))
+        return application
+
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        username = clean_username(user.full_name)
+        await self.log_command(update, username, "/start")
+        await update.message.reply_html(
+            f"{self.config.TELEGRAM_START_MESSAGE.format(user=user.mention_html(), name=self.config.NAME, model=self.config.MODEL)}",
+            reply_markup=ForceReply(selective=True)
+        )
+
+    async def reset_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         user = update.effective_user
         username = clean_username(user.full_name)
-        msg_obj: OpenAIMessage = OpenAIMessage(update.message.text,
-                                               username, self.config.NAME,
-                                               'user', 'user', str(update.effective_chat.id))
-        answer_from_openai: OpenAIMessage = self.process_message(msg_obj)
+        chat_id = str(update.effective_chat.id)
+        # messages sent before the reset are answered first, in the conversation they belong to
+        await self.flush_pending_updates(chat_id)
+        await self.dispatcher.run(chat_id, self.reset_conversation, chat_id, username)
+        await self.log_command(update, username, "/reset")
+        await update.message.reply_text(f"{self.config.CONSOLE_RESET_MSG}")
+
+    async def pic_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        username = clean_username(user.full_name)
+        # /pic [n] prompt
+        args: list[str] = context.args or []
+        n = 1
+        if len(args) > 1 and args[0].isdigit():
+            n = int(args.pop(0))
+        prompt = " ".join(args)
+        if not prompt:
+            await update.message.reply_text(self.config.TELEGRAM_PIC_USAGE_MESSAGE)
+            return
+        await self.log_command(update, username, "/pic")
+        try:
+            pictures = await self.pictures.create(prompt, n)
+        except Exception as e:
+            await update.message.reply_text(f"{self.config.ERROR_LOG_MSG} {e}")
+            return
+        media = [picture.telegram_file_id or picture.data for picture in pictures]
+        with metrics.span("telegram_send"):
+            if len(pictures) == 1:
+                messages = [await update.message.reply_photo(photo=media[0],
+                                                             caption=self.config.TELEGRAM_IMAGE_CAPTION)]
+            else:
+                messages = await update.message.reply_media_group(
+                    [InputMediaPhoto(item, caption=self.config.TELEGRAM_IMAGE_CAPTION if i == 0 else None)
+                     for i, item in enumerate(media)])
+        for picture, message in zip(pictures, messages):
+            if message.photo:
+                await self.pictures.remember_file_id(picture, message.photo[-1].file_id)
+
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user = update.effective_user
+        username = clean_username(user.full_name)
+        await self.log_command(update, username, "/help")
+        await update.message.reply_text(f"{self.config.TELEGRAM_HELP_MESSAGE}")
+
+    async def answer_to_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        # answer to a reply-message from a user in a group
+        if update.message.chat.type == 'group':
+            replied = update.effective_message.reply_to_message and \
+                update.effective_message.reply_to_message.from_user.id == context.bot.id
+            # answer to a mention in a group
+            mentioned = any([entity.type == MessageEntity.MENTION
+                             for entity in update.effective_message.entities or []])
+            if replied:
+                metrics.inc("telegram_updates_total", kind="reply")
+            if mentioned:
+                metrics.inc("telegram_updates_total", kind="mention")
+            # a reply that also mentions the bot, or several mentions, still get one answer
+            if replied or mentioned:
+                await self.answer(update)
+        # if not in a group, just answer to the message
+        else:
+            metrics.inc("telegram_updates_total", kind="direct")
+            await self.answer(update)
+
+    async def answer(self, update: Update) -> None:
+        # messages a user sends within the coalescing window, or while the answer to their previous
+        # message is generated, are sent to OpenAI together as one turn
+        key = f"{update.effective_chat.id}:{update.effective_user.id}"
+        pending = self._pending_updates.get(key)
+        if pending is not None:
+            pending.updates.append(update)
+            metrics.inc("coalesced_messages_total")
+            return
+        self._pending_updates[key] = pending = PendingUpdates(update)
+        try:
+            while pending.updates:
+                try:
+                    await asyncio.wait_for(pending.flush.wait(), self.config.COALESCE_WINDOW_MS / 1000)
+                except asyncio.TimeoutError:
+                    pass
+                updates = list(pending.updates)
+                pending.updates.clear()
+                text = "\n".join([u.message.text for u in updates])
+                try:
+                    await self.reply(updates[-1], text)
+                except Exception as e:
+                    # the messages that arrived in the meantime are still answered
+                    metrics.inc("errors_total", error=type(e).__name__)
+                    self._handle_error(self._user_message(updates[-1], text), e)
+                    with contextlib.suppress(Exception):
+                        await updates[-1].message.reply_text(self.config.CONNECTION_ERROR_MESSAGE)
+        finally:
+            del self._pending_updates[key]
+            pending.answered.set()
+
+    async def flush_pending_updates(self, chat_id: str) -> None:
+        # answers the waiting messages of the chat now and returns when they are answered
+        for key, pending in list(self._pending_updates.items()):
+            if key.split(":", 1)[0] == chat_id:
+                pending.flush.set()
+                await pending.answered.wait()
+
+    async def reply(self, update: Update, text: str) -> None:
+        if not self.config.STREAM:
+            for chunk in split_message(await self.dispatch_message(update, text=text)):
+                with metrics.span("telegram_send"):
+                    await update.message.reply_text(chunk)
+            return
+        stream = TelegramStream(update.message, self.config.TELEGRAM_EDIT_INTERVAL)
+        stream.start()
+        answer = None
+        try:
+            answer = await self.dispatch_message(update, stream.feed, text)
+        finally:
+            await stream.finish(answer if answer is not None else stream.text)
+
+    async def dispatch_message(self, update: Update, on_delta: Callable[[str], None] or None = None,
+                               text: str or None = None) -> str or None:
+        try:
+            return await self.dispatcher.run(str(update.effective_chat.id), self.send_message, update, on_delta, text,
+                                             priority=self._priority(update))
+        except SchedulerBusyError as e:
+            # every worker is busy and the queue is full, the message is not sent to OpenAI
+            metrics.inc("scheduler_rejected_total")
+            self._handle_error(self._user_message(update, text), e)
+            return self.config.BUSY_MESSAGE
+
+    async def log_command(self, update: Update, username: str, command: str) -> None:
+        await self.async_db.add_message_to_system_log(f"{self.config.LOG_MSG_PREFIX} "
+                                                      f"{self.config.COMMAND_LOG_MSG} "
+                                                      f"{command} {username}"
+                                                      f"{self.config.LOG_MSG_APPENDIX}",
+                                                      'system', 'system', 'system', 'log',
+                                                      str(update.effective_chat.id), 0, datetime.datetime.now())
+
+    def reset_conversation(self, chat_id: str, username: str) -> None:
+        conversation = self.conversations.get(chat_id, username)
+        conversation.clear_messages()
+
+    def send_message(self, update: Update, on_delta: Callable[[str], None] or None = None,
+                     text: str or None = None) -> str or None:
+        answer_from_openai: OpenAIMessage = self.process_message(self._user_message(update, text), on_delta,
+                                                                 self._priority(update))
         return answer_from_openai.content
+
+    def _user_message(self, update: Update, text: str or None = None) -> OpenAIMessage:
+        username = clean_username(update.effective_user.full_name)
+        return OpenAIMessage(text if text is not None else update.message.text, username, self.config.NAME,
+                             'user', 'user', str(update.effective_chat.id))
+
+    @staticmethod
+    def _priority(update: Update) -> str:
+        return PRIORITY_DM if update.effective_chat.type == 'private' else PRIORITY_GROUP
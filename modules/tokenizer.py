@@ -0,0 +1,135 @@
+import hashlib
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+from modules.metrics import metrics
+
+if TYPE_CHECKING:
+    # imported on the first count, see Tokenizer.load_encoding
+    import tiktoken
+
+
+class ApproximateEncoding:
+    # used when the tokenizer data is neither in TIKTOKEN_CACHE_DIR nor can be downloaded: the text is split
+    # into words, numbers and punctuation like tiktoken does before its merges, about four characters a token
+    name: str = "approximate"
+    CHARACTERS_PER_TOKEN: int = 4
+    PIECES = re.compile(r"'(?i:[sdmt]|ll|ve|re)|[^\r\n\w]?[^\W\d_]+|\d{1,3}| ?[^\s\w]+[\r\n]*|\s*[\r\n]+|\s+")
+
+    def encode_ordinary_batch(self, texts: list[str]) -> list[range]:
+        # only the number of tokens is used
+        return [range(sum([math.ceil(len(piece) / self.CHARACTERS_PER_TOKEN) for piece in self.PIECES.findall(text)]))
+                for text in texts]
+
+
+class Tokenizer:
+    # chat format overhead billed by the API, see "How to count tokens with tiktoken" in the OpenAI cookbook
+    TOKENS_PER_MESSAGE: int = 3
+    TOKENS_PER_NAME: int = 1
+    TOKENS_REPLY_PRIMING: int = 3
+    FALLBACK_ENCODING: str = "cl100k_base"
+
+    def __init__(self, cache_size: int, cache_dir: str or None = None) -> None:
+        self.cache_size: int = cache_size
+        self.cache_dir: str or None = cache_dir
+        self._encodings: dict[str, "tiktoken.Encoding"] = {}
+        self._counts: OrderedDict[tuple[str, bytes], int] = OrderedDict()
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+
+    @property
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def encoding(self, model: str) -> "tiktoken.Encoding or ApproximateEncoding":
+        encoding = self._encodings.get(model)
+        if encoding is None:
+            try:
+                encoding = self.load_encoding(model)
+            except OSError as e:
+                # without network access the bot still runs, the prompts are only fitted less exactly
+                print(f"tokenizer data for {model} could not be loaded, token counts are estimated: {e}")
+                metrics.inc("tokenizer_fallbacks_total")
+                encoding = ApproximateEncoding()
+            self._encodings[model] = encoding
+        return encoding
+
+    def load_encoding(self, model: str) -> "tiktoken.Encoding":
+        # imported and loaded on the first count, tiktoken reads its data from TIKTOKEN_CACHE_DIR and only
+        # downloads it when it is not there; an empty TIKTOKEN_CACHE_DIR would turn the cache off
+        if self.cache_dir and not os.environ.get("TIKTOKEN_CACHE_DIR"):
+            os.environ["TIKTOKEN_CACHE_DIR"] = self.cache_dir
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(self.FALLBACK_ENCODING)
+
+    def prefetch(self, models: list[str]) -> None:
+        # fails without network access instead of falling back to estimates
+        for model in models:
+            self._encodings[model] = self.load_encoding(model)
+
+    def count(self, text: str, model: str) -> int:
+        return self.encode_batch([text], model)[0]
+
+    def encode_batch(self, texts: list[str], model: str) -> list[int]:
+        with metrics.span("tokenize"):
+            return self._encode_batch(texts, model)
+
+    def _encode_batch(self, texts: list[str], model: str) -> list[int]:
+        encoding = self.encoding(model)
+        keys = [(encoding.name, self._hash(text)) for text in texts]
+        counts: list[int or None] = []
+        with self._lock:
+            for key in keys:
+                count = self._counts.get(key)
+                if count is not None:
+                    self._counts.move_to_end(key)
+                counts.append(count)
+            missing = [i for i, count in enumerate(counts) if count is None]
+            self.hits += len(texts) - len(missing)
+            self.misses += len(missing)
+        if not missing:
+            return counts
+        # user content may contain special tokens like <|endoftext|>, they are billed as plain text
+        encoded = encoding.encode_ordinary_batch([texts[i] for i in missing])
+        with self._lock:
+            for i, tokens in zip(missing, encoded):
+                counts[i] = len(tokens)
+                self._counts[keys[i]] = counts[i]
+            while len(self._counts) > self.cache_size:
+                self._counts.popitem(last=False)
+        return counts
+
+    def message_overhead(self, role: str, name: str, model: str) -> int:
+        tokens_per_message, tokens_per_name = self._message_format(model)
+        role_tokens, name_tokens = self.encode_batch([role, name], model)
+        return tokens_per_message + role_tokens + name_tokens + tokens_per_name
+
+    def count_message(self, role: str, content: str, name: str, model: str) -> int:
+        return self.count(content, model) + self.message_overhead(role, name, model)
+
+    def count_messages(self, messages: list, model: str) -> None:
+        # fills in the token count of every message that has none, encoding all contents at once
+        pending = [msg for msg in messages if msg.token_count_is_missing]
+        if not pending:
+            return
+        content_counts = self.encode_batch([msg.content for msg in pending], model)
+        for msg, content_count in zip(pending, content_counts):
+            msg.token_count = content_count + self.message_overhead(msg.role, msg.sender, model)
+
+    @staticmethod
+    def _message_format(model: str) -> tuple[int, int]:
+        if model.startswith("gpt-3.5-turbo-0301"):
+            return 4, -1
+        return Tokenizer.TOKENS_PER_MESSAGE, Tokenizer.TOKENS_PER_NAME
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.blake2b(text.encode(), digest_size=16).digest()
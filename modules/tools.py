@@ -15,3 +15,17 @@ def replace_umlauts(text: str) -> str:
     for umlaut, replacement in umlauts.items():
         text = text.replace(umlaut, replacement)
     return text
+
+
+def split_message(text: str, limit: int = 4096) -> list[str]:
+    # splits at the last line break that fits, long lines are cut hard
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not chunks:
+        chunks.append(text)
+    return chunks
@@ -0,0 +1,116 @@
+import asyncio
+import importlib.util
+import threading
+import weakref
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from modules.config import Config
+
+# connection errors are retried by the adapter like in the session the openai module creates itself
+CONNECT_RETRIES: int = 2
+OPENAI_DEFAULT_API_BASE: str = "https://api.openai.com/v1"
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+class Transport:
+    # the HTTP clients of the process: one pooled requests session for the synchronous OpenAI calls, one aiohttp
+    # session per event loop for the asynchronous ones and the picture downloads, and the requests of the
+    # Telegram bot; keep-alive connections and TLS sessions are reused by all chats
+    def __init__(self, config: Config or None = None) -> None:
+        self.config: Config = config or Config()
+        self._lock = threading.Lock()
+        self._session: requests.Session or None = None
+        self._aiohttp_sessions: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+    @property
+    def session(self) -> requests.Session:
+        with self._lock:
+            if self._session is None:
+                self._session = self.create_session()
+            return self._session
+
+    def create_session(self) -> requests.Session:
+        # pool_maxsize connections are kept open per host, for up to pool_connections hosts
+        adapter = HTTPAdapter(pool_connections=self.config.HTTP_MAX_HOSTS,
+                              pool_maxsize=self.config.HTTP_MAX_CONNECTIONS_PER_HOST, max_retries=CONNECT_RETRIES)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def aiohttp_session(self) -> aiohttp.ClientSession:
+        # an aiohttp session can only be used in the event loop it was created in
+        loop = asyncio.get_running_loop()
+        session: aiohttp.ClientSession or None = self._aiohttp_sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.config.HTTP_MAX_CONNECTIONS,
+                                             limit_per_host=self.config.HTTP_MAX_CONNECTIONS_PER_HOST,
+                                             keepalive_timeout=self.config.HTTP_KEEPALIVE_TIMEOUT)
+            timeout = aiohttp.ClientTimeout(total=self.config.OPENAI_REQUEST_TIMEOUT,
+                                            connect=self.config.HTTP_CONNECT_TIMEOUT)
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._aiohttp_sessions[loop] = session
+        return session
+
+    async def close_aiohttp_session(self) -> None:
+        session: aiohttp.ClientSession or None = self._aiohttp_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+    def install(self) -> None:
+        # the openai module sends its synchronous requests through the shared session, the asynchronous ones
+        # use the session that is set in openai.aiosession by the caller
+        import openai
+        openai.requestssession = self.session
+        # the openai module also reads OPENAI_API_BASE when it is imported, an empty value would break it
+        openai.api_base = self.config.OPENAI_API_BASE or OPENAI_DEFAULT_API_BASE
+
+    def telegram_request(self, connection_pool_size: int):
+        # telegram is only imported by the Telegram modes
+        from telegram.request import HTTPXRequest
+        http_version = "2" if self.config.TELEGRAM_HTTP2 and http2_available() else "1.1"
+        return HTTPXRequest(connection_pool_size=connection_pool_size,
+                            read_timeout=self.config.TELEGRAM_TIMEOUT, write_timeout=self.config.TELEGRAM_TIMEOUT,
+                            connect_timeout=self.config.HTTP_CONNECT_TIMEOUT,
+                            pool_timeout=self.config.HTTP_CONNECT_TIMEOUT, http_version=http_version)
+
+    def telegram_options(self) -> dict:
+        # keyword arguments of telegram.Bot
+        options = {"request": self.telegram_request(self.config.HTTP_MAX_CONNECTIONS_PER_HOST),
+                   "get_updates_request": self.telegram_request(1)}
+        if self.config.TELEGRAM_API_BASE:
+            options["base_url"] = self.config.TELEGRAM_API_BASE
+        return options
+
+    def application_builder(self, token: str, base_url: str or None = None):
+        from telegram.ext import Application
+        # long polling keeps one connection busy, the answers have their own pool
+        builder = Application.builder().token(token) \
+            .request(self.telegram_request(self.config.HTTP_MAX_CONNECTIONS_PER_HOST)) \
+            .get_updates_request(self.telegram_request(1))
+        base_url = base_url or self.config.TELEGRAM_API_BASE
+        return builder.base_url(base_url) if base_url else builder
+
+
+# one transport per process, replaced e.g. to point the bot at local stand-in servers
+_transport: Transport or None = None
+_transport_lock = threading.Lock()
+
+
+def get_transport() -> Transport:
+    global _transport
+    with _transport_lock:
+        if _transport is None:
+            _transport = Transport()
+        return _transport
+
+
+def set_transport(transport: Transport) -> None:
+    global _transport
+    with _transport_lock:
+        _transport = transport
+    transport.install()
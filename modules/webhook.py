@@ -0,0 +1,149 @@
+import asyncio
+import hmac
+import json
+import os
+import secrets
+import openai
+from telegram import Bot, Update
+from telegram.ext import Application
+from modules.config import Config
+from modules.telegrambot import TelegramBot
+from modules.metrics import metrics, start_metrics_server
+from modules.shards import ShardRouter
+from modules.maintenance import Maintenance
+from modules.transport import get_transport
+
+SECRET_TOKEN_HEADER: bytes = b"x-telegram-bot-api-secret-token"
+
+
+class WebhookApp:
+    # minimal ASGI application: Telegram POSTs every update to the webhook path, the update is put
+    # into the update queue of the bot, or handed to a shard worker, and answered with 200 before it is processed
+    def __init__(self, bot: TelegramBot or None = None, router: ShardRouter or None = None) -> None:
+        self.bot: TelegramBot or None = bot
+        self.router: ShardRouter or None = router
+        self.config: Config = Config()
+        self.application: Application or None = None
+        # every uvicorn worker has one, they take turns through a lock file
+        self.maintenance: Maintenance = Maintenance()
+
+    async def __call__(self, scope: dict, receive, send) -> None:
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            event = await receive()
+            if event["type"] == "lifespan.startup":
+                await self.start()
+                await send({"type": "lifespan.startup.complete"})
+            elif event["type"] == "lifespan.shutdown":
+                await self.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def start(self) -> None:
+        if self.router:
+            self.router.start()
+        else:
+            self.application = self.bot.build_application()
+            await self.application.initialize()
+            # start() runs the handlers for everything in update_queue, concurrently per update
+            await self.application.start()
+        self.maintenance.start()
+        if self.config.METRICS_PORT and self.config.WEBHOOK_WORKERS == 1:
+            start_metrics_server(self.config.METRICS_HOST, self.config.METRICS_PORT)
+        print(self.config.TELEGRAM_STARTED_MESSAGE.format(name=self.config.NAME))
+
+    async def stop(self) -> None:
+        await asyncio.get_running_loop().run_in_executor(None, self.maintenance.stop)
+        if self.router:
+            await asyncio.get_running_loop().run_in_executor(None, self.router.stop)
+        else:
+            await self.application.stop()
+            await self.application.shutdown()
+            await self.bot.close()
+            self.bot.dispatcher.shutdown(wait=True)
+            self.bot.trace_log.flush()
+        print(self.config.TELEGRAM_STOPPED_MESSAGE.format(name=self.config.NAME))
+
+    async def _http(self, scope: dict, receive, send) -> None:
+        if scope["path"] != self.config.WEBHOOK_PATH:
+            await self._respond(send, 404)
+            return
+        if scope["method"] != "POST":
+            await self._respond(send, 405)
+            return
+        headers = dict(scope["headers"])
+        if not hmac.compare_digest(headers.get(SECRET_TOKEN_HEADER, b""), self.config.WEBHOOK_SECRET_TOKEN.encode()):
+            metrics.inc("webhook_requests_total", status="403")
+            await self._respond(send, 403)
+            return
+        body = await self._read_body(receive)
+        try:
+            data = json.loads(body)
+            update = Update.de_json(data, self.application.bot if self.application else None)
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            metrics.inc("webhook_requests_total", status="400")
+            await self._respond(send, 400)
+            return
+        if self.router:
+            self.router.route(data)
+        else:
+            await self.application.update_queue.put(update)
+        metrics.inc("webhook_requests_total", status="200")
+        await self._respond(send, 200)
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        body = b""
+        while True:
+            event = await receive()
+            body += event.get("body", b"")
+            if not event.get("more_body"):
+                return body
+
+    @staticmethod
+    async def _respond(send, status: int) -> None:
+        await send({"type": "http.response.start", "status": status,
+                    "headers": [(b"content-type", b"text/plain"), (b"content-length", b"0")]})
+        await send({"type": "http.response.body", "body": b""})
+
+
+def create_app() -> WebhookApp:
+    # called by uvicorn in every worker process
+    config = Config()
+    if config.SHARD_WORKERS > 0:
+        return WebhookApp(router=ShardRouter(config.SHARD_WORKERS))
+    openai.api_key = config.OPENAI_API_KEY
+    get_transport().install()
+    return WebhookApp(bot=TelegramBot())
+
+
+async def register_webhook(config: Config) -> None:
+    async with Bot(config.TELEGRAM_BOT_TOKEN, **get_transport().telegram_options()) as bot:
+        await bot.set_webhook(url=config.WEBHOOK_URL.rstrip("/") + config.WEBHOOK_PATH,
+                              secret_token=config.WEBHOOK_SECRET_TOKEN,
+                              allowed_updates=Update.ALL_TYPES)
+
+
+def run_webhook() -> None:
+    import uvicorn
+    # the workers are started with the environment of this process, so they all check the same token
+    if not os.environ.get("WEBHOOK_SECRET_TOKEN"):
+        os.environ["WEBHOOK_SECRET_TOKEN"] = secrets.token_urlsafe(32)
+    config = Config.reload()
+    # uvicorn workers would share out the updates of a chat, which breaks their order and the caches,
+    # so several processes run as shard workers behind the single front process
+    if config.SHARD_WORKERS == 0 and config.WEBHOOK_WORKERS > 1:
+        os.environ["SHARD_WORKERS"] = str(config.WEBHOOK_WORKERS)
+        config = Config.reload()
+    # without WEBHOOK_URL the server only accepts updates posted to it directly, e.g. for local tests
+    if config.WEBHOOK_URL:
+        asyncio.run(register_webhook(config))
+    uvicorn.run("modules.webhook:create_app", factory=True, host=config.WEBHOOK_HOST, port=config.WEBHOOK_PORT,
+                log_level="warning")
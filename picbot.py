@@ -1,30 +1,39 @@
+import asyncio
 import openai
-import requests
-import os
-from dotenv import load_dotenv
 import argparse
+from modules.config import Config
+from modules.picture import PictureGenerator
+from modules.transport import get_transport
 
-load_dotenv()
-API_KEY = os.getenv("OPENAI_API_KEY")
-openai.api_key = API_KEY
+config = Config()
+openai.api_key = config.OPENAI_API_KEY
+get_transport().install()
 
 
-def generate_image(prompt):
+async def generate_images(prompt: list[str], n: int) -> None:
+    generator = PictureGenerator()
     try:
         prompt_text = " ".join(prompt)
-        response = openai.Image.create(prompt=prompt_text, n=1)
-        image_url = response["data"][0]["url"]
-        image_data = requests.get(image_url).content
-        with open("generated_image.png", "wb") as f:
-            f.write(image_data)
+        pictures = await generator.create(prompt_text, n)
+        for i, picture in enumerate(pictures):
+            # pictures from the cache that were only sent to Telegram so far are read from the store
+            data = picture.data or generator.store.load(picture.content_hash)
+            file_name = "generated_image.png" if i == 0 else f"generated_image-{i + 1}.png"
+            with open(file_name, "wb") as f:
+                f.write(data)
+        if pictures and pictures[0].stored:
+            await pictures[0].stored
         print("Image generated successfully!")
     except Exception as e:
         print(f"Error generating image: {e}")
+    finally:
+        await generator.close()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate an image based on a prompt.")
     parser.add_argument("prompt", nargs="+", type=str, help="The prompt to generate the image from.")
+    parser.add_argument("-n", type=int, default=1, help="The number of images to generate.")
     args = parser.parse_args()
 
-    generate_image(args.prompt)
+    asyncio.run(generate_images(args.prompt, args.n))
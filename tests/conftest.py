@@ -0,0 +1,29 @@
+import os
+import tempfile
+import pytest
+from dotenv import dotenv_values
+from modules.config import Config
+
+EXAMPLE_ENV: str = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "example.env")
+
+
+def example_settings() -> dict[str, str]:
+    return {name: value or "" for name, value in dotenv_values(EXAMPLE_ENV).items()}
+
+
+def pytest_configure(config) -> None:
+    # modules may read the settings while the tests are collected, before any fixture runs
+    for name, value in example_settings().items():
+        os.environ.setdefault(name, value)
+    os.environ["DB_PATH"] = tempfile.mkdtemp(prefix="chatbot-tests-")
+    Config.reload()
+
+
+@pytest.fixture(autouse=True)
+def config(tmp_path, monkeypatch) -> Config:
+    # the settings of example.env with a database of its own for every test;
+    # a test changes a setting with monkeypatch.setenv and Config.reload()
+    for name, value in example_settings().items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setenv("DB_PATH", str(tmp_path))
+    return Config.reload()
@@ -0,0 +1,116 @@
+import time
+import openai
+import pytest
+from modules.ai import ChatPartner, CircuitBreaker, CircuitOpenError
+from modules.config import Config
+from modules.message import OpenAIMessage
+
+
+@pytest.fixture
+def delays(monkeypatch) -> list[float]:
+    # the backoff delays, nothing is waited for
+    delays: list[float] = []
+    monkeypatch.setattr("modules.ai.time.sleep", delays.append)
+    return delays
+
+
+@pytest.fixture
+def partner(monkeypatch, delays) -> ChatPartner:
+    for name, value in {"OPENAI_MAX_RETRIES": "3", "OPENAI_RETRY_BASE_DELAY": "1", "OPENAI_RETRY_MAX_DELAY": "4",
+                        "CIRCUIT_BREAKER_THRESHOLD": "5", "OPENAI_HEDGE_DELAY": "0"}.items():
+        monkeypatch.setenv(name, value)
+    Config.reload()
+    return ChatPartner()
+
+
+def fail_with(monkeypatch, errors: list[Exception]) -> list[dict]:
+    # raises the errors one after the other, then answers
+    calls: list[dict] = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        if errors:
+            raise errors.pop(0)
+        return {"choices": [{"message": {"role": "assistant", "content": "answer"}}]}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return calls
+
+
+def ask(partner: ChatPartner) -> dict:
+    return partner.talk_to_openai([OpenAIMessage("question", "User", "Chatbot", 'user', 'user', "chat")], 10)
+
+
+def test_transient_errors_are_retried_with_backoff(partner, delays, monkeypatch):
+    calls = fail_with(monkeypatch, [openai.error.Timeout("slow"), openai.error.ServiceUnavailableError("down"),
+                                    openai.error.RateLimitError("wait", headers={"retry-after": "3"})])
+    assert ask(partner)["choices"][0]["message"]["content"] == "answer"
+    assert len(calls) == 4
+    assert partner.stats.retries == 3
+    # full jitter below base * 2 ** attempt, but never earlier than the server asked for
+    assert 0 <= delays[0] <= 1 and 0 <= delays[1] <= 2 and delays[2] == 3
+    assert partner.circuit_breaker.state == CircuitBreaker.CLOSED
+
+
+def test_retries_stop_after_the_limit(partner, delays, monkeypatch):
+    calls = fail_with(monkeypatch, [openai.error.APIConnectionError("refused") for _ in range(10)])
+    with pytest.raises(openai.error.APIConnectionError):
+        ask(partner)
+    assert len(calls) == 4
+    assert len(delays) == 3 and max(delays) <= 4
+
+
+def test_errors_that_waiting_does_not_fix_are_not_retried(partner, delays, monkeypatch):
+    calls = fail_with(monkeypatch, [openai.error.RateLimitError("quota", code="insufficient_quota"),
+                                    openai.error.APIError("bad request", http_status=400),
+                                    openai.error.InvalidRequestError("too long", "messages")])
+    for error in (openai.error.RateLimitError, openai.error.APIError, openai.error.InvalidRequestError):
+        with pytest.raises(error):
+            ask(partner)
+    assert len(calls) == 3 and delays == []
+    assert partner.circuit_breaker.failures == 0
+
+
+def test_a_stream_is_not_retried_once_something_was_shown(partner, delays, monkeypatch):
+    def create(**kwargs):
+        yield {"choices": [{"delta": {"content": "Hel"}}]}
+        raise openai.error.APIConnectionError("connection lost")
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    shown: list[str] = []
+    with pytest.raises(openai.error.APIConnectionError):
+        partner.stream_to_openai([OpenAIMessage("question", "User", "Chatbot", 'user', 'user', "chat")], 10,
+                                 shown.append)
+    assert shown == ["Hel"] and delays == []
+
+
+def test_circuit_breaker_opens_probes_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError) as e:
+        breaker.before_call()
+    assert 0 < e.value.retry_in <= 30
+    # after the timeout one request probes the upstream, a failure opens the circuit again at once
+    breaker.opened_at = time.monotonic() - 31
+    breaker.before_call()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    breaker.opened_at = time.monotonic() - 31
+    breaker.before_call()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+    breaker.before_call()
+
+
+def test_open_circuit_stops_the_requests(partner, monkeypatch):
+    partner.circuit_breaker.failure_threshold = 2
+    calls = fail_with(monkeypatch, [openai.error.APIConnectionError("refused") for _ in range(10)])
+    with pytest.raises(CircuitOpenError):
+        ask(partner)
+    assert len(calls) == 2
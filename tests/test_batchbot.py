@@ -0,0 +1,28 @@
+import json
+import openai
+from modules.batchbot import BatchBot
+from modules.config import Config
+from modules.metrics import metrics
+
+
+def test_records_without_a_chat_are_counted_under_one_label(tmp_path, monkeypatch):
+    def create(**kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "answer"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    input_file, output_file = tmp_path / "prompts.jsonl", tmp_path / "results.jsonl"
+    input_file.write_text("".join([json.dumps({"prompt": f"question {i}"}) + "\n" for i in range(20)]))
+    BatchBot().run(str(input_file), str(output_file), concurrency=4)
+    results = [json.loads(line) for line in output_file.read_text().splitlines()]
+    assert sorted([result["record"] for result in results]) == list(range(1, 21))
+    assert {result["chat_id"] for result in results} == {f"batch-{i}" for i in range(1, 21)}
+    labels = {dict(labels).get("chat_id") for name, labels in metrics.counters if name == "tokens_total"}
+    assert "batch" in labels and not any([label.startswith("batch-") for label in labels])
+
+
+def test_a_batch_uses_its_share_of_the_rate_limits(monkeypatch):
+    monkeypatch.setenv("OPENAI_TOKENS_PER_MINUTE", "90000")
+    monkeypatch.setenv("BATCH_RATE_LIMIT_SHARE", "0.25")
+    Config.reload()
+    assert BatchBot().scheduler.token_bucket.capacity == 22500
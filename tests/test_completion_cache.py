@@ -0,0 +1,41 @@
+from modules.completion_cache import CompletionCache
+from modules.config import Config
+from modules.database import CachedCompletion, Database
+from modules.message import OpenAIMessage
+
+RESPONSE: dict = {"choices": [{"message": {"role": "assistant", "content": "42"}}],
+                  "usage": {"prompt_tokens": 10, "completion_tokens": 1}}
+
+
+def prompt(username: str, question: str) -> list[OpenAIMessage]:
+    # the config messages of a conversation and its first question, see ChatBot._create_start_messages
+    config = Config()
+    return [OpenAIMessage(config.SYSTEM_PROMPT, config.NAME, username, 'system', 'config', username),
+            OpenAIMessage(f"{config.MY_NAME_IS} {username}", username, config.NAME, 'user', 'config', username),
+            OpenAIMessage(f"{config.I_WILL_CALL_YOU} {username}", config.NAME, username, 'assistant', 'config',
+                          username),
+            OpenAIMessage(question, username, config.NAME, 'user', 'user', username)]
+
+
+def test_users_of_the_same_name_asking_the_same_question_share_an_entry(config):
+    cache = CompletionCache(Database(config.DB_URI))
+    key = cache.key(prompt("Alice", "What is the answer?"), 100)
+    assert cache.key(prompt("Alice", "What is  the answer?"), 100) == key
+    # the answer may call the user by name
+    assert cache.key(prompt("Bob", "What is the answer?"), 100) != key
+    assert cache.key(prompt("Alice", "What is it?"), 100) != key
+    assert cache.key(prompt("Alice", "What is the answer?"), 200) != key
+
+
+def test_limits_are_enforced_every_few_entries(config, monkeypatch):
+    monkeypatch.setenv("COMPLETION_CACHE_MAX_ENTRIES", "5")
+    monkeypatch.setattr(CompletionCache, "EVICT_EVERY", 10)
+    db = Database(Config.reload().DB_URI)
+    cache = CompletionCache(db)
+    for i in range(9):
+        cache.put(f"key-{i}", RESPONSE)
+    assert db.session.query(CachedCompletion).count() == 9
+    cache.put("key-9", RESPONSE)
+    assert db.session.query(CachedCompletion).count() == 5
+    assert cache.get("key-9") is not None
+    assert cache.get("key-0") is None
@@ -0,0 +1,89 @@
+import openai
+import pytest
+from modules.chatbot_base import ChatBot
+from modules.config import Config
+from modules.conversation import Conversation
+from modules.message import OpenAIMessage
+from modules.tokenizer import Tokenizer
+
+
+@pytest.fixture
+def requests(monkeypatch) -> list[dict]:
+    # the requests sent to OpenAI; summary requests are answered with a short summary
+    requests: list[dict] = []
+
+    def create(**kwargs):
+        requests.append(kwargs)
+        summary = kwargs["messages"][0]["content"].startswith(Config().SUMMARY_PROMPT[:20])
+        content = f"summary {len(requests)}" if summary else f"answer {len(requests)}"
+        return {"choices": [{"message": {"role": "assistant", "content": content}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return requests
+
+
+@pytest.fixture
+def bot(monkeypatch, requests) -> ChatBot:
+    for name, value in {"SUMMARY_TOKENS_THRESHOLD": "60", "MAX_TOKENS_SUMMARY": "10", "MESSAGE_MAX_TOKENS": "120",
+                        "MODEL_MAX_TOKENS": "200", "RESPONSE_MIN_TOKENS": "20", "MAX_TOKENS": "50",
+                        "STREAM": "false"}.items():
+        monkeypatch.setenv(name, value)
+    Config.reload()
+    return ChatBot()
+
+
+def ask(bot: ChatBot, text: str) -> OpenAIMessage:
+    return bot.process_message(OpenAIMessage(text, "Alice", bot.config.NAME, 'user', 'user', "chat"))
+
+
+def prompt_tokens(request: dict) -> int:
+    tokenizer, model = OpenAIMessage.tokenizer, Config().MODEL
+    return Tokenizer.TOKENS_REPLY_PRIMING + sum([tokenizer.count_message(msg["role"], msg["content"], msg["name"], model)
+                                                 for msg in request["messages"]])
+
+
+def test_old_turns_are_folded_into_a_summary(bot, requests):
+    for i in range(12):
+        assert ask(bot, f"question {i} " + "word " * 6).content.startswith("answer")
+    summaries = [request for request in requests if request["max_tokens"] == bot.config.MAX_TOKENS_SUMMARY]
+    assert summaries
+    conversation = bot.conversations.get("chat", "Alice")
+    assert conversation.summary_message.content.startswith(bot.config.SUMMARY_MESSAGE_PREFIX)
+    # folded before the newest question was answered
+    assert sum(conversation.user_messages.token_counts[:-2]) <= bot.config.SUMMARY_TOKENS_THRESHOLD
+    # the latest request has the config, the summary and the newest question, within the budget
+    last = requests[-1]
+    contents = [msg["content"] for msg in last["messages"]]
+    assert conversation.summary_message.content in contents
+    assert contents[-1].startswith("question 11")
+    assert prompt_tokens(last) <= bot.context_window.prompt_budget
+    assert last["max_tokens"] <= bot.config.MAX_TOKENS
+    # the folded messages are summarized again from the database after a restart
+    stored = Conversation("chat", "Alice")
+    assert stored.summary_message.content == conversation.summary_message.content
+    assert len(stored.user_messages) == len(conversation.user_messages)
+
+
+def test_a_message_over_the_budget_is_not_sent(bot, requests):
+    answer = ask(bot, "word " * 200)
+    assert requests == []
+    assert answer.content == bot.config.MESSAGE_TOO_LONG_USER_MSG.format(max_tokens=bot.context_window.prompt_budget)
+
+
+def test_folded_messages_relevant_to_the_question_are_sent_again(bot, requests, monkeypatch):
+    if not bot.db.shared_engine.search_index:
+        pytest.skip("sqlite without FTS5")
+    # room for more than the recent messages
+    monkeypatch.setattr(bot.config, "MESSAGE_MAX_TOKENS", 170)
+    ask(bot, "my cat is called Whiskers")
+    for i in range(10):
+        ask(bot, f"question {i} " + "word " * 6)
+    conversation = bot.conversations.get("chat", "Alice")
+    assert "my cat is called Whiskers" not in conversation.user_messages.contents
+    assert "my cat is called Whiskers" not in [msg["content"] for msg in requests[-1]["messages"]]
+    ask(bot, "how is Whiskers doing?")
+    contents = [msg["content"] for msg in requests[-1]["messages"]]
+    # after the summary and before the recent messages
+    recalled = contents.index("my cat is called Whiskers")
+    assert contents.index(conversation.summary_message.content) < recalled < len(contents) - 1
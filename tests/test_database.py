@@ -0,0 +1,62 @@
+import datetime
+import pytest
+from modules.config import Config
+from modules.database import Database, SystemLog
+
+
+def log_row(db: Database, message, chat_id: str = "chat") -> None:
+    db.add_message_to_system_log(message, 'system', 'system', 'system', 'log', chat_id, 0, datetime.datetime.now())
+
+
+@pytest.fixture
+def db(monkeypatch) -> Database:
+    # rows are only written by a full batch or a flush, not by a background thread
+    monkeypatch.setenv("DB_WRITE_BATCH_SIZE", "5")
+    monkeypatch.setenv("DB_WRITE_FLUSH_INTERVAL", "0")
+    return Database(Config.reload().DB_URI)
+
+
+def test_rows_are_written_in_batches_and_before_reads(db):
+    for i in range(7):
+        log_row(db, f"row {i}")
+    # the first five were a full batch
+    assert db.session.query(SystemLog).count() == 5
+    assert len(db.write_queue) == 2
+    assert [row.message for row in db.get_system_log_from_db("chat")] == [f"row {i}" for i in range(7)]
+
+
+def test_a_row_that_cannot_be_written_is_dropped_after_a_few_attempts(db, capsys):
+    log_row(db, "before")
+    log_row(db, object())
+    log_row(db, "after")
+    for _ in range(db.write_queue.MAX_FLUSH_ATTEMPTS - 1):
+        with pytest.raises(Exception):
+            db.flush()
+        assert len(db.write_queue) == 3
+    db.flush()
+    assert len(db.write_queue) == 0
+    assert "row dropped" in capsys.readouterr().out
+    assert [row.message for row in db.get_system_log_from_db("chat")] == ["before", "after"]
+    # later rows are written as usual
+    log_row(db, "later")
+    assert [row.message for row in db.get_system_log_from_db("chat")][-1] == "later"
+
+
+def test_search_finds_the_folded_messages_of_the_chat_by_relevance(db):
+    if not db.shared_engine.search_index:
+        pytest.skip("sqlite without FTS5")
+    for chat_id, content in [("chat", "my cat is called Whiskers"), ("chat", "the weather is nice"),
+                             ("chat", "Whiskers likes fish, the cat sleeps a lot"), ("chat", "what about my cat?"),
+                             ("other", "my cat is called Tom")]:
+        db.add_message_to_messages(content, "user", "bot", 'user', 'user', chat_id, 5, datetime.datetime.now())
+    db.fold_messages("chat", 3, "summary", "bot", "user", 5, datetime.datetime.now())
+    found = db.search_messages("chat", "Cat name?", 5)
+    # only folded messages of the chat, the newest message was not folded
+    assert {msg.content for _, msg in found} == {"my cat is called Whiskers",
+                                                 "Whiskers likes fish, the cat sleeps a lot"}
+    assert [msg.content for _, msg in db.search_messages("chat", "Whiskers fish", 5)][0] == \
+        "Whiskers likes fish, the cat sleeps a lot"
+    assert db.search_messages("chat", "nothing matches", 5) == []
+    assert db.search_messages("chat", "?!", 5) == []
+    db.remove_conversation("chat")
+    assert db.search_messages("chat", "cat", 5) == []
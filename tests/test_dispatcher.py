@@ -0,0 +1,70 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import openai
+from modules.config import Config
+from modules.dispatcher import ChatDispatcher
+from modules.scheduler import PRIORITY_DM, PRIORITY_GROUP
+from modules.telegrambot import TelegramBot
+
+
+def direct_message(number: int) -> SimpleNamespace:
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=number, type='private'),
+                           effective_user=SimpleNamespace(id=number, full_name=f"User {number}"),
+                           message=SimpleNamespace(text=f"question {number}"))
+
+
+def test_direct_messages_get_a_worker_before_groups():
+    dispatcher = ChatDispatcher(1)
+    release = threading.Event()
+    order: list[str] = []
+
+    async def main():
+        first = asyncio.create_task(dispatcher.run("0", release.wait, 5, priority=PRIORITY_DM))
+        await asyncio.sleep(0.01)
+        group = asyncio.create_task(dispatcher.run("1", order.append, "group", priority=PRIORITY_GROUP))
+        direct = asyncio.create_task(dispatcher.run("2", order.append, "dm", priority=PRIORITY_DM))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(first, group, direct)
+
+    asyncio.run(main())
+    dispatcher.shutdown()
+    assert order == ["dm", "group"]
+
+
+def test_chats_that_wait_for_a_worker_count_towards_the_queue(monkeypatch):
+    monkeypatch.setenv("MAX_CONCURRENT_REQUESTS", "2")
+    monkeypatch.setenv("SCHEDULER_MAX_QUEUE", "2")
+    monkeypatch.setenv("STREAM", "false")
+    config = Config.reload()
+    started = threading.Semaphore(0)
+    release = threading.Event()
+
+    def create(**kwargs):
+        started.release()
+        release.wait(5)
+        return {"choices": [{"message": {"role": "assistant", "content": "answer"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11}}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    bot = TelegramBot()
+
+    async def main() -> list[str]:
+        updates = [direct_message(number) for number in range(8)]
+        # both workers wait for OpenAI, two chats may wait for them and the other four are turned away
+        running = [asyncio.create_task(bot.dispatch_message(update, text=update.message.text))
+                   for update in updates[:2]]
+        for _ in running:
+            await asyncio.to_thread(started.acquire, timeout=5)
+        waiting = [asyncio.create_task(bot.dispatch_message(update, text=update.message.text))
+                   for update in updates[2:]]
+        await asyncio.sleep(0.1)
+        assert bot.scheduler.waiting == 2
+        release.set()
+        return await asyncio.gather(*running, *waiting)
+
+    answers = asyncio.run(main())
+    bot.dispatcher.shutdown()
+    assert answers == ["answer"] * 4 + [config.BUSY_MESSAGE] * 4
+    assert bot.scheduler.rejected == 4
@@ -0,0 +1,81 @@
+import datetime
+import glob
+import json
+import os
+import pytest
+from modules.config import Config
+from modules.database import Database, SystemLog
+from modules.maintenance import ArchiveStore, Maintenance
+from modules.report import UsageReport
+
+
+def usage_rows(count: int, date_time: datetime.datetime) -> list[dict]:
+    return [dict(message=json.dumps({"prompt_tokens": 10, "completion_tokens": 2}), from_user="user",
+                 to_user="bot", role="system", category="usage", chat_id="chat", token_count=12,
+                 date_time=date_time) for _ in range(count)]
+
+
+@pytest.fixture
+def maintenance(monkeypatch) -> Maintenance:
+    monkeypatch.setenv("LOG_RETENTION_DAYS", "30")
+    monkeypatch.setenv("LOG_RETENTION_ROWS_PER_CHAT", "0")
+    monkeypatch.setenv("MAINTENANCE_CHUNK_SIZE", "4")
+    return Maintenance(Database(Config.reload().DB_URI))
+
+
+def archived(maintenance: Maintenance) -> list[dict]:
+    return list(maintenance.archive.read('system_log'))
+
+
+def test_expired_rows_are_archived_once_they_are_counted(maintenance):
+    db = maintenance.db
+    old = datetime.datetime.now() - datetime.timedelta(days=60)
+    db.add_messages_to_system_log(usage_rows(10, old))
+    assert maintenance.run_once() == 9
+    # the newest row stays, so sqlite cannot give its id and the ids of the archived rows to new rows
+    assert db.session.query(SystemLog).count() == 1
+    assert len(archived(maintenance)) == 9
+    assert len(glob.glob(os.path.join(Config().ARCHIVE_PATH, "system_log", "*.jsonl.gz"))) == 3
+    db.add_messages_to_system_log(usage_rows(5, datetime.datetime.now()))
+    assert [row.id for row in db.session.query(SystemLog).order_by(SystemLog.id)] == list(range(10, 16))
+    # the old row is not the newest any more, the new rows are counted before it goes
+    assert maintenance.run_once() == 1
+    assert sum([row["requests"] for row in UsageReport(db).rows("month")]) == 15
+
+
+def test_rows_stay_in_the_database_when_the_delete_fails(maintenance, monkeypatch):
+    db = maintenance.db
+    db.add_messages_to_system_log(usage_rows(10, datetime.datetime.now() - datetime.timedelta(days=60)))
+    archive_rows = db.archive_rows
+
+    def failing_archive_rows(model, condition, write_rows, chunk_size):
+        def write_and_fail(rows):
+            write_rows(rows)
+            raise OSError("disk I/O error")
+        return archive_rows(model, condition, write_and_fail, chunk_size)
+
+    monkeypatch.setattr(db, "archive_rows", failing_archive_rows)
+    with pytest.raises(OSError):
+        maintenance.run_once()
+    assert db.session.query(SystemLog).count() == 10
+    assert os.listdir(os.path.join(Config().ARCHIVE_PATH, "system_log")) == []
+    monkeypatch.setattr(db, "archive_rows", archive_rows)
+    assert maintenance.run_once() == 9
+    assert sorted([row["id"] for row in archived(maintenance)]) == list(range(1, 10))
+
+
+def test_a_chunk_left_by_a_crash_is_kept_only_when_its_rows_were_deleted(maintenance):
+    db = maintenance.db
+    db.add_messages_to_system_log(usage_rows(3, datetime.datetime.now()))
+    rows = [row._asdict() for row in db.session.query(SystemLog.id, SystemLog.message).all()]
+    # a crash after the delete of rows 1 and 2, and one before the delete of row 3
+    deleted, kept = maintenance.archive.segment('system_log'), maintenance.archive.segment('system_log')
+    deleted.prefix += "-a"
+    kept.prefix += "-b"
+    deleted.write(rows[:2])
+    kept.write(rows[2:])
+    db.session.query(SystemLog).filter(SystemLog.id <= 2).delete()
+    db.session.commit()
+    ArchiveStore(Config().ARCHIVE_PATH).recover(db)
+    assert [row["id"] for row in archived(maintenance)] == [1, 2]
+    assert len(os.listdir(os.path.join(Config().ARCHIVE_PATH, "system_log"))) == 1
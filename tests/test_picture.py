@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+from modules.database import Database, StoredPicture
+from modules.picture import PictureStore
+
+
+def stored_picture(db: Database, prompt: str, content_hash: str, size: int, days_old: int = 0) -> None:
+    db.add_pictures(prompt, prompt, [(content_hash, size)])
+    if days_old:
+        db.session.query(StoredPicture).filter_by(prompt_key=prompt) \
+            .update({"created": datetime.now() - timedelta(days=days_old),
+                     "last_used": datetime.now() - timedelta(days=days_old)})
+        db.session.commit()
+
+
+def test_equal_pictures_are_stored_once(tmp_path):
+    store = PictureStore(str(tmp_path / "pictures"))
+    store.save("ab12", b"png")
+    store.save("ab12", b"png")
+    assert store.load("ab12") == b"png"
+    store.remove(["ab12", "cd34"])
+    assert store.load("ab12") is None
+
+
+def test_expired_pictures_are_removed_but_files_still_used_are_kept(config):
+    db = Database(config.DB_URI)
+    stored_picture(db, "old", "aa", 100, days_old=40)
+    stored_picture(db, "old and new", "bb", 100, days_old=40)
+    stored_picture(db, "new", "bb", 100)
+    assert db.expire_pictures(datetime.now() - timedelta(days=30), 1000) == ["aa"]
+    assert [row.prompt for row in db.session.query(StoredPicture)] == ["new"]
+
+
+def test_least_recently_used_pictures_go_beyond_the_size_limit(config):
+    db = Database(config.DB_URI)
+    stored_picture(db, "oldest", "aa", 100, days_old=3)
+    stored_picture(db, "older", "bb", 100, days_old=2)
+    stored_picture(db, "newest", "cc", 100)
+    stored_picture(db, "newest again", "cc", 100)
+    assert db.expire_pictures(datetime.now() - timedelta(days=30), 250) == ["aa"]
+    assert db.expire_pictures(datetime.now() - timedelta(days=30), 100) == ["bb"]
+    assert {row.content_hash for row in db.session.query(StoredPicture)} == {"cc"}
@@ -0,0 +1,73 @@
+import csv
+import io
+import json
+from datetime import datetime
+import pytest
+from modules.config import Config
+from modules.database import Database
+from modules.report import UsageReport, write_rows
+
+
+def log(category: str, role: str, user: str, chat_id: str, date_time: datetime, message: str = "") -> dict:
+    return dict(message=message, from_user=user, to_user="bot", role=role, category=category, chat_id=chat_id,
+                token_count=0, date_time=date_time)
+
+
+def usage(user: str, chat_id: str, date_time: datetime, prompt_tokens: int, completion_tokens: int) -> dict:
+    return log("usage", "system", user, chat_id, date_time,
+               json.dumps({"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}))
+
+
+@pytest.fixture
+def db(config) -> Database:
+    db = Database(Config().DB_URI)
+    db.add_messages_to_system_log([
+        log("user", "user", "alice", "1", datetime(2023, 6, 1, 10, 5)),
+        usage("alice", "1", datetime(2023, 6, 1, 10, 6), 100, 20),
+        log("user", "user", "bob", "2", datetime(2023, 6, 1, 11, 0)),
+        usage("bob", "2", datetime(2023, 6, 1, 11, 1), 50, 10),
+        log("user", "user", "alice", "1", datetime(2023, 6, 2, 9, 0)),
+        dict(log("error", "system", "system", "1", datetime(2023, 6, 2, 9, 1)), to_user="alice"),
+        # not counted
+        log("log", "system", "system", "1", datetime(2023, 6, 2, 9, 2)),
+    ])
+    return db
+
+
+def test_the_log_is_summed_up_per_period_user_and_chat(db):
+    report = UsageReport(db)
+    assert report.rows("day") == [
+        {"day": "2023-06-01", "messages": 2, "requests": 2, "prompt_tokens": 150, "completion_tokens": 30,
+         "errors": 0, "total_tokens": 180, "error_rate": 0.0},
+        {"day": "2023-06-02", "messages": 1, "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+         "errors": 1, "total_tokens": 0, "error_rate": 1.0},
+    ]
+    assert [(row["user"], row["total_tokens"], row["errors"]) for row in report.rows("user")] == [
+        ("alice", 120, 1), ("bob", 60, 0)]
+    assert [(row["chat"], row["messages"]) for row in report.rows("chat")] == [("1", 2), ("2", 1)]
+    assert [row["hour"] for row in report.rows("hour", since=datetime(2023, 6, 1, 11),
+                                               until=datetime(2023, 6, 2))] == ["2023-06-01 11:00"]
+
+
+def test_every_report_only_adds_the_rows_after_the_watermark(db):
+    report = UsageReport(db)
+    assert db.roll_up_usage() == 7
+    assert db.get_rollup_watermark() == 7
+    assert db.roll_up_usage() == 0
+    db.add_messages_to_system_log([usage("bob", "2", datetime(2023, 6, 1, 11, 30), 5, 5)])
+    # the new row is added to the hour that already has a rollup row
+    assert [row["total_tokens"] for row in report.rows("month")] == [190]
+    assert db.get_rollup_watermark() == 8
+    assert [row["total_tokens"] for row in report.rows("month")] == [190]
+
+
+def test_the_rows_are_written_as_table_csv_and_json(db):
+    rows = UsageReport(db).rows("month")
+    table, csv_file, json_file = io.StringIO(), io.StringIO(), io.StringIO()
+    write_rows(rows, "table", table)
+    write_rows(rows, "csv", csv_file)
+    write_rows(rows, "json", json_file)
+    header, line = table.getvalue().splitlines()
+    assert header.split() == list(rows[0]) and line.split()[:2] == ["2023-06", "3"]
+    assert next(csv.DictReader(io.StringIO(csv_file.getvalue())))["total_tokens"] == "180"
+    assert json.loads(json_file.getvalue()) == rows
@@ -0,0 +1,64 @@
+import queue
+import threading
+import time
+import pytest
+from modules.scheduler import RequestScheduler, SchedulerBusyError, PRIORITY_DM, PRIORITY_GROUP
+
+
+def wait_until_queued(scheduler: RequestScheduler, count: int) -> None:
+    deadline = time.monotonic() + 5
+    while scheduler.queued < count and time.monotonic() < deadline:
+        time.sleep(0.001)
+    assert scheduler.queued == count
+
+
+def test_direct_messages_go_first_and_group_chats_take_turns():
+    # 100 tokens a minute: once the first request took them all, the others wait until it gives them back
+    scheduler = RequestScheduler(0, 100, 10)
+    first = scheduler.acquire("first", PRIORITY_DM, 100)
+    served: queue.Queue = queue.Queue()
+
+    def request(name: str, chat_id: str, priority: str) -> None:
+        served.put((name, scheduler.acquire(chat_id, priority, 50)))
+
+    for i, (name, chat_id, priority) in enumerate([("a1", "a", PRIORITY_GROUP), ("a2", "a", PRIORITY_GROUP),
+                                                   ("b1", "b", PRIORITY_GROUP), ("c1", "c", PRIORITY_DM)]):
+        threading.Thread(target=request, args=(name, chat_id, priority), daemon=True).start()
+        wait_until_queued(scheduler, i + 1)
+    order: list[str] = []
+    finished = [first]
+    while len(order) < 4:
+        # a request that used no tokens gives back its whole estimate, which lets two more go
+        for ticket in finished:
+            ticket.actual_tokens = 0
+            scheduler.settle(ticket)
+        finished = [served.get(timeout=5), served.get(timeout=5)]
+        order.extend([name for name, _ in finished])
+        finished = [ticket for _, ticket in finished]
+    assert order == ["c1", "a1", "b1", "a2"]
+    assert scheduler.queued == 0
+
+
+def test_requests_beyond_the_queue_limit_are_rejected():
+    scheduler = RequestScheduler(0, 0, 2)
+    scheduler.admit()
+    scheduler.admit()
+    with pytest.raises(SchedulerBusyError):
+        scheduler.admit()
+    # an admitted request got a worker, its place in the queue is free again
+    scheduler.leave()
+    scheduler.admit()
+    assert (scheduler.waiting, scheduler.rejected) == (2, 1)
+    # a request that was admitted is not rejected again when it reaches the rate limits
+    scheduler.settle(scheduler.acquire("chat", PRIORITY_DM, 10))
+
+
+def test_a_share_of_the_limits_keeps_the_bucket_level():
+    scheduler = RequestScheduler(0, 1000, 10)
+    scheduler.acquire("a", PRIORITY_DM, 500)
+    # half the limit: half as much is left and it refills half as fast
+    scheduler.set_limits(0, 500)
+    assert scheduler.request_bucket is None
+    assert scheduler.token_bucket.capacity == 500
+    assert 250 <= scheduler.token_bucket.tokens < 251
+    assert scheduler.token_bucket.wait_time(500) == pytest.approx(30, abs=0.2)
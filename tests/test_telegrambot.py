@@ -0,0 +1,184 @@
+import asyncio
+import threading
+from types import SimpleNamespace
+import openai
+import pytest
+from telegram.error import BadRequest, NetworkError
+from modules.config import Config
+from modules.message import OpenAIMessage
+from modules.metrics import metrics
+from modules.telegrambot import TelegramBot, TelegramStream
+
+
+class FakeMessage:
+    def __init__(self, text: str, failures: int = 0) -> None:
+        self.text: str = text
+        self.failures: int = failures
+        self.replies: list[str] = []
+
+    async def reply_text(self, text: str) -> None:
+        if self.failures:
+            self.failures -= 1
+            raise NetworkError("connection lost")
+        self.replies.append(text)
+
+
+class FakeSentMessage:
+    # a streamed answer, the edits fail with the given errors first
+    def __init__(self, text: str, errors: list[Exception]) -> None:
+        self.text: str = text
+        self.errors: list[Exception] = errors
+        self.edits: int = 0
+
+    async def edit_text(self, text: str) -> None:
+        self.edits += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.text = text
+
+
+class FakeStreamMessage:
+    def __init__(self, errors: list[Exception]) -> None:
+        self.errors: list[Exception] = errors
+        self.sent: list[FakeSentMessage] = []
+
+    async def reply_text(self, text: str) -> FakeSentMessage:
+        self.sent.append(FakeSentMessage(text, self.errors))
+        return self.sent[-1]
+
+
+def direct_message(text: str, failures: int = 0) -> SimpleNamespace:
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=7, type='private'),
+                           effective_user=SimpleNamespace(id=7, full_name="User 7"),
+                           message=FakeMessage(text, failures))
+
+
+@pytest.fixture
+def prompts(monkeypatch) -> list[str]:
+    # the last message of every request sent to OpenAI
+    prompts: list[str] = []
+
+    def create(**kwargs):
+        prompts.append(kwargs["messages"][-1]["content"])
+        return {"choices": [{"message": {"role": "assistant", "content": f"answer {len(prompts)}"}}],
+                "usage": {"prompt_tokens": 10, "completion_tokens": 2, "total_tokens": 12}}
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", create)
+    return prompts
+
+
+@pytest.fixture
+def bot(monkeypatch, prompts) -> TelegramBot:
+    monkeypatch.setenv("STREAM", "false")
+    monkeypatch.setenv("COALESCE_WINDOW_MS", "100")
+    Config.reload()
+    bot = TelegramBot()
+    yield bot
+    bot.dispatcher.shutdown()
+
+
+def test_messages_within_the_window_are_answered_together(bot, prompts):
+    updates = [direct_message(text) for text in ("a", "b", "c")]
+
+    async def main():
+        await asyncio.gather(*[bot.answer(update) for update in updates])
+
+    asyncio.run(main())
+    assert prompts == ["a\nb\nc"]
+    assert [update.message.replies for update in updates] == [[], [], ["answer 1"]]
+
+
+def test_reset_answers_the_waiting_messages_first(bot, prompts, monkeypatch):
+    monkeypatch.setattr(bot.config, "COALESCE_WINDOW_MS", 60000)
+    question, reset = direct_message("question"), direct_message("/reset")
+
+    async def main():
+        answer = asyncio.create_task(bot.answer(question))
+        await asyncio.sleep(0.05)
+        await asyncio.wait_for(bot.reset_command(reset, None), 5)
+        assert answer.done()
+
+    asyncio.run(main())
+    assert prompts == ["question"]
+    assert question.message.replies == ["answer 1"]
+    assert reset.message.replies == [bot.config.CONSOLE_RESET_MSG]
+    assert len(bot.conversations.get("7", "User_7").user_messages) == 0
+
+
+def test_messages_are_answered_after_a_failed_reply(bot, prompts, monkeypatch):
+    started, release = threading.Event(), threading.Event()
+    create = openai.ChatCompletion.create
+
+    def slow_create(**kwargs):
+        started.set()
+        release.wait(5)
+        return create(**kwargs)
+
+    monkeypatch.setattr(openai.ChatCompletion, "create", slow_create)
+    first, second = direct_message("first", failures=1), direct_message("second")
+
+    async def main():
+        answer = asyncio.create_task(bot.answer(first))
+        await asyncio.to_thread(started.wait, 5)
+        # arrives while the answer to the first message is generated
+        await bot.answer(second)
+        release.set()
+        await answer
+
+    asyncio.run(main())
+    assert prompts == ["first", "second"]
+    assert first.message.replies == [bot.config.CONNECTION_ERROR_MESSAGE]
+    assert second.message.replies == ["answer 2"]
+
+
+def test_close_closes_the_http_session_of_the_event_loop(bot):
+    async def main():
+        session = bot.pictures.session
+        await bot.close()
+        return session
+
+    assert asyncio.run(main()).closed
+
+
+def test_stream_survives_failed_and_unchanged_edits(monkeypatch):
+    monkeypatch.setattr(TelegramStream, "RETRY_DELAY", 0)
+    message = FakeStreamMessage([NetworkError("timed out"), BadRequest("Message is not modified")])
+
+    async def main():
+        stream = TelegramStream(message, 0)
+        stream.start()
+        for delta in ("Hello", " world", "  \n"):
+            stream.feed(delta)
+            await asyncio.sleep(0.01)
+        await stream.finish("Hello world!")
+
+    asyncio.run(main())
+    assert [sent.text for sent in message.sent] == ["Hello world!"]
+    assert message.errors == []
+
+
+def test_stream_gives_up_on_the_final_text(monkeypatch):
+    monkeypatch.setattr(TelegramStream, "RETRY_DELAY", 0)
+    message = FakeStreamMessage([NetworkError("timed out")] * 10)
+
+    async def main():
+        stream = TelegramStream(message, 0)
+        stream.text = "Hello"
+        await stream._render()
+        await stream.finish("Hello world")
+
+    with pytest.raises(NetworkError):
+        asyncio.run(main())
+    assert message.sent[0].edits == TelegramStream.FINAL_RENDER_ATTEMPTS
+
+
+def test_tokens_are_counted_per_kind_of_chat(bot, monkeypatch):
+    def labels() -> set[str]:
+        return {dict(labels).get("chat_id") for name, labels in metrics.counters if name == "tokens_total"}
+
+    for chat_id in ("7", "-1001"):
+        bot.process_message(OpenAIMessage("question", "User_7", bot.config.NAME, 'user', 'user', chat_id))
+    assert {"dm", "group"} <= labels() and not {"7", "-1001"} & labels()
+    monkeypatch.setattr(bot.config, "METRICS_PER_CHAT", True)
+    bot.process_message(OpenAIMessage("question", "User_7", bot.config.NAME, 'user', 'user', "7"))
+    assert "7" in labels()
@@ -0,0 +1,44 @@
+import os
+import pytest
+import requests
+import tiktoken
+from modules.tokenizer import ApproximateEncoding, Tokenizer
+
+
+@pytest.fixture
+def offline(monkeypatch) -> list[str]:
+    # tiktoken cannot download its data, returns the cache directories it was asked to use
+    cache_dirs: list[str] = []
+
+    def load(name: str):
+        cache_dirs.append(os.environ.get("TIKTOKEN_CACHE_DIR"))
+        raise requests.ConnectionError(f"no network to download {name}")
+
+    monkeypatch.setattr(tiktoken, "encoding_for_model", load)
+    monkeypatch.setattr(tiktoken, "get_encoding", load)
+    return cache_dirs
+
+
+def test_an_empty_cache_dir_setting_does_not_turn_the_cache_off(offline, monkeypatch, tmp_path):
+    monkeypatch.setenv("TIKTOKEN_CACHE_DIR", "")
+    Tokenizer(10, str(tmp_path)).count("hello", "gpt-3.5-turbo")
+    assert offline == [str(tmp_path)]
+
+
+def test_token_counts_are_estimated_without_the_tokenizer_data(offline, tmp_path):
+    tokenizer = Tokenizer(10, str(tmp_path))
+    assert tokenizer.encode_batch(["Hello world, how are you?", ""], "gpt-3.5-turbo") == [9, 0]
+    assert isinstance(tokenizer.encoding("gpt-3.5-turbo"), ApproximateEncoding)
+    # the fallback is chosen once, not for every count
+    tokenizer.count("again", "gpt-3.5-turbo")
+    assert len(offline) == 1
+    with pytest.raises(OSError):
+        tokenizer.prefetch(["gpt-4"])
+
+
+def test_counts_are_cached_for_the_most_recent_texts(offline, tmp_path):
+    tokenizer = Tokenizer(2, str(tmp_path))
+    for text in ["one", "two", "one", "three", "two"]:
+        tokenizer.count(text, "gpt-3.5-turbo")
+    # "two" was dropped for "three", "one" was used again and kept until then
+    assert (tokenizer.hits, tokenizer.misses) == (1, 4)
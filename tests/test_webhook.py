@@ -0,0 +1,16 @@
+import uvicorn
+from modules.config import Config
+from modules.webhook import run_webhook
+
+
+def test_several_webhook_workers_run_as_shards(monkeypatch):
+    runs: list[dict] = []
+    monkeypatch.setattr(uvicorn, "run", lambda app, **kwargs: runs.append(kwargs))
+    monkeypatch.setenv("WEBHOOK_URL", "")
+    monkeypatch.setenv("WEBHOOK_SECRET_TOKEN", "secret")
+    monkeypatch.setenv("WEBHOOK_WORKERS", "3")
+    monkeypatch.setenv("SHARD_WORKERS", "0")
+    run_webhook()
+    # one front process routes the updates of a chat to the worker that owns it
+    assert Config().SHARD_WORKERS == 3
+    assert runs[0].get("workers", 1) == 1